@@ -0,0 +1,5 @@
+import time
+
+# Start of the init phase. Lambda imports this package before the handler
+# module, so the clock runs before the handler imports the SDK.
+IMPORT_STARTED = time.perf_counter()
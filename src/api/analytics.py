@@ -0,0 +1,160 @@
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+
+from boto3.dynamodb.types import TypeDeserializer
+
+from src.api.blobstore import get_blob_store
+from src.api.serializer import dumps
+from src.api.timestamps import TIMESTAMP_FORMAT
+
+# Change records of the Operations, Wallets and Users streams are written as
+# files under <prefix>/<entity>/dt=<day>/, one folder per day the changes
+# happened, so Redshift COPY and Spectrum can load or prune by partition
+ANALYTICS_PREFIX = os.getenv("ANALYTICS_PREFIX", "analytics")
+ANALYTICS_FORMAT = os.getenv("ANALYTICS_FORMAT", "parquet")
+ANALYTICS_COMPRESSION = os.getenv("ANALYTICS_COMPRESSION", "snappy")
+
+# Rows per file. The batch size and batching window of the event source
+# decide how many records and how much time go into one invocation.
+ANALYTICS_MAX_ROWS = int(os.getenv("ANALYTICS_MAX_ROWS", "10000"))
+
+STREAM_TABLES = {
+    os.getenv("OPERATIONS_TABLE", None): "operations",
+    os.getenv("WALLETS_TABLE", None): "wallets",
+    os.getenv("USERS_TABLE", None): "users",
+}
+
+_deserializer = TypeDeserializer()
+
+
+class AnalyticsError(ValueError):
+    pass
+
+
+def sequence_of(record):
+    # sequence numbers grow within a shard but not with a fixed width
+    return int(record["dynamodb"]["SequenceNumber"])
+
+
+def entity_of(record):
+    # arn:aws:dynamodb:<region>:<account>:table/<name>/stream/<label>
+    name = record["eventSourceARN"].split(":table/", 1)[1].split("/", 1)[0]
+    return STREAM_TABLES.get(name, name)
+
+
+def to_row(record):
+    # The new image of inserts and updates, the old one of deletes, plus
+    # the change itself so loads can keep the latest version of every item
+    change = record["dynamodb"]
+    image = change.get("NewImage") or change.get("OldImage") or change["Keys"]
+    changed = datetime.fromtimestamp(
+        change["ApproximateCreationDateTime"], timezone.utc
+    )
+    row = {
+        "eventName": record["eventName"],
+        "sequenceNumber": change["SequenceNumber"],
+        "changedAt": changed.strftime(TIMESTAMP_FORMAT),
+    }
+    for name, value in image.items():
+        value = _deserializer.deserialize(value)
+        row[name] = sorted(value) if isinstance(value, set) else value
+    return row
+
+
+def _arrow_column(pa, values):
+    # nested attributes become JSON text, and columns whose values have no
+    # common Arrow type, like legacy string balances, are kept as strings
+    values = [dumps(v) if isinstance(v, (list, dict)) else v for v in values]
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], pa.string())
+
+
+def encode_parquet(rows):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise AnalyticsError("parquet files need pyarrow, use ndjson without it")
+
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    columns = [_arrow_column(pa, [row.get(name) for row in rows]) for name in names]
+    sink = pa.BufferOutputStream()
+    pq.write_table(
+        pa.Table.from_arrays(columns, names=names),
+        sink,
+        compression=ANALYTICS_COMPRESSION,
+    )
+    return sink.getvalue().to_pybytes()
+
+
+def encode_ndjson(rows):
+    # COPY ... FORMAT JSON 'auto' GZIP
+    return gzip.compress(b"".join(dumps(row).encode("utf-8") + b"\n" for row in rows))
+
+
+ENCODERS = {
+    "parquet": (".parquet", encode_parquet),
+    "ndjson": (".ndjson.gz", encode_ndjson),
+}
+
+
+def plan_files(records, max_rows=None):
+    # Group rows by entity and day in sequence order, and cut every group
+    # into files of at most max_rows. Files are sorted by their first
+    # sequence number, so the ones left after a failure hold every record
+    # that still has to be written.
+    max_rows = max_rows or ANALYTICS_MAX_ROWS
+    groups = {}
+    for record in sorted(records, key=sequence_of):
+        row = to_row(record)
+        groups.setdefault((entity_of(record), row["changedAt"][:10]), []).append(row)
+
+    files = []
+    for (entity, day), rows in groups.items():
+        for start in range(0, len(rows), max_rows):
+            files.append((entity, day, rows[start : start + max_rows]))
+    return sorted(files, key=lambda f: int(f[2][0]["sequenceNumber"]))
+
+
+def export_records(records, store=None, file_format=None, max_rows=None):
+    # Write the records of a stream batch, returns the files written and the
+    # first sequence number that could not be written, if any. File names
+    # come from their sequence numbers, so a batch delivered again overwrites
+    # its files, rows carry sequenceNumber to drop the other duplicates.
+    file_format = file_format or ANALYTICS_FORMAT
+    if file_format not in ENCODERS:
+        raise AnalyticsError(f"Unsupported analytics format: {file_format}")
+    suffix, encode = ENCODERS[file_format]
+    store = store or get_blob_store()
+
+    files = plan_files(records, max_rows)
+    written = []
+    for index, (entity, day, rows) in enumerate(files):
+        first = rows[0]["sequenceNumber"]
+        last = rows[-1]["sequenceNumber"]
+        key = f"{ANALYTICS_PREFIX}/{entity}/dt={day}/{first}-{last}{suffix}"
+        try:
+            store.put(key, encode(rows))
+        except Exception as err:
+            print(json.dumps({"message": "Analytics export failed", "error": str(err)}))
+            pending = [
+                row["sequenceNumber"] for _, _, rows in files[index:] for row in rows
+            ]
+            return written, min(pending, key=int)
+        written.append({"key": key, "location": store.location(key), "rows": len(rows)})
+    return written, None
+
+
+def lambda_handler(event, context):
+    # Lambda checkpoints the shard when the handler returns, so nothing is
+    # buffered between invocations. A failed file makes Lambda retry the
+    # batch from its first unwritten record.
+    written, failed = export_records(event.get("Records", []))
+    print(json.dumps({"message": "Analytics files written", "files": written}))
+    if failed is None:
+        return {"batchItemFailures": []}
+    return {"batchItemFailures": [{"itemIdentifier": failed}]}
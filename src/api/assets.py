@@ -1,79 +1,117 @@
 import json
 import uuid
 import os
-import boto3
-from datetime import datetime
 
-# Prepare DynamoDB client
+from src.api.batch import batch_create
+from src.api.catalogue import AssetCatalogue
+from src.api.db import get_resource, record_import_time, table
+from src.api.export import export_ndjson, is_export_request
+from src.api.fields import get_fields, project, projection
+from src.api.pagination import fetch_page, page_headers
+from src.api.router import ApiError, Router, response
+from src.api.scan import parallel_scan
+
+# the SDK and every module the handler needs are loaded
+record_import_time()
+
+# DynamoDB table, the shared client is created on first use
 ASSETS_TABLE = os.getenv("ASSETS_TABLE", None)
-dynamodb = boto3.resource("dynamodb")
-ddbTable = dynamodb.Table(ASSETS_TABLE)
+
+# Asset catalogue kept in memory by warm containers
+catalogue = AssetCatalogue(ASSETS_TABLE)
+
+router = Router()
 
 
 def lambda_handler(event, context):
-    route_key = f"{event['httpMethod']} {event['resource']}"
+    return router.dispatch(event, context)
 
-    # Set default response, override with data from DynamoDB if any
-    response_body = {"Message": "Unsupported route"}
-    status_code = 400
 
-    try:
-        # Get a list of all Assets
-        if route_key == "GET /assets":
-            ddb_response = ddbTable.scan(Select="ALL_ATTRIBUTES")
-            # return list of items instead of full DynamoDB response
-            response_body = ddb_response["Items"]
-            status_code = 200
-
-        # CRUD operations for a single Asset
-
-        # Read an asset by ID
-        if route_key == "GET /assets/{assetId}":
-            # get data from the database
-            ddb_response = ddbTable.get_item(
-                Key={"assetId": event["pathParameters"]["assetId"]}
-            )
-            # return single item instead of full DynamoDB response
-            if "Item" in ddb_response:
-                response_body = ddb_response["Item"]
-            else:
-                response_body = {}
-            status_code = 200
-
-        # Delete a asset by ID
-        if route_key == "DELETE /assets/{assetId}":
-            # delete item in the database
-            ddbTable.delete_item(Key={"assetId": event["pathParameters"]["assetId"]})
-            response_body = {}
-            status_code = 200
-
-        # Create a new asset
-        if route_key == "POST /assets":
-            request_json = json.loads(event["body"])
-
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error: Invalid body fields"})
-
-            # generate unique id
-            request_json["assetId"] = str(uuid.uuid1())
-
-            # update the database
-            ddbTable.put_item(Item=request_json)
-            response_body = request_json
-            status_code = 200
-
-    except Exception as err:
-        status_code = 400
-        response_body = {"Error:": str(err)}
-        print(str(err))
+# Get a list of all Assets
+@router.route("GET", "/assets")
+def list_assets(request):
+    # read only the attributes asked for with ?fields=
+    fields = get_fields(request.event, "assets")
+    scan_kwargs = projection(fields)
+
+    # stream the whole table into the blob store
+    if is_export_request(request.event):
+        export = export_ndjson(
+            "assets", parallel_scan(table(ASSETS_TABLE), **scan_kwargs)
+        )
+        return response(200, {"export": export})
+
+    # serve the whole catalogue from memory when it is not paged
+    if "limit" not in request.query and "cursor" not in request.query:
+        items = catalogue.all()
+        if items is not None:
+            return response(200, [project(item, fields) for item in items])
+
+    # read a single page, the client follows the cursor for the rest
+    items, next_cursor = fetch_page(
+        table(ASSETS_TABLE).scan,
+        request.event,
+        **(scan_kwargs or {"Select": "ALL_ATTRIBUTES"}),
+    )
+    # return list of items instead of full DynamoDB response
+    return response(200, items, page_headers(next_cursor))
+
+
+# CRUD operations for a single Asset
+
+
+# Read an asset by ID
+@router.route("GET", "/assets/{assetId}")
+def get_asset(request):
+    # get data from the catalogue, missing ids are read from the database
+    asset = catalogue.get(request.path["assetId"])
+    return response(200, project(asset, get_fields(request.event, "assets")) or {})
+
+
+# Delete a asset by ID
+@router.route("DELETE", "/assets/{assetId}")
+def delete_asset(request):
+    # delete item in the database
+    table(ASSETS_TABLE).delete_item(Key={"assetId": request.path["assetId"]})
+    catalogue.invalidate()
+    return response(200, {})
+
+
+# Create many assets at once
+@router.route("POST", "/assets:batch")
+def create_assets(request):
+    status_code, response_body = batch_create(
+        get_resource(),
+        ASSETS_TABLE,
+        request.json(),
+        "assetId",
+        is_valid_body,
+        assign_asset_id,
+    )
+    catalogue.invalidate()
     return response(status_code, response_body)
 
 
-def response(status_code, body):
-    headers = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
+# Create a new asset
+@router.route("POST", "/assets")
+def create_asset(request):
+    request_json = request.json()
+
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    assign_asset_id(request_json)
+
+    # update the database
+    table(ASSETS_TABLE).put_item(Item=request_json)
+    catalogue.invalidate()
+    return response(200, request_json)
+
 
-    return {"statusCode": status_code, "body": json.dumps(body), "headers": headers}
+def assign_asset_id(request_json):
+    # generate unique id
+    request_json["assetId"] = str(uuid.uuid1())
 
 
 def is_valid_body(request_json):
@@ -0,0 +1,293 @@
+from decimal import Decimal, InvalidOperation
+
+from botocore.exceptions import ClientError
+
+from src.api.db import get_client, table
+from src.api.lookups import forget_wallet
+from src.api.rollups import day_of, rollup_actions, rollup_deltas
+from src.api.router import ApiError
+from src.api.updates import set_expression
+
+# DynamoDB accepts at most 100 actions per transaction, batches keep one of
+# them for the wallet update and one per day for the rollups
+TRANSACT_MAX_ITEMS = 100
+
+# Answer when the wallet of a write belongs to another user
+OWNER_MESSAGE = "Wallet does not belong to the user"
+
+
+class BalanceError(ApiError):
+    pass
+
+
+def parse_amount(value):
+    # amounts and balances are DynamoDB numbers, numeric strings are accepted
+    if isinstance(value, bool) or not isinstance(value, (int, float, Decimal, str)):
+        return None
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    if not amount.is_finite() or amount < 0:
+        return None
+    return amount
+
+
+def signed_amount(operation):
+    # what the operation adds to the balance of its wallet
+    if not operation:
+        return Decimal(0)
+    amount = Decimal(str(operation["amount"]))
+    return amount if operation["type"] == "buy" else -amount
+
+
+def _operation_condition(previous):
+    # the stored operation must still be the one the delta was computed from
+    if previous is None:
+        return {"ConditionExpression": "attribute_not_exists(operationId)"}
+    return {
+        "ConditionExpression": "walletId = :walletId AND amount = :amount AND #type = :type",
+        "ExpressionAttributeNames": {"#type": "type"},
+        "ExpressionAttributeValues": {
+            ":walletId": previous["walletId"],
+            ":amount": previous["amount"],
+            ":type": previous["type"],
+        },
+    }
+
+
+def _wallet_update(wallets_table, walletId, userId, delta, needed):
+    # ADD the delta to the balance, unless the wallet changed owner or the
+    # balance would go below zero on the way
+    condition = "userId = :userId"
+    values = {":userId": userId}
+    if needed > 0:
+        condition += " AND balance >= :needed"
+        values[":needed"] = needed
+    action = {
+        "TableName": wallets_table,
+        "Key": {"walletId": walletId},
+        "ConditionExpression": condition,
+        "ExpressionAttributeValues": values,
+    }
+    if delta == 0:
+        return {"ConditionCheck": action}
+    values[":delta"] = delta
+    return {"Update": {**action, "UpdateExpression": "ADD balance :delta"}}
+
+
+def _conflict(wallets_table, walletId, userId, reasons, wallet_index, owner_message):
+    # tell the client which condition cancelled the transaction, the wallet
+    # is only read again on this error path. None when no condition failed,
+    # like an ADD on a balance stored as a string, the caller raises the
+    # DynamoDB error then.
+    forget_wallet(walletId)
+    codes = [reason.get("Code") for reason in reasons]
+    if "ConditionalCheckFailed" in codes[:wallet_index]:
+        return BalanceError(409, "Operation was modified by another request")
+    if codes[wallet_index : wallet_index + 1] != ["ConditionalCheckFailed"]:
+        return None
+
+    ddb_response = table(wallets_table).get_item(
+        Key={"walletId": walletId}, ConsistentRead=True
+    )
+    wallet = ddb_response.get("Item")
+    if not wallet:
+        return BalanceError(400, "Wallet not found")
+    if wallet["userId"] != userId:
+        return BalanceError(400, owner_message)
+    return BalanceError(400, "Insufficient balance")
+
+
+def _transact(
+    wallets_table,
+    walletId,
+    userId,
+    actions,
+    wallet_index,
+    owner_message=OWNER_MESSAGE,
+):
+    # actions before wallet_index write operations, the one at wallet_index
+    # updates the wallet and the rest update the rollups
+    try:
+        # botocore gives every call a fresh ClientRequestToken and keeps it
+        # for its own retries. The conditions on the operation items make
+        # the rollups idempotent, a token derived from the change would make
+        # DynamoDB skip the same change made again within ten minutes.
+        get_client().transact_write_items(TransactItems=actions)
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "TransactionCanceledException":
+            raise
+        conflict = _conflict(
+            wallets_table,
+            walletId,
+            userId,
+            err.response.get("CancellationReasons", []),
+            wallet_index,
+            owner_message,
+        )
+        if conflict is None:
+            raise
+        raise conflict
+
+
+def _rollups(stats_table, walletId, deltas):
+    return rollup_actions(stats_table, walletId, deltas) if stats_table else []
+
+
+def write_operation(
+    operations_table,
+    wallets_table,
+    userId,
+    operation,
+    previous=None,
+    stats_table=None,
+):
+    # Put the operation, apply its amount to the wallet balance and to the
+    # daily rollups in a single transaction. previous is the stored version
+    # being replaced.
+    walletId = operation["walletId"]
+    delta = signed_amount(operation) - signed_amount(previous)
+    actions = [
+        {
+            "Put": {
+                "TableName": operations_table,
+                "Item": operation,
+                **_operation_condition(previous),
+            }
+        },
+        _wallet_update(wallets_table, walletId, userId, delta, max(-delta, 0)),
+        *_rollups(
+            stats_table, walletId, rollup_deltas(added=[operation], removed=[previous])
+        ),
+    ]
+    _transact(wallets_table, walletId, userId, actions, 1)
+
+
+def update_operation(
+    operations_table,
+    wallets_table,
+    userId,
+    previous,
+    changes,
+    stats_table=None,
+):
+    # Write only the changed attributes of the operation, and apply the
+    # difference to the wallet balance and the rollups in the same
+    # transaction. Returns the operation as it is now stored.
+    operation = {**previous, **changes}
+    walletId = previous["walletId"]
+    delta = signed_amount(operation) - signed_amount(previous)
+    actions = [
+        {
+            "Update": {
+                "TableName": operations_table,
+                "Key": {"operationId": previous["operationId"]},
+                **set_expression(changes, _operation_condition(previous)),
+            }
+        },
+        _wallet_update(wallets_table, walletId, userId, delta, max(-delta, 0)),
+        *_rollups(
+            stats_table,
+            walletId,
+            rollup_deltas(added=[operation], removed=[previous]),
+        ),
+    ]
+    _transact(wallets_table, walletId, userId, actions, 1)
+    return operation
+
+
+def delete_operation(
+    operations_table,
+    wallets_table,
+    userId,
+    previous,
+    stats_table=None,
+    owner_message=OWNER_MESSAGE,
+):
+    # Delete the operation and take its amount back from the wallet balance
+    # and the daily rollups
+    walletId = previous["walletId"]
+    delta = -signed_amount(previous)
+    actions = [
+        {
+            "Delete": {
+                "TableName": operations_table,
+                "Key": {"operationId": previous["operationId"]},
+                **_operation_condition(previous),
+            }
+        },
+        _wallet_update(wallets_table, walletId, userId, delta, max(-delta, 0)),
+        *_rollups(stats_table, walletId, rollup_deltas(removed=[previous])),
+    ]
+    _transact(
+        wallets_table,
+        walletId,
+        userId,
+        actions,
+        1,
+        owner_message,
+    )
+
+
+def _chunks(operations):
+    # split new operations so each transaction also fits the wallet update
+    # and one rollup update per day it touches
+    chunk, days = [], set()
+    for operation in operations:
+        chunk_days = days | {day_of(operation)}
+        if chunk and len(chunk) + 2 + len(chunk_days) > TRANSACT_MAX_ITEMS:
+            yield chunk
+            chunk, chunk_days = [], {day_of(operation)}
+        chunk.append(operation)
+        days = chunk_days
+    if chunk:
+        yield chunk
+
+
+def write_operations(
+    operations_table, wallets_table, walletId, userId, operations, stats_table=None
+):
+    # Write new operations of one wallet in transactions with a single wallet
+    # update of their net amount and their rollup updates. The balance must
+    # cover the deepest running deficit of the chunk, so it never goes below
+    # zero in the order of the request. Returns the operationId of every
+    # operation that could not be written mapped to (status, error), 503 for
+    # chunks that failed for any other reason than the wallet.
+    failed = {}
+    for chunk in _chunks(operations):
+        delta = Decimal(0)
+        needed = Decimal(0)
+        for operation in chunk:
+            delta += signed_amount(operation)
+            needed = max(needed, -delta)
+
+        actions = [
+            {
+                "Put": {
+                    "TableName": operations_table,
+                    "Item": operation,
+                    **_operation_condition(None),
+                }
+            }
+            for operation in chunk
+        ]
+        actions.append(_wallet_update(wallets_table, walletId, userId, delta, needed))
+        actions += _rollups(stats_table, walletId, rollup_deltas(added=chunk))
+        try:
+            _transact(
+                wallets_table,
+                walletId,
+                userId,
+                actions,
+                len(chunk),
+            )
+        except BalanceError as err:
+            for operation in chunk:
+                failed[operation["operationId"]] = (err.status_code, err.message)
+        except Exception as err:
+            # earlier chunks are committed, report this one and keep going
+            # so the client knows which operations to send again
+            for operation in chunk:
+                failed[operation["operationId"]] = (503, str(err))
+    return failed
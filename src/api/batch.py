@@ -0,0 +1,137 @@
+import os
+import random
+import time
+
+from src.api.router import ApiError
+
+# DynamoDB accepts at most 25 put or delete requests per BatchWriteItem call
+BATCH_WRITE_SIZE = 25
+
+# Upper bound of items accepted by a single batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+# Retries of unprocessed items, with exponential backoff and full jitter
+BATCH_MAX_RETRIES = int(os.getenv("BATCH_MAX_RETRIES", "5"))
+BATCH_BACKOFF_SECONDS = float(os.getenv("BATCH_BACKOFF_SECONDS", "0.05"))
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_batch(body):
+    # the body of a batch request is a non empty JSON array
+    if not isinstance(body, list) or not body:
+        raise BatchError("Body must be a non empty array")
+    if len(body) > BATCH_MAX_ITEMS:
+        raise BatchError(f"A batch accepts at most {BATCH_MAX_ITEMS} items")
+    return body
+
+
+def _backoff(attempt):
+    time.sleep(random.uniform(0, BATCH_BACKOFF_SECONDS * 2**attempt))
+
+
+def _batch_write(dynamodb, table_name, requests):
+    # Send write requests in chunks of 25 retrying unprocessed ones, and
+    # return every request that could not be written with its error
+    failed = []
+    for start in range(0, len(requests), BATCH_WRITE_SIZE):
+        pending = requests[start : start + BATCH_WRITE_SIZE]
+        attempt = 0
+        while pending:
+            try:
+                ddb_response = dynamodb.batch_write_item(
+                    RequestItems={table_name: pending}
+                )
+            except Exception as err:
+                failed += [(request, str(err)) for request in pending]
+                break
+
+            pending = ddb_response.get("UnprocessedItems", {}).get(table_name, [])
+            if not pending:
+                break
+            if attempt >= BATCH_MAX_RETRIES:
+                failed += [(request, "Unprocessed") for request in pending]
+                break
+            _backoff(attempt)
+            attempt += 1
+    return failed
+
+
+def batch_get_items(dynamodb, request_items):
+    # Read request_items with BatchGetItem retrying unprocessed keys, and
+    # return the items read per table. Keys still unprocessed after the
+    # last retry fail the request, a partial read would look like missing
+    # items.
+    items = {}
+    attempt = 0
+    while True:
+        ddb_response = dynamodb.batch_get_item(RequestItems=request_items)
+        for table_name, table_items in ddb_response["Responses"].items():
+            items.setdefault(table_name, []).extend(table_items)
+
+        request_items = ddb_response.get("UnprocessedKeys")
+        if not request_items:
+            return items
+        if attempt >= BATCH_MAX_RETRIES:
+            raise ApiError(503, "Items could not be read, try again")
+        _backoff(attempt)
+        attempt += 1
+
+
+def batch_put_items(dynamodb, table_name, items, key_name):
+    # Write items and return the key of every item that could not be
+    # written mapped to its error
+    failed = _batch_write(
+        dynamodb, table_name, [{"PutRequest": {"Item": item}} for item in items]
+    )
+    return {request["PutRequest"]["Item"][key_name]: error for request, error in failed}
+
+
+def batch_delete_keys(dynamodb, table_name, keys):
+    # Delete items by key and return the keys that could not be deleted
+    failed = _batch_write(
+        dynamodb, table_name, [{"DeleteRequest": {"Key": key}} for key in keys]
+    )
+    return [request["DeleteRequest"]["Key"] for request, _ in failed]
+
+
+def batch_create(
+    dynamodb, table_name, body, key_name, is_valid_body, prepare, write_items=None
+):
+    # Validate every item, write the valid ones and report a result per item
+    # in the order of the request. prepare() completes a valid item in place.
+    # write_items() replaces the plain BatchWriteItem and returns the key of
+    # every item it could not write mapped to (status, error).
+    results = []
+    items = []
+    for index, request_json in enumerate(parse_batch(body)):
+        if not isinstance(request_json, dict) or not is_valid_body(request_json):
+            results.append(
+                {"index": index, "status": 400, "Error": "Invalid body fields"}
+            )
+            continue
+        prepare(request_json)
+        items.append(request_json)
+        results.append({"index": index, "status": 201, "item": request_json})
+
+    failed = {}
+    if items and write_items:
+        failed = write_items(items)
+    elif items:
+        failed = {
+            key: (503, error)
+            for key, error in batch_put_items(
+                dynamodb, table_name, items, key_name
+            ).items()
+        }
+
+    for result in results:
+        key = result.get("item", {}).get(key_name)
+        if key in failed:
+            result.pop("item")
+            result["status"], result["Error"] = failed[key]
+
+    status_code = 200 if all(r["status"] == 201 for r in results) else 207
+    return status_code, {"results": results}
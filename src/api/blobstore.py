@@ -0,0 +1,141 @@
+import json
+import os
+
+# Backend used for exports: "local" (filesystem) or "s3"
+BLOB_STORE = os.getenv("BLOB_STORE", "local")
+BLOB_STORE_LOCAL_ROOT = os.getenv("BLOB_STORE_LOCAL_ROOT", "/tmp/blobstore")
+BLOB_STORE_BUCKET = os.getenv("BLOB_STORE_BUCKET", None)
+
+# Size of each part of a chunked object
+BLOB_CHUNK_BYTES = int(os.getenv("BLOB_CHUNK_BYTES", str(1024 * 1024)))
+
+MANIFEST_NAME = "manifest.json"
+
+
+class ChunkedWriter:
+    # Buffers writes and flushes them to the store as numbered parts, so only
+    # one chunk is ever held in memory. close() writes a manifest listing the
+    # parts and returns a handle to the finished object.
+    def __init__(self, store, key, chunk_bytes=None, part_suffix=""):
+        self.store = store
+        self.key = key
+        self.chunk_bytes = chunk_bytes or BLOB_CHUNK_BYTES
+        self.part_suffix = part_suffix
+        self.parts = []
+        self.size = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        self.size += len(data)
+        if len(self._buffer) >= self.chunk_bytes:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        part_key = f"{self.key}/part-{len(self.parts):05d}{self.part_suffix}"
+        self.store.put(part_key, bytes(self._buffer))
+        self.parts.append(part_key)
+        self._buffer = bytearray()
+
+    def close(self, metadata=None):
+        self._flush()
+        manifest = dict(metadata or {}, parts=self.parts, bytes=self.size)
+        manifest_key = f"{self.key}/{MANIFEST_NAME}"
+        self.store.put(manifest_key, json.dumps(manifest).encode("utf-8"))
+        return dict(
+            manifest,
+            store=self.store.name,
+            key=self.key,
+            location=self.store.location(self.key),
+            manifest=manifest_key,
+        )
+
+
+class BlobStore:
+    name = None
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def location(self, key):
+        raise NotImplementedError
+
+    def open_writer(self, key, chunk_bytes=None, part_suffix=""):
+        return ChunkedWriter(self, key, chunk_bytes, part_suffix)
+
+    def read_chunked(self, key):
+        # yield the parts of a chunked object in order
+        manifest = json.loads(self.get(f"{key}/{MANIFEST_NAME}"))
+        for part_key in manifest["parts"]:
+            yield self.get(part_key)
+
+
+class LocalBlobStore(BlobStore):
+    name = "local"
+
+    def __init__(self, root=None):
+        self.root = root or BLOB_STORE_LOCAL_ROOT
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"Invalid key: {key}")
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see partial parts
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def get(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    def location(self, key):
+        return self._path(key)
+
+
+class S3BlobStore(BlobStore):
+    name = "s3"
+
+    def __init__(self, bucket=None, client=None):
+        self.bucket = bucket or BLOB_STORE_BUCKET
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client("s3")
+        return self._client
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+
+    def location(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+
+BLOB_STORES = {
+    LocalBlobStore.name: LocalBlobStore,
+    S3BlobStore.name: S3BlobStore,
+}
+
+
+def get_blob_store(name=None):
+    name = name or BLOB_STORE
+    if name not in BLOB_STORES:
+        raise ValueError(f"Unknown blob store: {name}")
+    return BLOB_STORES[name]()
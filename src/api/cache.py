@@ -0,0 +1,60 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    # Bounded least recently used cache whose entries expire after ttl seconds.
+    # None is a valid value, so negative lookups can be cached too.
+    def __init__(self, max_items, ttl, clock=time.monotonic):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        # return the cached value or MISSING, max_age tightens the TTL for
+        # callers that accept less staleness, 0 bypasses the cache
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        with self._lock:
+            entry = self._entries.get(key, MISSING)
+            if entry is not MISSING:
+                stored_at, value = entry
+                if self.clock() - stored_at < max_age:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if self.clock() - stored_at >= self.ttl:
+                    del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
@@ -0,0 +1,136 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Key
+
+from src.api.batch import BATCH_WRITE_SIZE, batch_delete_keys
+from src.api.db import OPERATIONS_WALLET_INDEX, get_client, table
+from src.api.fields import projection
+from src.api.jobs import start_job
+from src.api.pagination import iter_items
+from src.api.router import ApiError
+
+# BatchWriteItem calls in flight during a cascading delete
+CASCADE_WORKERS = int(os.getenv("CASCADE_WORKERS", "8"))
+
+# Largest cascade deleted within the request, bigger ones run as a job
+CASCADE_SYNC_MAX_ITEMS = int(os.getenv("CASCADE_SYNC_MAX_ITEMS", "200"))
+
+
+class CascadeError(ApiError):
+    pass
+
+
+def wallet_children(operations_table, stats_table, walletId):
+    # (table, key) of the operations and daily rollups of a wallet, read
+    # from the index partition of the wallet with keys only
+    operations = iter_items(
+        table(operations_table).query,
+        IndexName=OPERATIONS_WALLET_INDEX,
+        KeyConditionExpression=Key("walletId").eq(walletId),
+        **projection(["operationId"]),
+    )
+    for operation in operations:
+        yield operations_table, {"operationId": operation["operationId"]}
+    if stats_table:
+        rollups = iter_items(
+            table(stats_table).query,
+            KeyConditionExpression=Key("walletId").eq(walletId),
+            **projection(["walletId", "period"]),
+        )
+        for rollup in rollups:
+            yield stats_table, rollup
+
+
+def wallet_levels(wallets_table, operations_table, stats_table, walletId):
+    return [
+        wallet_children(operations_table, stats_table, walletId),
+        [(wallets_table, {"walletId": walletId})],
+    ]
+
+
+def user_levels(users_table, wallets_table, operations_table, stats_table, userId):
+    wallets = list(
+        iter_items(
+            table(wallets_table).query,
+            IndexName="Wallets-AssetIndex",
+            KeyConditionExpression=Key("userId").eq(userId),
+            **projection(["walletId"]),
+        )
+    )
+    return [
+        itertools.chain.from_iterable(
+            wallet_children(operations_table, stats_table, wallet["walletId"])
+            for wallet in wallets
+        ),
+        [(wallets_table, {"walletId": wallet["walletId"]}) for wallet in wallets],
+        [(users_table, {"userId": userId})],
+    ]
+
+
+def collect(levels, max_items=None):
+    # read the keys of every level, None once there are more than max_items
+    collected = []
+    count = 0
+    for level in levels:
+        keys = []
+        for entry in level:
+            count += 1
+            if max_items is not None and count > max_items:
+                return None
+            keys.append(entry)
+        collected.append(keys)
+    return collected
+
+
+def _chunks(keys):
+    by_table = {}
+    for table_name, key in keys:
+        by_table.setdefault(table_name, []).append(key)
+    for table_name, table_keys in by_table.items():
+        for start in range(0, len(table_keys), BATCH_WRITE_SIZE):
+            yield table_name, table_keys[start : start + BATCH_WRITE_SIZE]
+
+
+def delete_levels(levels):
+    # Delete level after level with concurrent BatchWriteItem calls. A level
+    # starts once the previous one is fully deleted, so no item is left
+    # behind without the parent that leads to it. levels come from collect(),
+    # returns the number of items deleted.
+    client = get_client()
+    deleted = 0
+    with ThreadPoolExecutor(
+        max_workers=CASCADE_WORKERS, thread_name_prefix="cascade"
+    ) as executor:
+        for level in levels:
+            futures = [
+                executor.submit(batch_delete_keys, client, table_name, chunk)
+                for table_name, chunk in _chunks(level)
+            ]
+            failed = sum(len(future.result()) for future in futures)
+            if failed:
+                raise CascadeError(503, f"{failed} items could not be deleted")
+            deleted += len(level)
+    return deleted
+
+
+def wants_job(event):
+    params = event.get("queryStringParameters") or {}
+    return params.get("async") == "true"
+
+
+def delete_cascade(request, kind, params, plan):
+    # Delete small cascades within the request and return None. Larger ones,
+    # or any with ?async=true, run as a job that is returned for polling.
+    # plan() returns the levels to delete.
+    if not wants_job(request.event):
+        levels = collect(plan(), CASCADE_SYNC_MAX_ITEMS)
+        if levels is not None:
+            delete_levels(levels)
+            return None
+    return start_job(kind, params, request.path["userId"], request.context)
+
+
+def job_location(job):
+    return {"Location": f"/users/{job['userId']}/jobs/{job['jobId']}"}
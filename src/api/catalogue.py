@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+
+from src.api.batch import batch_get_items
+from src.api.db import get_resource, table
+from src.api.pagination import iter_items
+
+# Seconds a loaded asset catalogue is served before it is read again
+ASSET_CACHE_TTL = float(os.getenv("ASSET_CACHE_TTL", "300"))
+
+# DynamoDB reads at most 100 keys per BatchGetItem call
+BATCH_GET_SIZE = 100
+
+# Catalogues larger than this are not cached as a whole
+ASSET_CACHE_MAX_ITEMS = int(os.getenv("ASSET_CACHE_MAX_ITEMS", "10000"))
+
+# Fraction of the TTL after which a background refresh is started, so warm
+# invocations keep reading from memory while the new copy is loaded
+ASSET_CACHE_REFRESH_AHEAD = float(os.getenv("ASSET_CACHE_REFRESH_AHEAD", "0.8"))
+
+
+class AssetCatalogue:
+    # Process level copy of the Assets table, kept for the life of the Lambda
+    # container. Writes done by this container invalidate it, writes done by
+    # other containers are picked up after at most one TTL.
+    def __init__(self, table_name, ttl=None, max_items=None, clock=time.monotonic):
+        self.table_name = table_name
+        self.ttl = ASSET_CACHE_TTL if ttl is None else ttl
+        self.max_items = max_items or ASSET_CACHE_MAX_ITEMS
+        self.clock = clock
+        self.complete = False
+        self._assets = None
+        self._loaded_at = None
+        self._refreshing = False
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # the low level client is safe to share with the refresh thread
+        generation = self._generation
+        assets = {}
+        complete = True
+        for item in iter_items(
+            table(self.table_name).meta.client.scan,
+            TableName=self.table_name,
+        ):
+            if len(assets) >= self.max_items:
+                complete = False
+                break
+            assets[item["assetId"]] = item
+
+        with self._lock:
+            self._refreshing = False
+            # drop the copy if a write invalidated the catalogue meanwhile
+            if generation != self._generation:
+                return assets
+            self._assets = assets
+            self.complete = complete
+            self._loaded_at = self.clock()
+        return assets
+
+    def _refresh_in_background(self):
+        try:
+            self._load()
+        except Exception as err:
+            # keep serving the current copy, the next access retries
+            self._refreshing = False
+            print(str(err))
+
+    def _fresh_assets(self):
+        with self._lock:
+            assets, loaded_at = self._assets, self._loaded_at
+            age = None if assets is None else self.clock() - loaded_at
+            refresh = (
+                age is not None
+                and age >= self.ttl * ASSET_CACHE_REFRESH_AHEAD
+                and age < self.ttl
+                and not self._refreshing
+            )
+            if refresh:
+                self._refreshing = True
+
+        if age is None or age >= self.ttl:
+            return self._load()
+        if refresh:
+            threading.Thread(target=self._refresh_in_background, daemon=True).start()
+        return assets
+
+    def all(self):
+        # every asset, or None when the table does not fit in the cache
+        assets = self._fresh_assets()
+        return list(assets.values()) if self.complete else None
+
+    def get(self, assetId):
+        assets = self._fresh_assets()
+        if assetId in assets:
+            return assets[assetId]
+
+        # the asset may have been created by another container since the load
+        ddb_response = table(self.table_name).get_item(Key={"assetId": assetId})
+        item = ddb_response.get("Item")
+        if item:
+            with self._lock:
+                if self._assets is not None and len(self._assets) < self.max_items:
+                    self._assets[assetId] = item
+        return item
+
+    def get_many(self, assetIds):
+        # assets by id, ids missing from memory are read with BatchGetItem
+        assets = self._fresh_assets()
+        found = {k: assets[k] for k in assetIds if k in assets}
+        missing = [k for k in assetIds if k not in assets]
+        for start in range(0, len(missing), BATCH_GET_SIZE):
+            request_items = {
+                self.table_name: {
+                    "Keys": [
+                        {"assetId": k} for k in missing[start : start + BATCH_GET_SIZE]
+                    ]
+                }
+            }
+            items = batch_get_items(get_resource(), request_items)
+            for item in items.get(self.table_name, []):
+                found[item["assetId"]] = item
+        return found
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._assets = None
+            self._loaded_at = None
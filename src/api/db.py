@@ -0,0 +1,58 @@
+import json
+import os
+import time
+
+import boto3
+
+from src.api import IMPORT_STARTED
+from src.api.metrics import instrument
+
+# How long the init phase spent importing the handler module with the SDK,
+# and creating the client
+init_timings = {}
+
+# Indexes of the operations of a wallet and their sort key. Operations
+# stored before createdAt existed are missing from Operations-WalletTimeIndex
+# until the backfill in migrations.py ran, the deployment reads the walletId
+# only Operations-WalletIndex until then.
+OPERATIONS_WALLET_INDEXES = {
+    "Operations-WalletIndex": None,
+    "Operations-WalletTimeIndex": "createdAt",
+}
+OPERATIONS_WALLET_INDEX = os.getenv(
+    "OPERATIONS_WALLET_INDEX", "Operations-WalletTimeIndex"
+)
+
+# Created on first use and kept for the life of the container
+_resource = None
+_tables = {}
+
+
+def record_import_time():
+    # called by every handler module once its imports are done
+    init_timings["importMs"] = round((time.perf_counter() - IMPORT_STARTED) * 1000, 3)
+
+
+def get_resource():
+    # the DynamoDB resource wraps a single low level client shared by every
+    # module and Table handle of the container
+    global _resource
+    if _resource is None:
+        started = time.perf_counter()
+        _resource = boto3.resource("dynamodb")
+        # count, time and cost every call of the shared client
+        instrument(_resource.meta.client)
+        init_timings["clientMs"] = round((time.perf_counter() - started) * 1000, 3)
+        print(json.dumps({"message": "DynamoDB client initialised", **init_timings}))
+    return _resource
+
+
+def get_client():
+    return get_resource().meta.client
+
+
+def table(name):
+    # Table handles are created once per container instead of once per call
+    if name not in _tables:
+        _tables[name] = get_resource().Table(name)
+    return _tables[name]
@@ -0,0 +1,47 @@
+import hashlib
+
+from src.api.compression import ENCODINGS
+
+
+def etag_for(body):
+    # strong validator taken from a hash of the encoded body
+    return '"' + hashlib.blake2b(body.encode("utf-8"), digest_size=16).hexdigest() + '"'
+
+
+def _opaque_tag(tag):
+    # If-None-Match uses the weak comparison, and compressed responses carry
+    # the encoding as a suffix of the same tag
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    base, _, suffix = tag.rpartition("-")
+    if base and suffix in ENCODINGS:
+        return base
+    return tag
+
+
+def matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = _opaque_tag(etag)
+    return any(_opaque_tag(tag) == wanted for tag in if_none_match.split(","))
+
+
+def conditional_response(response, if_none_match):
+    # only successful reads are validated
+    if response["statusCode"] != 200:
+        return response
+
+    etag = etag_for(response["body"])
+    headers = dict(response["headers"])
+    headers["ETag"] = etag
+    exposed = headers.get("Access-Control-Expose-Headers")
+    headers["Access-Control-Expose-Headers"] = f"{exposed}, ETag" if exposed else "ETag"
+
+    if matches(if_none_match, etag):
+        # the client already holds this content
+        return {**response, "statusCode": 304, "headers": headers, "body": ""}
+    return {**response, "headers": headers}
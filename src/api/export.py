@@ -0,0 +1,34 @@
+import uuid
+
+from src.api.blobstore import get_blob_store
+from src.api.serializer import dumps
+
+EXPORT_FORMATS = ("ndjson",)
+
+
+class ExportError(ValueError):
+    pass
+
+
+def is_export_request(event):
+    params = event.get("queryStringParameters") or {}
+    export_format = params.get("export")
+    if export_format is None:
+        return False
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Unsupported export format: {export_format}")
+    return True
+
+
+def export_ndjson(entity, items, store=None, chunk_bytes=None):
+    # Encode items one line at a time into a chunked object, so memory use
+    # depends on the chunk size and not on the number of items
+    store = store or get_blob_store()
+    writer = store.open_writer(
+        f"exports/{entity}/{uuid.uuid4()}", chunk_bytes, ".ndjson"
+    )
+    count = 0
+    for item in items:
+        writer.write(dumps(item).encode("utf-8") + b"\n")
+        count += 1
+    return writer.close({"entity": entity, "format": "ndjson", "items": count})
@@ -0,0 +1,51 @@
+# Attributes each entity can select with ?fields=, they follow the
+# <Entity>Response schemas of swagger-api.yml, whose "id" is the key
+# attribute. Key attributes are always returned because they identify the
+# item and the handlers use them for the ownership checks.
+ENTITY_FIELDS = {
+    "users": (("userId",), ("idNumber", "firstName", "lastName", "email", "phone")),
+    "assets": (("assetId",), ("symbol", "blockchain")),
+    "wallets": (("walletId", "userId"), ("address", "balance", "assetId")),
+    "operations": (("operationId", "walletId"), ("amount", "type", "createdAt")),
+}
+
+
+class FieldsError(ValueError):
+    pass
+
+
+def get_fields(event, entity):
+    # None when the client wants every attribute
+    params = event.get("queryStringParameters") or {}
+    requested = params.get("fields")
+    if requested is None:
+        return None
+
+    keys, fields = ENTITY_FIELDS[entity]
+    names = list(keys)
+    for name in requested.split(","):
+        name = name.strip()
+        if name not in keys and name not in fields:
+            raise FieldsError(f"Unknown field: {name}")
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def projection(fields):
+    # ProjectionExpression for get_item, query and scan. Every name goes
+    # through a placeholder since some, like "type", are reserved words.
+    if not fields:
+        return {}
+    names = {f"#f{i}": name for i, name in enumerate(fields)}
+    return {
+        "ProjectionExpression": ",".join(names),
+        "ExpressionAttributeNames": names,
+    }
+
+
+def project(item, fields):
+    # same selection for items served from memory
+    if not item or not fields:
+        return item
+    return {k: v for k, v in item.items() if k in fields}
@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from src.api.cache import MISSING, LRUCache
+from src.api.db import table
+
+# Responses of POST requests sent with an Idempotency-Key header are kept for
+# IDEMPOTENCY_TTL_SECONDS, retries within that time get the same response
+# without writing again. Without a table the header is ignored.
+IDEMPOTENCY_TABLE = os.getenv("IDEMPOTENCY_TABLE", None)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+
+# A request that is still in progress after this long is taken as lost, and
+# a retry may run it again
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "120"))
+
+# Finished responses kept by warm containers, they never change
+IDEMPOTENCY_CACHE_MAX_ITEMS = int(os.getenv("IDEMPOTENCY_CACHE_MAX_ITEMS", "256"))
+IDEMPOTENCY_CACHE_TTL = float(os.getenv("IDEMPOTENCY_CACHE_TTL", "300"))
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+replay_cache = LRUCache(IDEMPOTENCY_CACHE_MAX_ITEMS, IDEMPOTENCY_CACHE_TTL)
+
+
+class IdempotencyError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def _fingerprint(event):
+    # a key may only be reused with the same body
+    body = (event.get("body") or "").encode("utf-8")
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def _check_fingerprint(record, fingerprint):
+    if record["fingerprint"] != fingerprint:
+        raise IdempotencyError(
+            422, "Idempotency-Key was already used with a different body"
+        )
+
+
+def _replay(record, fingerprint):
+    _check_fingerprint(record, fingerprint)
+    headers = dict(record["headers"])
+    headers[REPLAYED_HEADER] = "true"
+    exposed = headers.get("Access-Control-Expose-Headers")
+    headers["Access-Control-Expose-Headers"] = (
+        f"{exposed}, {REPLAYED_HEADER}" if exposed else REPLAYED_HEADER
+    )
+    return {
+        "statusCode": int(record["statusCode"]),
+        "headers": headers,
+        "body": gzip.decompress(bytes(record["body"])).decode("utf-8"),
+    }
+
+
+def _claim(record_id, fingerprint):
+    # Only one request holds a key at a time, the conditional put fails for
+    # every other one while the record is in progress or finished
+    now = int(time.time())
+    table(IDEMPOTENCY_TABLE).put_item(
+        Item={
+            "idempotencyKey": record_id,
+            "status": "in_progress",
+            "fingerprint": fingerprint,
+            "lockedUntil": now + IDEMPOTENCY_LOCK_SECONDS,
+            "expiresAt": now + IDEMPOTENCY_TTL_SECONDS,
+        },
+        # expired records may not have been removed by the TTL yet
+        ConditionExpression="attribute_not_exists(idempotencyKey)"
+        " OR expiresAt < :now"
+        " OR (#status = :in_progress AND lockedUntil < :now)",
+        ExpressionAttributeNames={"#status": "status"},
+        ExpressionAttributeValues={":now": now, ":in_progress": "in_progress"},
+    )
+
+
+def _complete(record_id, fingerprint, result):
+    stored = {
+        ":completed": "completed",
+        ":statusCode": result["statusCode"],
+        ":headers": result["headers"],
+        # compressed to keep large batch responses within the item size limit
+        ":body": gzip.compress(result["body"].encode("utf-8")),
+    }
+    table(IDEMPOTENCY_TABLE).update_item(
+        Key={"idempotencyKey": record_id},
+        UpdateExpression="SET #status = :completed, #statusCode = :statusCode,"
+        " #headers = :headers, #body = :body REMOVE lockedUntil",
+        # placeholders for every name, some are reserved words
+        ExpressionAttributeNames={
+            f"#{name}": name for name in ("status", "statusCode", "headers", "body")
+        },
+        ExpressionAttributeValues=stored,
+    )
+    replay_cache.put(
+        record_id,
+        {
+            "fingerprint": fingerprint,
+            "statusCode": result["statusCode"],
+            "headers": result["headers"],
+            "body": stored[":body"],
+        },
+    )
+
+
+def _release(record_id):
+    # failed requests do not keep the key, the client may retry them
+    table(IDEMPOTENCY_TABLE).delete_item(Key={"idempotencyKey": record_id})
+
+
+def idempotent_response(request, run):
+    # Run the request once per Idempotency-Key and path, replaying the
+    # stored response of successful runs. run() returns the response.
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if not key or not IDEMPOTENCY_TABLE:
+        return run()
+    if len(key) > MAX_KEY_LENGTH:
+        raise IdempotencyError(400, "Invalid Idempotency-Key")
+
+    path = request.event.get("path") or request.event["resource"]
+    record_id = f"{request.method} {path} {key}"
+    fingerprint = _fingerprint(request.event)
+
+    record = replay_cache.get(record_id)
+    if record is not MISSING:
+        return _replay(record, fingerprint)
+
+    try:
+        _claim(record_id, fingerprint)
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        ddb_response = table(IDEMPOTENCY_TABLE).get_item(
+            Key={"idempotencyKey": record_id}, ConsistentRead=True
+        )
+        record = ddb_response.get("Item")
+        if record:
+            _check_fingerprint(record, fingerprint)
+        if record and record["status"] == "completed":
+            replay_cache.put(record_id, record)
+            return _replay(record, fingerprint)
+        raise IdempotencyError(
+            409, "A request with this Idempotency-Key is still in progress"
+        )
+
+    result = run()
+    if 200 <= result["statusCode"] < 300:
+        _complete(record_id, fingerprint, result)
+    else:
+        _release(record_id)
+    return result
@@ -0,0 +1,89 @@
+import json
+import os
+import time
+import uuid
+
+import boto3
+
+from src.api.db import table
+from src.api.timestamps import now_iso
+
+# Status of work that runs after the request returned, kept for a week
+JOBS_TABLE = os.getenv("JOBS_TABLE", None)
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Key of the events a function sends itself to run a job
+JOB_EVENT_KEY = "jobId"
+
+_lambda_client = None
+
+
+def get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        _lambda_client = boto3.client("lambda")
+    return _lambda_client
+
+
+def invoke_async(function_name, payload):
+    # an Event invocation returns as soon as Lambda queued it
+    get_lambda_client().invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps(payload).encode("utf-8"),
+    )
+
+
+def start_job(kind, params, userId, context):
+    # Store the job as pending and run it in a new invocation of the same
+    # function, clients poll its status with the returned item
+    job = {
+        "jobId": str(uuid.uuid4()),
+        "kind": kind,
+        "params": params,
+        "userId": userId,
+        "status": "pending",
+        "createdAt": now_iso(),
+        "expiresAt": int(time.time()) + JOB_TTL_SECONDS,
+    }
+    table(JOBS_TABLE).put_item(Item=job)
+    invoke_async(context.invoked_function_arn, {JOB_EVENT_KEY: job["jobId"]})
+    return job
+
+
+def get_job(jobId):
+    ddb_response = table(JOBS_TABLE).get_item(Key={"jobId": jobId})
+    return ddb_response.get("Item")
+
+
+def _set_status(jobId, status, **attributes):
+    attributes = dict(attributes, status=status, updatedAt=now_iso())
+    table(JOBS_TABLE).update_item(
+        Key={"jobId": jobId},
+        UpdateExpression="SET "
+        + ", ".join(f"#{name} = :{name}" for name in attributes),
+        ExpressionAttributeNames={f"#{name}": name for name in attributes},
+        ExpressionAttributeValues={
+            f":{name}": value for name, value in attributes.items()
+        },
+    )
+
+
+def is_job_event(event):
+    return JOB_EVENT_KEY in event and "httpMethod" not in event
+
+
+def run_job(event, runners):
+    # Run the job with the runner of its kind. Failures are recorded and
+    # raised again, so Lambda retries the invocation, runners are idempotent.
+    job = get_job(event[JOB_EVENT_KEY])
+    if not job or job["status"] == "succeeded":
+        return job
+    _set_status(job["jobId"], "running")
+    try:
+        result = runners[job["kind"]](**job["params"])
+    except Exception as err:
+        _set_status(job["jobId"], "failed", error=str(err))
+        raise
+    _set_status(job["jobId"], "succeeded", result=result)
+    return dict(job, status="succeeded", result=result)
@@ -0,0 +1,67 @@
+import os
+
+from src.api.batch import batch_get_items
+from src.api.cache import MISSING, LRUCache
+from src.api.db import get_resource, table
+
+# Existence and ownership lookups of users and wallets cached per container.
+# EXISTENCE_CACHE_TTL is the maximum staleness in seconds, it also applies to
+# negative lookups.
+EXISTENCE_CACHE_MAX_ITEMS = int(os.getenv("EXISTENCE_CACHE_MAX_ITEMS", "1024"))
+EXISTENCE_CACHE_TTL = float(os.getenv("EXISTENCE_CACHE_TTL", "5"))
+
+# Methods whose routes always read from the database
+EXISTENCE_CACHE_BYPASS_METHODS = os.getenv(
+    "EXISTENCE_CACHE_BYPASS_METHODS", "PUT,DELETE"
+).split(",")
+
+existence_cache = LRUCache(EXISTENCE_CACHE_MAX_ITEMS, EXISTENCE_CACHE_TTL)
+
+
+def max_age_for(event):
+    # security sensitive routes bypass the cache
+    if event["httpMethod"] in EXISTENCE_CACHE_BYPASS_METHODS:
+        return 0
+    return None
+
+
+def get_user(users_table, userId, max_age=None):
+    user = existence_cache.get(("user", userId), max_age)
+    if user is MISSING:
+        ddb_response = table(users_table).get_item(Key={"userId": userId})
+        user = ddb_response.get("Item")
+        existence_cache.put(("user", userId), user)
+    return user
+
+
+def get_user_and_wallet(users_table, wallets_table, userId, walletId, max_age=None):
+    user = existence_cache.get(("user", userId), max_age)
+    wallet = existence_cache.get(("wallet", walletId), max_age)
+
+    # read whatever the cache did not have with a single BatchGetItem
+    request_items = {}
+    if user is MISSING:
+        request_items[users_table] = {"Keys": [{"userId": userId}]}
+    if wallet is MISSING:
+        request_items[wallets_table] = {"Keys": [{"walletId": walletId}]}
+    if not request_items:
+        return user, wallet
+
+    # retries unprocessed keys a bounded number of times, then answers 503
+    items = batch_get_items(get_resource(), request_items)
+
+    if user is MISSING:
+        user = next(iter(items.get(users_table, [])), None)
+        existence_cache.put(("user", userId), user)
+    if wallet is MISSING:
+        wallet = next(iter(items.get(wallets_table, [])), None)
+        existence_cache.put(("wallet", walletId), wallet)
+    return user, wallet
+
+
+def forget_user(userId):
+    existence_cache.invalidate(("user", userId))
+
+
+def forget_wallet(walletId):
+    existence_cache.invalidate(("wallet", walletId))
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+
+# Every call of the shared DynamoDB client is counted and timed per operation
+# and asks for the capacity it consumed, Router.dispatch logs the totals of
+# each invocation. NONE leaves ReturnConsumedCapacity out of the requests.
+DYNAMODB_CONSUMED_CAPACITY = os.getenv("DYNAMODB_CONSUMED_CAPACITY", "TOTAL")
+
+
+class CallMetrics:
+    # Calls made since the last reset. Scans and cascades call DynamoDB from
+    # worker threads, so records are taken under a lock.
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = self.clock()
+            self.operations = {}
+            self.tables = {}
+
+    def record(self, operation_name, elapsed, consumed, failed):
+        with self.lock:
+            stats = self.operations.setdefault(
+                operation_name,
+                {"count": 0, "errors": 0, "ms": 0.0, "capacityUnits": 0.0},
+            )
+            stats["count"] += 1
+            stats["errors"] += int(failed)
+            stats["ms"] += elapsed * 1000
+            for capacity in consumed:
+                units = capacity.get("CapacityUnits", 0)
+                stats["capacityUnits"] += units
+                name = capacity.get("TableName")
+                self.tables[name] = self.tables.get(name, 0) + units
+
+    def summary(self):
+        with self.lock:
+            operations = {
+                name: {
+                    **stats,
+                    "ms": round(stats["ms"], 3),
+                    "capacityUnits": round(stats["capacityUnits"], 2),
+                }
+                for name, stats in self.operations.items()
+            }
+            return {
+                "durationMs": round((self.clock() - self.started) * 1000, 3),
+                "calls": sum(stats["count"] for stats in operations.values()),
+                "callsMs": round(sum(s["ms"] for s in operations.values()), 3),
+                "capacityUnits": round(sum(self.tables.values()), 2),
+                "operations": operations,
+                "tables": {name: round(u, 2) for name, u in self.tables.items()},
+            }
+
+
+call_metrics = CallMetrics()
+
+
+def _consumed(parsed):
+    # a single entry for item and query calls, one per table for batches
+    # and transactions
+    consumed = parsed.get("ConsumedCapacity") or []
+    return [consumed] if isinstance(consumed, dict) else consumed
+
+
+def _ask_consumed_capacity(params, model, **kwargs):
+    if (
+        DYNAMODB_CONSUMED_CAPACITY != "NONE"
+        and "ReturnConsumedCapacity" in model.input_shape.members
+    ):
+        params.setdefault("ReturnConsumedCapacity", DYNAMODB_CONSUMED_CAPACITY)
+
+
+def _before_call(context, **kwargs):
+    # the request context travels with the call, also across threads
+    context["metricsStarted"] = call_metrics.clock()
+
+
+def _after_call(parsed, model, context, **kwargs):
+    started = context.get("metricsStarted")
+    if started is None:
+        return
+    call_metrics.record(
+        model.name,
+        call_metrics.clock() - started,
+        _consumed(parsed),
+        "Error" in parsed,
+    )
+
+
+def instrument(client):
+    events = client.meta.events
+    events.register("before-parameter-build.dynamodb", _ask_consumed_capacity)
+    events.register("before-call.dynamodb", _before_call)
+    events.register("after-call.dynamodb", _after_call)
+
+
+def log_summary(route_key, status_code):
+    print(
+        json.dumps(
+            {
+                "message": "DynamoDB calls",
+                "route": route_key,
+                "statusCode": status_code,
+                **call_metrics.summary(),
+            }
+        )
+    )
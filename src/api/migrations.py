@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+from decimal import Decimal, InvalidOperation
+
+from botocore.exceptions import ClientError
+
+from src.api.db import get_client, table
+from src.api.rollups import rollup_actions, rollup_deltas
+from src.api.scan import parallel_scan
+from src.api.timestamps import now_iso
+
+# One-off conversions of items written by earlier versions, run against a
+# deployed stack with its table names in the environment:
+#   python -m src.api.migrations numbers
+#   python -m src.api.migrations created-at
+# They only change items still in the old shape, so they can run again.
+WALLETS_TABLE = os.getenv("WALLETS_TABLE", None)
+OPERATIONS_TABLE = os.getenv("OPERATIONS_TABLE", None)
+OPERATION_STATS_TABLE = os.getenv("OPERATION_STATS_TABLE", None)
+
+
+def _to_number(value):
+    try:
+        number = Decimal(value)
+    except InvalidOperation:
+        return None
+    return number if number.is_finite() else None
+
+
+def convert_numbers(table_name, key_name, attribute):
+    # Store attribute as a number on every item that holds it as a string,
+    # ADD and the balance conditions only work on numbers. Items changed
+    # since they were read are left to the next run, strings that are not
+    # numbers are returned to be fixed by hand.
+    converted = 0
+    invalid = []
+    items = parallel_scan(
+        table(table_name),
+        FilterExpression="attribute_type(#a, :string)",
+        ProjectionExpression="#k, #a",
+        ExpressionAttributeNames={"#k": key_name, "#a": attribute},
+        ExpressionAttributeValues={":string": "S"},
+    )
+    for item in items:
+        number = _to_number(item[attribute])
+        if number is None:
+            invalid.append(item[key_name])
+            continue
+        try:
+            table(table_name).update_item(
+                Key={key_name: item[key_name]},
+                UpdateExpression="SET #a = :number",
+                ConditionExpression="#a = :string",
+                ExpressionAttributeNames={"#a": attribute},
+                ExpressionAttributeValues={
+                    ":number": number,
+                    ":string": item[attribute],
+                },
+            )
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            continue
+        converted += 1
+    return {"converted": converted, "invalid": invalid}
+
+
+def migrate_numbers():
+    return {
+        "wallets.balance": convert_numbers(WALLETS_TABLE, "walletId", "balance"),
+        "operations.amount": convert_numbers(OPERATIONS_TABLE, "operationId", "amount"),
+    }
+
+
+def backfill_created_at(operations_table, stats_table=None, createdAt=None):
+    # Give operations stored before createdAt existed the time of the
+    # backfill, their creation time was never recorded, so they enter the
+    # sorted wallet index. Each one is counted in the rollups of that day in
+    # the same transaction, deleting or changing it later takes it out of
+    # them again. Operations that got a createdAt meanwhile are skipped.
+    createdAt = createdAt or now_iso()
+    backfilled = 0
+    operations = parallel_scan(
+        table(operations_table), FilterExpression="attribute_not_exists(createdAt)"
+    )
+    for operation in operations:
+        operation = dict(operation, createdAt=createdAt)
+        actions = [
+            {
+                "Update": {
+                    "TableName": operations_table,
+                    "Key": {"operationId": operation["operationId"]},
+                    "UpdateExpression": "SET createdAt = :createdAt",
+                    "ConditionExpression": "attribute_not_exists(createdAt)",
+                    "ExpressionAttributeValues": {":createdAt": createdAt},
+                }
+            }
+        ]
+        if stats_table:
+            actions += rollup_actions(
+                stats_table, operation["walletId"], rollup_deltas(added=[operation])
+            )
+        try:
+            get_client().transact_write_items(TransactItems=actions)
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "TransactionCanceledException":
+                raise
+            reasons = err.response.get("CancellationReasons", [])
+            if [reason.get("Code") for reason in reasons[:1]] != [
+                "ConditionalCheckFailed"
+            ]:
+                raise
+            continue
+        backfilled += 1
+    return {"backfilled": backfilled, "createdAt": createdAt}
+
+
+def migrate_created_at():
+    return backfill_created_at(OPERATIONS_TABLE, OPERATION_STATS_TABLE)
+
+
+MIGRATIONS = {
+    "numbers": migrate_numbers,
+    "created-at": migrate_created_at,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="One-off data migrations")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    args = parser.parse_args(argv)
+    result = MIGRATIONS[args.migration]()
+    print(json.dumps({"message": "Migration finished", args.migration: result}))
+
+
+if __name__ == "__main__":
+    main()
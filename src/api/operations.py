@@ -1,173 +1,296 @@
 import json
 import uuid
 import os
-import boto3
-from datetime import datetime
+from boto3.dynamodb.conditions import Key
 
-# Prepare DynamoDB client
-dynamodb = boto3.resource("dynamodb")
+from src.api.balances import (
+    delete_operation as delete_operation_and_balance,
+    parse_amount,
+    update_operation as update_operation_and_balance,
+    write_operation,
+    write_operations,
+)
+from src.api.batch import batch_create
+from src.api.db import (
+    OPERATIONS_WALLET_INDEX,
+    OPERATIONS_WALLET_INDEXES,
+    get_resource,
+    record_import_time,
+    table,
+)
+from src.api.export import export_ndjson, is_export_request
+from src.api.fields import get_fields, projection
+from src.api.lookups import get_user_and_wallet, max_age_for
+from src.api.pagination import fetch_page, iter_items, page_headers
+from src.api.rollups import get_stats
+from src.api.router import ApiError, Router, response
+from src.api.timestamps import now_iso, range_query
+from src.api.updates import parse_patch
 
+# the SDK and every module the handler needs are loaded
+record_import_time()
+
+# DynamoDB tables, the shared client is created on first use
 OPERATIONS_TABLE = os.getenv("OPERATIONS_TABLE", None)
 WALLETS_TABLE = os.getenv("WALLETS_TABLE", None)
 USERS_TABLE = os.getenv("USERS_TABLE", None)
 ASSETS_TABLE = os.getenv("ASSETS_TABLE", None)
+OPERATION_STATS_TABLE = os.getenv("OPERATION_STATS_TABLE", None)
+
+OPERATIONS_RESOURCE = "/users/{userId}/wallets/{walletId}/operations"
+OPERATION_RESOURCE = OPERATIONS_RESOURCE + "/{operationId}"
+
+router = Router()
 
 
 def lambda_handler(event, context):
-    route_key = f"{event['httpMethod']} {event['resource']}"
+    return router.dispatch(event, context)
 
-    # Set default response, override with data from DynamoDB if any
-    response_body = {"Message": "Unsupported route"}
-    status_code = 400
 
-    # First check if userId and walletId exist
-    ddb_response_user = dynamodb.Table(USERS_TABLE).get_item(
-        TableName=USERS_TABLE, Key={"userId": event["pathParameters"]["userId"]}
+def user_and_wallet_exist(request):
+    # First check if userId and walletId exist, both in one round trip
+    request.user, request.wallet = get_user_and_wallet(
+        USERS_TABLE,
+        WALLETS_TABLE,
+        request.path["userId"],
+        request.path["walletId"],
+        max_age_for(request.event),
     )
-    if "Item" not in ddb_response_user:
-        return response(400, {"Error": "User not found"})
+    if not request.user:
+        raise ApiError(400, "User not found")
+    if not request.wallet:
+        raise ApiError(400, "Wallet not found")
+
+
+def wallet_belongs_to_user(request):
+    # check if the wallet belongs to the user
+    if not request.wallet["userId"] == request.user["userId"]:
+        raise ApiError(400, "Wallet does not belong to the user")
+
 
-    ddb_response_wallet = dynamodb.Table(WALLETS_TABLE).get_item(
-        TableName=WALLETS_TABLE, Key={"walletId": event["pathParameters"]["walletId"]}
+# Get a list of all Operations
+@router.route("GET", OPERATIONS_RESOURCE, prechecks=[user_and_wallet_exist])
+def list_operations(request):
+    # query the index partition instead of filtering the whole index, in
+    # creation order and narrowed to ?from= and ?to= on the sort key
+    query_kwargs = {
+        "IndexName": OPERATIONS_WALLET_INDEX,
+        **range_query(
+            request.event,
+            Key("walletId").eq(request.path["walletId"]),
+            OPERATIONS_WALLET_INDEXES[OPERATIONS_WALLET_INDEX],
+        ),
+        **projection(get_fields(request.event, "operations")),
+    }
+
+    # stream every page of the partition into the blob store
+    if is_export_request(request.event):
+        export = export_ndjson(
+            "operations", iter_items(table(OPERATIONS_TABLE).query, **query_kwargs)
+        )
+        return response(200, {"export": export})
+
+    items, next_cursor = fetch_page(
+        table(OPERATIONS_TABLE).query, request.event, **query_kwargs
     )
-    if "Item" not in ddb_response_wallet:
-        return response(400, {"Error": "Wallet not found"})
+    # return list of items instead of full DynamoDB response
+    return response(200, items, page_headers(next_cursor))
 
-    try:
-        # Get a list of all Operations
-        if route_key == "GET /users/{userId}/wallets/{walletId}/operations":
-            try:
-                ddb_response = dynamodb.Table(OPERATIONS_TABLE).scan(
-                    TableName=OPERATIONS_TABLE,
-                    FilterExpression="walletId = :id",
-                    ExpressionAttributeValues={
-                        ":id": event["pathParameters"]["walletId"]
-                    },
-                    IndexName="Operations-WalletIndex",
-                )
-                # return list of items instead of full DynamoDB response
-                response_body = ddb_response["Items"]
-                status_code = 200
-            except Exception as err:
-                status_code = 400
-                response_body = {"Error:": str(err)}
-                print(str(err))
-
-        # CRUD operations for a single Operation
-
-        # Read a operation by ID
-        if (
-            route_key
-            == "GET /users/{userId}/wallets/{walletId}/operations/{operationId}"
-        ):
-            # get data from the database
-            ddb_response = dynamodb.Table(OPERATIONS_TABLE).get_item(
-                TableName=OPERATIONS_TABLE,
-                Key={"operationId": event["pathParameters"]["operationId"]},
-            )
-
-            # return single item instead of full DynamoDB response
-            if (
-                "Item" in ddb_response
-                and ddb_response["Item"]["walletId"]
-                == event["pathParameters"]["walletId"]
-            ):
-                response_body = ddb_response["Item"]
-            else:
-                response_body = {}
-            status_code = 200
-
-        # Delete a operation by ID
-        if (
-            route_key
-            == "DELETE /users/{userId}/wallets/{walletId}/operations/{operationId}"
-        ):
-            # check if wallet is valid
-            wallet = get_wallet_by_id(event["pathParameters"]["walletId"])
-            if not wallet:
-                return response(400, {"Error": "Wallet not found"})
-
-            # check if userId is valid
-            if wallet["userId"] != event["pathParameters"]["userId"]:
-                return response(400, {"Error": "Invalid user"})
-
-            # delete item in the database
-            dynamodb.Table(OPERATIONS_TABLE).delete_item(
-                TableName=OPERATIONS_TABLE,
-                Key={"operationId": event["pathParameters"]["operationId"]},
-            )
-            response_body = {}
-            status_code = 200
-
-        # Create a new operation
-        if route_key == "POST /users/{userId}/wallets/{walletId}/operations":
-            request_json = json.loads(event["body"])
-
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error": "Invalid body fields"})
-
-            # check if the wallet belongs to the user
-            if (
-                not ddb_response_wallet["Item"]["userId"]
-                == ddb_response_user["Item"]["userId"]
-            ):
-                return response(400, {"Error": "Wallet does not belong to the user"})
-
-            request_json["walletId"] = event["pathParameters"]["walletId"]
-
-            # generate unique id
-            request_json["operationId"] = str(uuid.uuid1())
-
-            # update the database
-            dynamodb.Table(OPERATIONS_TABLE).put_item(
-                TableName=OPERATIONS_TABLE, Item=request_json
-            )
-            response_body = request_json
-            status_code = 201
-
-        # Update a specific operation by ID
-        if (
-            route_key
-            == "PUT /users/{userId}/wallets/{walletId}/operations/{operationId}"
-        ):
-            # update item in the database
-            request_json = json.loads(event["body"])
-
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error": "Invalid body fields"})
-
-            request_json["walletId"] = event["pathParameters"]["walletId"]
-            # update the database
-            dynamodb.Table(OPERATIONS_TABLE).put_item(
-                TableName=OPERATIONS_TABLE, Item=request_json
-            )
-            response_body = request_json
-            status_code = 200
-    except Exception as err:
-        status_code = 400
-        response_body = {"Error:": str(err)}
-        print(str(err))
-    return response(status_code, response_body)
+
+# CRUD operations for a single Operation
 
 
-def get_wallet_by_id(walletId):
+# Read a operation by ID
+@router.route("GET", OPERATION_RESOURCE, prechecks=[user_and_wallet_exist])
+def get_operation(request):
     # get data from the database
-    ddb_response = dynamodb.Table(WALLETS_TABLE).get_item(
-        TableName=WALLETS_TABLE, Key={"walletId": walletId}
+    ddb_response = table(OPERATIONS_TABLE).get_item(
+        Key={"operationId": request.path["operationId"]},
+        **projection(get_fields(request.event, "operations")),
     )
+
     # return single item instead of full DynamoDB response
-    if "Item" in ddb_response:
-        return ddb_response["Item"]
-    else:
-        return
+    if (
+        "Item" in ddb_response
+        and ddb_response["Item"]["walletId"] == request.path["walletId"]
+    ):
+        return response(200, ddb_response["Item"])
+    return response(200, {})
+
+
+# Delete a operation by ID. Ownership is a condition of the transaction,
+# the user and the wallet are only read when there is no operation to delete.
+@router.route("DELETE", OPERATION_RESOURCE)
+def delete_operation(request):
+    previous = get_stored_operation(request, "Invalid user")
+    if previous:
+        # delete item in the database and take its amount back from the wallet
+        delete_operation_and_balance(
+            OPERATIONS_TABLE,
+            WALLETS_TABLE,
+            request.path["userId"],
+            previous,
+            OPERATION_STATS_TABLE,
+            owner_message="Invalid user",
+        )
+    return response(200, {})
+
+
+# Create many operations at once
+@router.route(
+    "POST",
+    OPERATIONS_RESOURCE + ":batch",
+    prechecks=[user_and_wallet_exist, wallet_belongs_to_user],
+)
+def create_operations(request):
+    def prepare(request_json):
+        request_json["amount"] = parse_amount(request_json["amount"])
+        request_json["walletId"] = request.path["walletId"]
+        request_json["createdAt"] = now_iso()
+        # generate unique id
+        request_json["operationId"] = str(uuid.uuid1())
+
+    def write_items(items):
+        # operations, the wallet balance and the rollups change together
+        return write_operations(
+            OPERATIONS_TABLE,
+            WALLETS_TABLE,
+            request.path["walletId"],
+            request.path["userId"],
+            items,
+            OPERATION_STATS_TABLE,
+        )
+
+    status_code, response_body = batch_create(
+        get_resource(),
+        OPERATIONS_TABLE,
+        request.json(),
+        "operationId",
+        is_valid_body,
+        prepare,
+        write_items,
+    )
+    return response(status_code, response_body)
 
 
-def response(status_code, body):
-    headers = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
+# Create a new operation
+@router.route("POST", OPERATIONS_RESOURCE, prechecks=[user_and_wallet_exist])
+def create_operation(request):
+    request_json = request.json()
+
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    wallet_belongs_to_user(request)
+
+    request_json["amount"] = parse_amount(request_json["amount"])
+    request_json["walletId"] = request.path["walletId"]
+    request_json["createdAt"] = now_iso()
+
+    # generate unique id
+    request_json["operationId"] = str(uuid.uuid1())
+
+    # update the database, the wallet balance and the rollups in one transaction
+    write_operation(
+        OPERATIONS_TABLE,
+        WALLETS_TABLE,
+        request.path["userId"],
+        request_json,
+        stats_table=OPERATION_STATS_TABLE,
+    )
+    return response(201, request_json)
+
+
+# Update a specific operation by ID, the transaction checks the wallet
+# belongs to the user
+@router.route("PUT", OPERATION_RESOURCE)
+def update_operation(request):
+    request_json = request.json()
+
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    previous = get_stored_operation(request)
+
+    request_json["amount"] = parse_amount(request_json["amount"])
+    request_json["walletId"] = request.path["walletId"]
+    request_json["operationId"] = request.path["operationId"]
+    # keep the creation time of the operation being replaced
+    request_json["createdAt"] = (previous or {}).get("createdAt") or now_iso()
+    # update the database and apply the difference to the wallet balance
+    write_operation(
+        OPERATIONS_TABLE,
+        WALLETS_TABLE,
+        request.path["userId"],
+        request_json,
+        previous,
+        OPERATION_STATS_TABLE,
+    )
+    return response(200, request_json)
+
+
+# Change the amount or type of an operation, only what changed is written
+@router.route("PATCH", OPERATION_RESOURCE)
+def patch_operation(request):
+    changes = parse_patch(request.json(), "operations", immutable=("createdAt",))
+    if "amount" in changes:
+        changes["amount"] = parse_amount(changes["amount"])
+        if not changes["amount"]:
+            raise ApiError(400, "Invalid body fields")
+    if "type" in changes and changes["type"] not in ("buy", "sell"):
+        raise ApiError(400, "Invalid body fields")
+
+    previous = get_stored_operation(request)
+    if not previous:
+        raise ApiError(400, "Operation not found")
+    update_operation_and_balance(
+        OPERATIONS_TABLE,
+        WALLETS_TABLE,
+        request.path["userId"],
+        previous,
+        changes,
+        OPERATION_STATS_TABLE,
+    )
+    return response(
+        200,
+        {
+            "operationId": previous["operationId"],
+            "walletId": previous["walletId"],
+            **changes,
+        },
+    )
+
+
+# Daily buy and sell totals of a wallet, kept up to date by every write
+@router.route(
+    "GET",
+    "/users/{userId}/wallets/{walletId}/stats",
+    prechecks=[user_and_wallet_exist, wallet_belongs_to_user],
+)
+def get_wallet_stats(request):
+    stats = get_stats(OPERATION_STATS_TABLE, request.path["walletId"], request.event)
+    return response(200, stats)
+
+
+def get_stored_operation(request, owner_message="Wallet does not belong to the user"):
+    # the stored version the balance change is computed from, None when the
+    # operation does not exist in a wallet of the user
+    ddb_response = table(OPERATIONS_TABLE).get_item(
+        Key={"operationId": request.path["operationId"]}, ConsistentRead=True
+    )
+    operation = ddb_response.get("Item")
+    if operation and operation["walletId"] == request.path["walletId"]:
+        return operation
 
-    return {"statusCode": status_code, "body": json.dumps(body), "headers": headers}
+    # only these paths read the user and the wallet, to tell what is wrong
+    user_and_wallet_exist(request)
+    if request.wallet["userId"] != request.path["userId"]:
+        raise ApiError(400, owner_message)
+    if operation:
+        raise ApiError(400, "Operation not found")
+    return None
 
 
 def is_valid_body(request_json):
@@ -175,6 +298,7 @@ def is_valid_body(request_json):
         return (
             request_json
             and "amount" in request_json
+            and parse_amount(request_json["amount"])
             and "type" in request_json
             and (request_json["type"] == "buy" or request_json["type"] == "sell")
         )
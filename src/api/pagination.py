@@ -0,0 +1,88 @@
+import base64
+import binascii
+import json
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+# Upper bound for the ?limit= query parameter
+MAX_LIMIT = 1000
+
+# Response header carrying the cursor of the next page, if any
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+_serializer = TypeSerializer()
+_deserializer = TypeDeserializer()
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(last_evaluated_key):
+    # the cursor is the DynamoDB LastEvaluatedKey, typed and base64url encoded
+    # so that clients treat it as an opaque token
+    if not last_evaluated_key:
+        return None
+    typed_key = {k: _serializer.serialize(v) for k, v in last_evaluated_key.items()}
+    raw = json.dumps(typed_key, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        typed_key = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        if not isinstance(typed_key, dict) or not typed_key:
+            raise PaginationError("Invalid cursor")
+        return {k: _deserializer.deserialize(v) for k, v in typed_key.items()}
+    except (binascii.Error, UnicodeError, ValueError, TypeError, AttributeError):
+        raise PaginationError("Invalid cursor")
+
+
+def get_page_params(event):
+    params = event.get("queryStringParameters") or {}
+
+    limit = params.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise PaginationError("Invalid limit")
+        if limit < 1 or limit > MAX_LIMIT:
+            raise PaginationError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    cursor = params.get("cursor")
+    start_key = decode_cursor(cursor) if cursor else None
+
+    return limit, start_key
+
+
+def fetch_page(operation, event, **kwargs):
+    # run a single scan/query page honouring ?limit= and ?cursor=
+    limit, start_key = get_page_params(event)
+    if limit:
+        kwargs["Limit"] = limit
+    if start_key:
+        kwargs["ExclusiveStartKey"] = start_key
+
+    ddb_response = operation(**kwargs)
+    return ddb_response["Items"], encode_cursor(ddb_response.get("LastEvaluatedKey"))
+
+
+def page_headers(next_cursor):
+    if not next_cursor:
+        return {}
+    return {
+        NEXT_CURSOR_HEADER: next_cursor,
+        "Access-Control-Expose-Headers": NEXT_CURSOR_HEADER,
+    }
+
+
+def iter_items(operation, **kwargs):
+    # follow LastEvaluatedKey and yield items page by page
+    while True:
+        ddb_response = operation(**kwargs)
+        yield from ddb_response["Items"]
+        if "LastEvaluatedKey" not in ddb_response:
+            return
+        kwargs["ExclusiveStartKey"] = ddb_response["LastEvaluatedKey"]
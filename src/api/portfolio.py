@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+from src.api.balances import parse_amount
+
+
+def build_portfolio(userId, wallets, catalogue):
+    # Group the wallets of a user by asset in one pass, then join the groups
+    # to the asset catalogue with a single lookup and total them per
+    # blockchain. The totals of a blockchain are per symbol, assets sharing
+    # one there, like two USDT tokens, are added together.
+    by_asset = {}
+    for wallet in wallets:
+        totals = by_asset.setdefault(wallet["assetId"], [0, Decimal(0)])
+        totals[0] += 1
+        totals[1] += parse_amount(wallet.get("balance")) or 0
+
+    assets = catalogue.get_many(list(by_asset))
+    asset_totals = []
+    by_blockchain = {}
+    for assetId, (count, balance) in by_asset.items():
+        asset = assets.get(assetId, {})
+        asset_totals.append(
+            {
+                "assetId": assetId,
+                "symbol": asset.get("symbol"),
+                "blockchain": asset.get("blockchain"),
+                "wallets": count,
+                "balance": balance,
+            }
+        )
+        blockchain = by_blockchain.setdefault(
+            asset.get("blockchain"),
+            {"blockchain": asset.get("blockchain"), "wallets": 0, "assets": {}},
+        )
+        blockchain["wallets"] += count
+        symbol = asset.get("symbol") or assetId
+        blockchain["assets"][symbol] = blockchain["assets"].get(symbol, 0) + balance
+
+    return {
+        "userId": userId,
+        "wallets": sum(count for count, _ in by_asset.values()),
+        "assets": asset_totals,
+        "blockchains": list(by_blockchain.values()),
+    }
@@ -0,0 +1,95 @@
+from decimal import Decimal
+
+from boto3.dynamodb.conditions import Key
+
+from src.api.db import table
+from src.api.pagination import iter_items
+from src.api.timestamps import parse_timestamp
+
+# Rollup items are keyed by walletId and a period such as "day#2001-01-01",
+# so other granularities can live next to the daily ones
+GRANULARITIES = ("day",)
+
+STATS_FIELDS = ("buyAmount", "buyCount", "sellAmount", "sellCount")
+
+
+class StatsError(ValueError):
+    pass
+
+
+def day_of(operation):
+    # operations written before createdAt existed have no day to count in
+    createdAt = (operation or {}).get("createdAt")
+    return createdAt[:10] if createdAt else None
+
+
+def rollup_deltas(added=(), removed=()):
+    # per day changes of the totals and counts for operations being added
+    # and operations being removed
+    deltas = {}
+    for operations, sign in ((added, 1), (removed, -1)):
+        for operation in operations:
+            day = day_of(operation)
+            if day is None:
+                continue
+            totals = deltas.setdefault(day, dict.fromkeys(STATS_FIELDS, Decimal(0)))
+            kind = operation["type"]
+            totals[f"{kind}Amount"] += sign * Decimal(str(operation["amount"]))
+            totals[f"{kind}Count"] += sign
+    return deltas
+
+
+def rollup_actions(stats_table, walletId, deltas):
+    # one ADD update per day item, they have no conditions of their own since
+    # the operation actions of the same transaction make them idempotent
+    actions = []
+    for day, totals in sorted(deltas.items()):
+        changed = {field: value for field, value in totals.items() if value != 0}
+        if not changed:
+            continue
+        actions.append(
+            {
+                "Update": {
+                    "TableName": stats_table,
+                    "Key": {"walletId": walletId, "period": f"day#{day}"},
+                    "UpdateExpression": "ADD "
+                    + ", ".join(f"{field} :{field}" for field in changed),
+                    "ExpressionAttributeValues": {
+                        f":{field}": value for field, value in changed.items()
+                    },
+                }
+            }
+        )
+    return actions
+
+
+def get_stats(stats_table, walletId, event):
+    # rollups of a wallet, one item per day of the ?from= ?to= range
+    params = event.get("queryStringParameters") or {}
+    granularity = params.get("granularity", "day")
+    if granularity not in GRANULARITIES:
+        raise StatsError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+
+    condition = Key("walletId").eq(walletId)
+    start = params.get("from")
+    end = params.get("to")
+    start = f"{granularity}#{parse_timestamp(start, 'from')[:10]}" if start else None
+    end = f"{granularity}#{parse_timestamp(end, 'to')[:10]}" if end else None
+    if start and end:
+        if start > end:
+            raise StatsError("from must not be after to")
+        condition = condition & Key("period").between(start, end)
+    elif start:
+        condition = condition & Key("period").between(start, f"{granularity}#~")
+    elif end:
+        condition = condition & Key("period").between(f"{granularity}#", end)
+    else:
+        condition = condition & Key("period").begins_with(f"{granularity}#")
+
+    stats = []
+    for item in iter_items(table(stats_table).query, KeyConditionExpression=condition):
+        totals = {field: item.get(field, 0) for field in STATS_FIELDS}
+        # skip days whose operations were all deleted
+        if totals["buyCount"] or totals["sellCount"]:
+            stats.append({"date": item["period"].split("#", 1)[1], **totals})
+    return stats
@@ -0,0 +1,107 @@
+import base64
+import json
+from decimal import Decimal
+
+from src.api.compression import compress_response
+from src.api.etag import conditional_response
+from src.api.idempotency import IdempotencyError, idempotent_response
+from src.api.metrics import call_metrics, log_summary
+from src.api.serializer import dumps
+
+
+class ApiError(Exception):
+    # raised by routes and prechecks to answer with an error response
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class Request:
+    def __init__(self, event, context):
+        self.event = event
+        self.context = context
+        self.method = event["httpMethod"]
+        self.path = event.get("pathParameters") or {}
+        self.query = event.get("queryStringParameters") or {}
+        self.headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+
+    def json(self):
+        body = self.event["body"]
+        # binary media types make API Gateway base64 encode request bodies too
+        if self.event.get("isBase64Encoded"):
+            body = base64.b64decode(body)
+        # DynamoDB takes numbers as Decimal, never as float
+        return json.loads(body, parse_float=Decimal)
+
+
+class Router:
+    # Routes are registered with the route decorator when the handler module
+    # is imported, so the dispatch table is built once per container and each
+    # request costs a single dict lookup. Unsupported routes are answered
+    # before any precheck runs, they never touch DynamoDB.
+    def __init__(self):
+        self.routes = {}
+
+    def route(self, method, resource, prechecks=()):
+        def register(handler):
+            route_key = f"{method} {resource}"
+            if route_key in self.routes:
+                raise ValueError(f"Route already registered: {route_key}")
+            self.routes[route_key] = (handler, tuple(prechecks))
+            return handler
+
+        return register
+
+    def dispatch(self, event, context):
+        route_key = f"{event['httpMethod']} {event['resource']}"
+        if route_key not in self.routes:
+            return response(400, {"Message": "Unsupported route"})
+        handler, prechecks = self.routes[route_key]
+
+        # DynamoDB calls, their time and capacity are logged per invocation
+        call_metrics.reset()
+        result = self.respond(Request(event, context), handler, prechecks)
+        log_summary(route_key, result["statusCode"])
+        return result
+
+    def respond(self, request, handler, prechecks):
+        if request.method == "POST":
+            # retries sent with the same Idempotency-Key replay the response
+            # of the first request instead of writing again
+            try:
+                result = idempotent_response(
+                    request, lambda: self.handle(request, handler, prechecks)
+                )
+            except IdempotencyError as err:
+                result = response(err.status_code, {"Error": err.message})
+        else:
+            result = self.handle(request, handler, prechecks)
+        # reads carry an ETag and answer 304 when the client has the content
+        if request.method == "GET":
+            result = conditional_response(result, request.headers.get("if-none-match"))
+        # large bodies are compressed when the client accepts it
+        return compress_response(result, request.headers.get("accept-encoding"))
+
+    def handle(self, request, handler, prechecks):
+        try:
+            # prechecks load what the route needs onto the request or raise
+            for precheck in prechecks:
+                precheck(request)
+            return handler(request)
+        except ApiError as err:
+            return response(err.status_code, {"Error": err.message})
+        except ValueError as err:
+            # invalid JSON, cursors, batches and similar client errors
+            return response(400, {"Error": str(err)})
+        except Exception as err:
+            print(str(err))
+            return response(400, {"Error": str(err)})
+
+
+def response(status_code, body, extra_headers=None):
+    headers = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
+    if extra_headers:
+        headers.update(extra_headers)
+
+    return {"statusCode": status_code, "body": dumps(body), "headers": headers}
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of Segment/TotalSegments workers of a parallel scan
+SCAN_SEGMENTS = int(os.getenv("SCAN_SEGMENTS", "4"))
+
+# Pages buffered between the workers and the consumer. Together with one page
+# in flight per worker this bounds the memory held by a scan.
+SCAN_MAX_BUFFERED_PAGES = int(os.getenv("SCAN_MAX_BUFFERED_PAGES", "8"))
+
+_SEGMENT_DONE = object()
+
+
+class ScanProgress:
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.finished_segments = 0
+        self.pages = 0
+        self.items = 0
+        self.scanned = 0
+
+    def as_dict(self):
+        return {
+            "totalSegments": self.total_segments,
+            "finishedSegments": self.finished_segments,
+            "pages": self.pages,
+            "items": self.items,
+            "scanned": self.scanned,
+        }
+
+
+def parallel_scan(
+    table,
+    total_segments=None,
+    max_buffered_pages=None,
+    page_size=None,
+    on_progress=None,
+    **scan_kwargs,
+):
+    # Scan a whole table with one worker per segment and yield the merged
+    # items as the pages arrive. Items of different segments interleave, there
+    # is no ordering guarantee across the table.
+    total_segments = total_segments or SCAN_SEGMENTS
+    max_buffered_pages = max_buffered_pages or SCAN_MAX_BUFFERED_PAGES
+
+    # low level clients are thread safe, resources are not
+    client = table.meta.client
+    buffer = queue.Queue(maxsize=max_buffered_pages)
+    stop = threading.Event()
+    progress = ScanProgress(total_segments)
+
+    def put(entry):
+        # block while the buffer is full, but give up once the consumer is gone
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def scan_segment(segment):
+        kwargs = dict(
+            scan_kwargs,
+            TableName=table.name,
+            Segment=segment,
+            TotalSegments=total_segments,
+        )
+        if page_size:
+            kwargs["Limit"] = page_size
+        try:
+            while not stop.is_set():
+                page = client.scan(**kwargs)
+                put((page["Items"], page.get("ScannedCount", len(page["Items"]))))
+                if "LastEvaluatedKey" not in page:
+                    break
+                kwargs["ExclusiveStartKey"] = page["LastEvaluatedKey"]
+        except Exception as err:
+            put(err)
+        finally:
+            put(_SEGMENT_DONE)
+
+    executor = ThreadPoolExecutor(
+        max_workers=total_segments, thread_name_prefix="scan-segment"
+    )
+    try:
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+
+        while progress.finished_segments < total_segments:
+            entry = buffer.get()
+            if isinstance(entry, Exception):
+                raise entry
+
+            items = []
+            if entry is _SEGMENT_DONE:
+                progress.finished_segments += 1
+            else:
+                items, scanned = entry
+                progress.pages += 1
+                progress.items += len(items)
+                progress.scanned += scanned
+            if on_progress:
+                on_progress(progress)
+            yield from items
+    finally:
+        # also reached when the consumer stops iterating early
+        stop.set()
+        executor.shutdown(wait=True)
@@ -0,0 +1,46 @@
+import json
+import uuid
+from decimal import Decimal
+
+# DynamoDB items never reference themselves, skip the circular reference
+# bookkeeping and use compact separators
+_ENCODER_OPTIONS = {"check_circular": False, "separators": (",", ":")}
+
+
+class _DecimalEncoder(json.JSONEncoder):
+    # The C encoder writes every str, int, float, list and dict itself and
+    # only calls default for Decimals, which DynamoDB uses for all numbers.
+    # Whole numbers become ints, any other Decimal is written as a per call
+    # marker string that dumps swaps for its exact digits, so no number is
+    # rounded through a float. Listings take no separate path: converting
+    # their Decimal columns up front still runs Python per number and copies
+    # every item, bench_serializer measures it no faster than this hook.
+    def __init__(self):
+        super().__init__(**_ENCODER_OPTIONS)
+        self.marker = None
+        self.raw_numbers = []
+
+    def default(self, value):
+        if isinstance(value, Decimal):
+            if value == value.to_integral_value():
+                return int(value)
+            if self.marker is None:
+                self.marker = uuid.uuid4().hex
+            self.raw_numbers.append(str(value))
+            return self.marker
+        return super().default(value)
+
+
+def dumps(body):
+    encoder = _DecimalEncoder()
+    text = encoder.encode(body)
+    if not encoder.raw_numbers:
+        return text
+
+    # the encoder writes values in order, so markers and digits line up
+    parts = text.split(f'"{encoder.marker}"')
+    chunks = [parts[0]]
+    for digits, part in zip(encoder.raw_numbers, parts[1:]):
+        chunks.append(digits)
+        chunks.append(part)
+    return "".join(chunks)
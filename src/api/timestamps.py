@@ -0,0 +1,59 @@
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+
+# Timestamps are stored as UTC ISO 8601 strings of fixed width, so their
+# string order is their time order and they work as DynamoDB sort keys
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+ORDERS = ("asc", "desc")
+
+
+class TimeRangeError(ValueError):
+    pass
+
+
+def now_iso():
+    return datetime.now(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def parse_timestamp(value, name):
+    # accept dates and ISO 8601 timestamps, naive ones are taken as UTC
+    try:
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
+        parsed = datetime.fromisoformat(value)
+    except (AttributeError, ValueError):
+        raise TimeRangeError(f"Invalid {name}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+
+
+def range_query(event, hash_condition, range_key):
+    # Query arguments for ?from= and ?to=, both inclusive, and ?order=.
+    # Without range_key the index has no sort key to narrow or order by.
+    params = event.get("queryStringParameters") or {}
+    start = params.get("from")
+    end = params.get("to")
+    if range_key is None:
+        if start is not None or end is not None or "order" in params:
+            raise TimeRangeError("from, to and order are not available yet")
+        return {"KeyConditionExpression": hash_condition}
+    order = params.get("order", "asc")
+    if order not in ORDERS:
+        raise TimeRangeError("order must be asc or desc")
+
+    condition = hash_condition
+    if start is not None and end is not None:
+        start = parse_timestamp(start, "from")
+        end = parse_timestamp(end, "to")
+        if start > end:
+            raise TimeRangeError("from must not be after to")
+        condition = condition & Key(range_key).between(start, end)
+    elif start is not None:
+        condition = condition & Key(range_key).gte(parse_timestamp(start, "from"))
+    elif end is not None:
+        condition = condition & Key(range_key).lte(parse_timestamp(end, "to"))
+
+    return {"KeyConditionExpression": condition, "ScanIndexForward": order == "asc"}
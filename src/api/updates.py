@@ -0,0 +1,45 @@
+from src.api.fields import ENTITY_FIELDS
+
+
+class PatchError(ValueError):
+    pass
+
+
+def parse_patch(body, entity, immutable=()):
+    # The attributes a PATCH request changes. Key attributes, and the
+    # immutable ones of the entity, can not be changed.
+    if not isinstance(body, dict) or not body:
+        raise PatchError("Body must be a non empty object")
+    keys, fields = ENTITY_FIELDS[entity]
+    for name, value in body.items():
+        if name in keys or name in immutable:
+            raise PatchError(f"{name} can not be changed")
+        if name not in fields:
+            raise PatchError(f"Unknown field: {name}")
+        if value is None:
+            raise PatchError(f"{name} can not be null")
+    return body
+
+
+def set_expression(changes, condition=None):
+    # UpdateExpression writing only the changed attributes, every name goes
+    # through a placeholder since some, like "type", are reserved words.
+    # condition holds the ConditionExpression and its names and values.
+    condition = condition or {}
+    names = {f"#u{i}": name for i, name in enumerate(changes)}
+    values = {f":u{i}": value for i, value in enumerate(changes.values())}
+    update = {
+        "UpdateExpression": "SET "
+        + ", ".join(f"#u{i} = :u{i}" for i in range(len(changes))),
+        "ExpressionAttributeNames": {
+            **condition.get("ExpressionAttributeNames", {}),
+            **names,
+        },
+        "ExpressionAttributeValues": {
+            **condition.get("ExpressionAttributeValues", {}),
+            **values,
+        },
+    }
+    if "ConditionExpression" in condition:
+        update["ConditionExpression"] = condition["ConditionExpression"]
+    return update
@@ -1,93 +1,186 @@
 import json
 import uuid
 import os
-import boto3
-from datetime import datetime
 
-# Prepare DynamoDB client
-dynamodb = boto3.resource("dynamodb")
+from botocore.exceptions import ClientError
+
+from src.api.batch import batch_create
+from src.api.cascade import (
+    collect,
+    delete_cascade,
+    delete_levels,
+    job_location,
+    user_levels,
+)
+from src.api.db import get_resource, record_import_time, table
+from src.api.export import export_ndjson, is_export_request
+from src.api.fields import get_fields, projection
+from src.api.jobs import get_job, is_job_event, run_job
+from src.api.lookups import forget_user
+from src.api.pagination import fetch_page, page_headers
+from src.api.router import ApiError, Router, response
+from src.api.scan import parallel_scan
+from src.api.updates import parse_patch, set_expression
+
+# the SDK and every module the handler needs are loaded
+record_import_time()
+
+# DynamoDB tables, the shared client is created on first use. Deleting a
+# user also deletes its wallets, operations and rollups.
 USERS_TABLE = os.getenv("USERS_TABLE", None)
-ddbUserTable = dynamodb.Table(USERS_TABLE)
+WALLETS_TABLE = os.getenv("WALLETS_TABLE", None)
+OPERATIONS_TABLE = os.getenv("OPERATIONS_TABLE", None)
+OPERATION_STATS_TABLE = os.getenv("OPERATION_STATS_TABLE", None)
+
+router = Router()
 
 
 def lambda_handler(event, context):
-    route_key = f"{event['httpMethod']} {event['resource']}"
+    # deletes too large for a request come back as job events
+    if is_job_event(event):
+        return run_job(event, {"deleteUser": delete_user_now})
+    return router.dispatch(event, context)
+
+
+# Get a list of all Users
+@router.route("GET", "/users")
+def list_users(request):
+    # read only the attributes asked for with ?fields=
+    scan_kwargs = projection(get_fields(request.event, "users"))
+
+    # stream the whole table into the blob store
+    if is_export_request(request.event):
+        export = export_ndjson(
+            "users", parallel_scan(table(USERS_TABLE), **scan_kwargs)
+        )
+        return response(200, {"export": export})
+
+    # read a single page, the client follows the cursor for the rest
+    items, next_cursor = fetch_page(
+        table(USERS_TABLE).scan,
+        request.event,
+        **(scan_kwargs or {"Select": "ALL_ATTRIBUTES"}),
+    )
+    # return list of items instead of full DynamoDB response
+    return response(200, items, page_headers(next_cursor))
+
+
+# CRUD operations for a single User
+
+
+# Read a user by ID
+@router.route("GET", "/users/{userId}")
+def get_user(request):
+    # get data from the database
+    ddb_response = table(USERS_TABLE).get_item(
+        Key={"userId": request.path["userId"]},
+        **projection(get_fields(request.event, "users")),
+    )
+    # return single item instead of full DynamoDB response
+    return response(200, ddb_response.get("Item", {}))
+
+
+# Delete a user by ID with its wallets, operations and rollups
+@router.route("DELETE", "/users/{userId}")
+def delete_user(request):
+    userId = request.path["userId"]
+    job = delete_cascade(
+        request, "deleteUser", {"userId": userId}, lambda: user_cascade(userId)
+    )
+    forget_user(userId)
+    if job:
+        return response(202, job, job_location(job))
+    return response(200, {})
+
+
+# Status of a job started by a request of the user
+@router.route("GET", "/users/{userId}/jobs/{jobId}")
+def get_user_job(request):
+    job = get_job(request.path["jobId"])
+    if job and job["userId"] == request.path["userId"]:
+        return response(200, job)
+    return response(200, {})
+
+
+# Create many users at once
+@router.route("POST", "/users:batch")
+def create_users(request):
+    status_code, response_body = batch_create(
+        get_resource(),
+        USERS_TABLE,
+        request.json(),
+        "userId",
+        is_valid_body,
+        assign_user_id,
+    )
+    return response(status_code, response_body)
+
+
+# Create a new user
+@router.route("POST", "/users")
+def create_user(request):
+    request_json = request.json()
+
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    assign_user_id(request_json)
+
+    # update the database
+    table(USERS_TABLE).put_item(Item=request_json)
+    return response(200, request_json)
+
 
-    # Set default response, override with data from DynamoDB if any
-    response_body = {"Message": "Unsupported route"}
-    status_code = 400
+# Update a specific user by ID
+@router.route("PUT", "/users/{userId}")
+def update_user(request):
+    request_json = request.json()
 
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    request_json["userId"] = request.path["userId"]
+    # update the database
+    table(USERS_TABLE).put_item(Item=request_json)
+    return response(200, request_json)
+
+
+# Change some attributes of a user, the rest of the item is not rewritten
+@router.route("PATCH", "/users/{userId}")
+def patch_user(request):
+    changes = parse_patch(request.json(), "users")
+    userId = request.path["userId"]
     try:
-        # Get a list of all Users
-        if route_key == "GET /users":
-            ddb_response = ddbUserTable.scan(Select="ALL_ATTRIBUTES")
-            # return list of items instead of full DynamoDB response
-            response_body = ddb_response["Items"]
-            status_code = 200
-
-        # CRUD operations for a single User
-
-        # Read a user by ID
-        if route_key == "GET /users/{userId}":
-            # get data from the database
-            ddb_response = ddbUserTable.get_item(
-                Key={"userId": event["pathParameters"]["userId"]}
-            )
-            # return single item instead of full DynamoDB response
-            if "Item" in ddb_response:
-                response_body = ddb_response["Item"]
-            else:
-                response_body = {}
-            status_code = 200
-
-        # Delete a user by ID
-        if route_key == "DELETE /users/{userId}":
-            # delete item in the database
-            ddbUserTable.delete_item(Key={"userId": event["pathParameters"]["userId"]})
-            response_body = {}
-            status_code = 200
-
-        # Create a new user
-        if route_key == "POST /users":
-            request_json = json.loads(event["body"])
-
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error": "Invalid body fields"})
-
-            # generate unique id
-            request_json["userId"] = str(uuid.uuid1())
-
-            # update the database
-            ddbUserTable.put_item(Item=request_json)
-            response_body = request_json
-            status_code = 200
-
-        # Update a specific user by ID
-        if route_key == "PUT /users/{userId}":
-            # update item in the database
-            request_json = json.loads(event["body"])
-
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error": "Invalid body fields"})
-
-            request_json["userId"] = event["pathParameters"]["userId"]
-            # update the database
-            ddbUserTable.put_item(Item=request_json)
-            response_body = request_json
-            status_code = 200
-    except Exception as err:
-        status_code = 400
-        response_body = {"Error:": str(err)}
-        print(str(err))
-    return response(status_code, response_body)
+        ddb_response = table(USERS_TABLE).update_item(
+            Key={"userId": userId},
+            ReturnValues="UPDATED_NEW",
+            **set_expression(
+                changes, {"ConditionExpression": "attribute_exists(userId)"}
+            ),
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        raise ApiError(400, "User not found")
+    forget_user(userId)
+    return response(200, {"userId": userId, **ddb_response["Attributes"]})
+
+
+def user_cascade(userId):
+    return user_levels(
+        USERS_TABLE, WALLETS_TABLE, OPERATIONS_TABLE, OPERATION_STATS_TABLE, userId
+    )
+
 
+def delete_user_now(userId):
+    return {"deleted": delete_levels(collect(user_cascade(userId)))}
 
-def response(status_code, body):
-    headers = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
 
-    return {"statusCode": status_code, "body": json.dumps(body), "headers": headers}
+def assign_user_id(request_json):
+    # generate unique id
+    request_json["userId"] = str(uuid.uuid1())
 
 
 def is_valid_body(request_json):
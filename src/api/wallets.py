@@ -1,157 +1,272 @@
 import json
 import uuid
 import os
-import boto3
-from datetime import datetime
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
 
-# Prepare DynamoDB client
-dynamodb = boto3.resource("dynamodb")
+from src.api.balances import parse_amount
+from src.api.cascade import (
+    collect,
+    delete_cascade,
+    delete_levels,
+    job_location,
+    wallet_levels,
+)
+from src.api.catalogue import AssetCatalogue
+from src.api.db import record_import_time, table
+from src.api.export import export_ndjson, is_export_request
+from src.api.fields import get_fields, projection
+from src.api.jobs import is_job_event, run_job
+from src.api.lookups import forget_wallet, get_user, max_age_for
+from src.api.pagination import fetch_page, iter_items, page_headers
+from src.api.portfolio import build_portfolio
+from src.api.router import ApiError, Router, response
+from src.api.updates import parse_patch, set_expression
 
+# the SDK and every module the handler needs are loaded
+record_import_time()
+
+# DynamoDB tables, the shared client is created on first use
 WALLETS_TABLE = os.getenv("WALLETS_TABLE", None)
 USERS_TABLE = os.getenv("USERS_TABLE", None)
 ASSETS_TABLE = os.getenv("ASSETS_TABLE", None)
+# deleting a wallet also deletes its operations and rollups
+OPERATIONS_TABLE = os.getenv("OPERATIONS_TABLE", None)
+OPERATION_STATS_TABLE = os.getenv("OPERATION_STATS_TABLE", None)
+
+# Asset catalogue kept in memory by warm containers
+asset_catalogue = AssetCatalogue(ASSETS_TABLE)
+
+router = Router()
 
 
 def lambda_handler(event, context):
-    route_key = f"{event['httpMethod']} {event['resource']}"
+    # deletes too large for a request come back as job events
+    if is_job_event(event):
+        return run_job(event, {"deleteWallet": delete_wallet_now})
+    return router.dispatch(event, context)
 
-    # Set default response, override with data from DynamoDB if any
-    response_body = {"Message": "Unsupported route"}
-    status_code = 400
 
+def user_exists(request):
     # First check if userId exist
-    ddb_response_user = dynamodb.Table(USERS_TABLE).get_item(
-        TableName=USERS_TABLE, Key={"userId": event["pathParameters"]["userId"]}
+    request.user = get_user(
+        USERS_TABLE, request.path["userId"], max_age_for(request.event)
     )
+    if not request.user:
+        raise ApiError(400, "User not found")
 
-    if "Item" not in ddb_response_user:
-        return response(400, {"Error": "User not found"})
 
-    try:
-        # Get a list of all Wallets
-        if route_key == "GET /users/{userId}/wallets":
-            try:
-                ddb_response = dynamodb.Table(WALLETS_TABLE).scan(
-                    TableName=WALLETS_TABLE,
-                    FilterExpression="userId = :id",
-                    ExpressionAttributeValues={
-                        ":id": event["pathParameters"]["userId"]
-                    },
-                    IndexName="Wallets-AssetIndex",
-                )
-                # return list of items instead of full DynamoDB response
-                response_body = ddb_response["Items"]
-                status_code = 200
-            except Exception as err:
-                status_code = 400
-                response_body = {"Error:": str(err)}
-                print(str(err))
-
-        # CRUD operations for a single Wallet
-
-        # Read a wallet by ID
-        if route_key == "GET /users/{userId}/wallets/{walletId}":
-            # get data from the database
-            ddb_response = dynamodb.Table(WALLETS_TABLE).get_item(
-                TableName=WALLETS_TABLE,
-                Key={"walletId": event["pathParameters"]["walletId"]},
-            )
+# Get a list of all Wallets
+@router.route("GET", "/users/{userId}/wallets", prechecks=[user_exists])
+def list_wallets(request):
+    # query the index partition instead of filtering the whole index
+    query_kwargs = {
+        "IndexName": "Wallets-AssetIndex",
+        "KeyConditionExpression": Key("userId").eq(request.path["userId"]),
+        **projection(get_fields(request.event, "wallets")),
+    }
 
-            # return single item instead of full DynamoDB response
-            if (
-                "Item" in ddb_response
-                and ddb_response["Item"]["userId"] == event["pathParameters"]["userId"]
-            ):
-                response_body = ddb_response["Item"]
-            else:
-                response_body = {}
-            status_code = 200
-
-        # Delete a wallet by ID
-        if route_key == "DELETE /users/{userId}/wallets/{walletId}":
-            # check if wallet is valid
-            wallet = get_wallet_by_id(event["pathParameters"]["walletId"])
-            if not wallet:
-                return response(400, {"Error": "Wallet not found"})
-
-            # check if userId is valid
-            if wallet["userId"] != event["pathParameters"]["userId"]:
-                return response(400, {"Error": "Invalid userId"})
-
-            # delete item in the database
-            dynamodb.Table(WALLETS_TABLE).delete_item(
-                TableName=WALLETS_TABLE,
-                Key={"walletId": event["pathParameters"]["walletId"]},
-            )
-            response_body = {}
-            status_code = 200
+    # stream every page of the partition into the blob store
+    if is_export_request(request.event):
+        export = export_ndjson(
+            "wallets", iter_items(table(WALLETS_TABLE).query, **query_kwargs)
+        )
+        return response(200, {"export": export})
 
-        # Create a new wallet
-        if route_key == "POST /users/{userId}/wallets":
-            request_json = json.loads(event["body"])
+    items, next_cursor = fetch_page(
+        table(WALLETS_TABLE).query, request.event, **query_kwargs
+    )
+    # return list of items instead of full DynamoDB response
+    return response(200, items, page_headers(next_cursor))
 
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error": "Invalid body fields"})
 
-            # check if asset is valid
-            ddb_response_asset = dynamodb.Table(ASSETS_TABLE).get_item(
-                TableName=ASSETS_TABLE, Key={"assetId": request_json["assetId"]}
-            )
-            if "Item" not in ddb_response_asset:
-                return response(400, {"Error": "Asset not found"})
+# Totals of the wallets of a user per asset and per blockchain
+@router.route("GET", "/users/{userId}/portfolio", prechecks=[user_exists])
+def get_portfolio(request):
+    # read only what the totals need from the index partition of the user
+    wallets = iter_items(
+        table(WALLETS_TABLE).query,
+        IndexName="Wallets-AssetIndex",
+        KeyConditionExpression=Key("userId").eq(request.path["userId"]),
+        **projection(["walletId", "assetId", "balance"]),
+    )
+    return response(
+        200, build_portfolio(request.path["userId"], wallets, asset_catalogue)
+    )
 
-            request_json["userId"] = event["pathParameters"]["userId"]
 
-            # generate unique id if it isn't present in the request
-            request_json["walletId"] = str(uuid.uuid1())
+# CRUD operations for a single Wallet
 
-            # update the database
-            dynamodb.Table(WALLETS_TABLE).put_item(
-                TableName=WALLETS_TABLE, Item=request_json
-            )
-            response_body = request_json
-            status_code = 201
-
-        # Update a specific wallet by ID
-        if route_key == "PUT /users/{userId}/wallets/{walletId}":
-            # update item in the database
-            request_json = json.loads(event["body"])
-
-            # check if it has a valid body
-            if not is_valid_body(request_json):
-                return response(400, {"Error": "Invalid body fields"})
-
-            request_json["walletId"] = event["pathParameters"]["walletId"]
-            # update the database
-            dynamodb.Table(WALLETS_TABLE).put_item(
-                TableName=WALLETS_TABLE, Item=request_json
-            )
-            response_body = request_json
-            status_code = 200
-    except Exception as err:
-        status_code = 400
-        response_body = {"Error:": str(err)}
-        print(str(err))
-    return response(status_code, response_body)
 
-
-def get_wallet_by_id(walletId):
+# Read a wallet by ID
+@router.route("GET", "/users/{userId}/wallets/{walletId}", prechecks=[user_exists])
+def get_wallet(request):
     # get data from the database
-    ddb_response = dynamodb.Table(WALLETS_TABLE).get_item(
-        TableName=WALLETS_TABLE, Key={"walletId": walletId}
+    wallet = get_wallet_by_id(
+        request.path["walletId"], get_fields(request.event, "wallets")
     )
+
     # return single item instead of full DynamoDB response
-    if "Item" in ddb_response:
-        return ddb_response["Item"]
-    else:
-        return
+    if wallet and wallet["userId"] == request.path["userId"]:
+        return response(200, wallet)
+    return response(200, {})
+
+
+# Delete a wallet by ID with its operations and rollups. The wallet goes
+# last, like the user of a user cascade, so a request that fails halfway
+# is retried against a wallet that still leads to what is left.
+@router.route("DELETE", "/users/{userId}/wallets/{walletId}")
+def delete_wallet(request):
+    walletId = request.path["walletId"]
+    wallet = (
+        table(WALLETS_TABLE)
+        .get_item(
+            Key={"walletId": walletId},
+            ConsistentRead=True,
+            **projection(["userId"]),
+        )
+        .get("Item")
+    )
+    if not wallet:
+        raise ApiError(400, "Wallet not found")
+    # userId is never changed once the wallet exists
+    if wallet["userId"] != request.path["userId"]:
+        raise ApiError(400, "Invalid userId")
+
+    job = delete_cascade(
+        request,
+        "deleteWallet",
+        {"walletId": walletId},
+        lambda: wallet_cascade(walletId),
+    )
+    forget_wallet(walletId)
+    if job:
+        return response(202, job, job_location(job))
+    return response(200, {})
+
+
+# Create a new wallet
+@router.route("POST", "/users/{userId}/wallets", prechecks=[user_exists])
+def create_wallet(request):
+    request_json = request.json()
+
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    # check if asset is valid
+    if not asset_catalogue.get(request_json["assetId"]):
+        raise ApiError(400, "Asset not found")
 
+    request_json["balance"] = parse_amount(request_json["balance"])
+    request_json["userId"] = request.path["userId"]
 
-def response(status_code, body):
-    headers = {"Content-Type": "application/json", "Access-Control-Allow-Origin": "*"}
+    # generate unique id
+    request_json["walletId"] = str(uuid.uuid1())
 
-    return {"statusCode": status_code, "body": json.dumps(body), "headers": headers}
+    # update the database
+    table(WALLETS_TABLE).put_item(Item=request_json)
+    return response(201, request_json)
+
+
+# Update a specific wallet by ID, only while it belongs to the user
+@router.route("PUT", "/users/{userId}/wallets/{walletId}")
+def update_wallet(request):
+    request_json = request.json()
+
+    # check if it has a valid body
+    if not is_valid_body(request_json):
+        raise ApiError(400, "Invalid body fields")
+
+    request_json["balance"] = parse_amount(request_json["balance"])
+    request_json["walletId"] = request.path["walletId"]
+    request_json["userId"] = request.path["userId"]
+    # update the database
+    owned_write(
+        table(WALLETS_TABLE).put_item,
+        request.path["walletId"],
+        request.path["userId"],
+        "Wallet does not belong to the user",
+        Item=request_json,
+    )
+    forget_wallet(request.path["walletId"])
+    return response(200, request_json)
+
+
+# Change some attributes of a wallet, only while it belongs to the user
+@router.route("PATCH", "/users/{userId}/wallets/{walletId}")
+def patch_wallet(request):
+    changes = parse_patch(request.json(), "wallets")
+    if "balance" in changes:
+        changes["balance"] = parse_amount(changes["balance"])
+        if changes["balance"] is None:
+            raise ApiError(400, "Invalid body fields")
+    if "assetId" in changes and not asset_catalogue.get(changes["assetId"]):
+        raise ApiError(400, "Asset not found")
+
+    walletId = request.path["walletId"]
+    ddb_response = owned_write(
+        table(WALLETS_TABLE).update_item,
+        walletId,
+        request.path["userId"],
+        "Wallet does not belong to the user",
+        Key={"walletId": walletId},
+        ReturnValues="UPDATED_NEW",
+        **set_expression(changes),
+    )
+    forget_wallet(walletId)
+    return response(200, {"walletId": walletId, **ddb_response["Attributes"]})
+
+
+def owned_write(write, walletId, userId, owner_message, **kwargs):
+    # Run a put or update of the wallet that only applies while it belongs
+    # to the user, in a single call with no read before it
+    values = dict(kwargs.pop("ExpressionAttributeValues", {}), **{":userId": userId})
+    try:
+        return write(
+            ConditionExpression="userId = :userId",
+            ExpressionAttributeValues=values,
+            ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            **kwargs,
+        )
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        forget_wallet(walletId)
+        # DynamoDB returns the stored wallet with the failure when it exists
+        # and belongs to another user, that needs no read. A missing wallet
+        # comes back without Item, as does every failure on backends that
+        # ignore ReturnValuesOnConditionCheckFailure, so those read it.
+        if "Item" in err.response:
+            wallet = err.response["Item"]
+        else:
+            wallet = (
+                table(WALLETS_TABLE)
+                .get_item(Key={"walletId": walletId}, ConsistentRead=True)
+                .get("Item")
+            )
+        if not wallet:
+            raise ApiError(400, "Wallet not found")
+        raise ApiError(400, owner_message)
+
+
+def wallet_cascade(walletId):
+    return wallet_levels(
+        WALLETS_TABLE, OPERATIONS_TABLE, OPERATION_STATS_TABLE, walletId
+    )
+
+
+def delete_wallet_now(walletId):
+    return {"deleted": delete_levels(collect(wallet_cascade(walletId)))}
+
+
+def get_wallet_by_id(walletId, fields=None):
+    # get data from the database
+    ddb_response = table(WALLETS_TABLE).get_item(
+        Key={"walletId": walletId}, **projection(fields)
+    )
+    # return single item instead of full DynamoDB response
+    return ddb_response.get("Item")
 
 
 def is_valid_body(request_json):
@@ -160,6 +275,7 @@ def is_valid_body(request_json):
             request_json
             and "address" in request_json
             and "balance" in request_json
+            and parse_amount(request_json["balance"]) is not None
             and "assetId" in request_json
         )
     except (json.JSONDecodeError, KeyError):
@@ -0,0 +1,54 @@
+# CPU cost against byte savings of the response encodings at different
+# levels on a large listing. Run with: python -m tests.benchmark.bench_compression
+import time
+import uuid
+
+from src.api.compression import COMPRESSORS
+from src.api.serializer import dumps
+from tests.benchmark.bench_serializer import wallet_items
+
+ITEMS = 10000
+ROUNDS = 5
+LEVELS = (1, 6, 9)
+
+
+def operation_items(count):
+    return [
+        {
+            "operationId": str(uuid.uuid4()),
+            "walletId": str(uuid.uuid4()),
+            "amount": i % 100,
+            "type": "buy" if i % 2 else "sell",
+        }
+        for i in range(count)
+    ]
+
+
+def best_of(compress, data, level):
+    timings = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        compressed = compress(data, level)
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000, len(compressed)
+
+
+def main():
+    listings = {
+        "wallets": dumps(wallet_items(ITEMS)).encode("utf-8"),
+        "operations": dumps(operation_items(ITEMS)).encode("utf-8"),
+    }
+    print(f"{ITEMS} items, best of {ROUNDS}")
+    for name, data in listings.items():
+        print(f"{name}: {len(data)} bytes")
+        for encoding, compress in COMPRESSORS.items():
+            for level in LEVELS:
+                ms, size = best_of(compress, data, level)
+                print(
+                    f"  {encoding:<8}level {level}{ms:>9.2f} ms{size:>10} bytes"
+                    f"{size / len(data):>8.1%}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+# Latency, throughput and DynamoDB calls of every route of the users, assets,
+# wallets and operations handlers on moto, for a few dataset sizes. The sample
+# events in events/ are replayed first, then variants of them on generated
+# items. Results are written as JSON, pass an earlier file with --compare to
+# see what changed between commits.
+# Run with: python -m tests.benchmark.bench_handlers --sizes 100,1000
+import argparse
+import contextlib
+import copy
+import importlib
+import io
+import json
+import os
+import subprocess
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import boto3
+from moto import mock_dynamodb
+
+from tests.unit import test_handler as fixtures
+
+SIZES = (100, 1000)
+REQUESTS = 50
+OUTPUT = "bench_handlers.json"
+PERCENTILES = (50, 95, 99)
+
+TABLES = {
+    "USERS_TABLE": fixtures.USERS_MOCK_TABLE_NAME,
+    "ASSETS_TABLE": fixtures.ASSETS_MOCK_TABLE_NAME,
+    "WALLETS_TABLE": fixtures.WALLETS_MOCK_TABLE_NAME,
+    "OPERATIONS_TABLE": fixtures.OPERATIONS_MOCK_TABLE_NAME,
+    "OPERATION_STATS_TABLE": fixtures.OPERATION_STATS_MOCK_TABLE_NAME,
+    "JOBS_TABLE": fixtures.JOBS_MOCK_TABLE_NAME,
+}
+
+ASSETS = (
+    fixtures.UUID_MOCK_VALUE_BTC,
+    fixtures.UUID_MOCK_VALUE_ETH,
+    fixtures.UUID_MOCK_VALUE_DOT,
+)
+
+
+def user_id(i):
+    return f"bench-user-{i}"
+
+
+def wallet_id(i):
+    return f"bench-wallet-{i}"
+
+
+def operation_id(i):
+    return f"bench-operation-{i}"
+
+
+def seed(size, requests):
+    # size users with one wallet and one operation each, on top of the items
+    # the sample events point to. The delete routes get their own items, so
+    # every request deletes something.
+    fixtures.set_up_dynamodb()
+    fixtures.put_data_dynamodb_user()
+    fixtures.put_data_dynamodb_asset()
+    fixtures.put_data_dynamodb_wallet()
+    fixtures.put_data_dynamodb_operation()
+
+    dynamodb = boto3.resource("dynamodb")
+    users = dynamodb.Table(TABLES["USERS_TABLE"]).batch_writer()
+    wallets = dynamodb.Table(TABLES["WALLETS_TABLE"]).batch_writer()
+    operations = dynamodb.Table(TABLES["OPERATIONS_TABLE"]).batch_writer()
+    with users, wallets, operations:
+        for i in range(size):
+            users.put_item(
+                Item={
+                    "userId": user_id(i),
+                    "idNumber": f"{i:08d}X",
+                    "firstName": f"First{i}",
+                    "lastName": f"Last{i}",
+                    "email": f"user{i}@example.com",
+                    "phone": f"6{i:08d}",
+                }
+            )
+            wallets.put_item(
+                Item={
+                    "walletId": wallet_id(i),
+                    "userId": user_id(i),
+                    "assetId": ASSETS[i % len(ASSETS)],
+                    "address": f"0x{i:x}",
+                    "balance": 1000,
+                }
+            )
+            operations.put_item(
+                Item={
+                    "operationId": operation_id(i),
+                    "walletId": wallet_id(i),
+                    "amount": 1,
+                    "type": "buy",
+                    "createdAt": f"2001-01-01T00:00:{i % 60:02d}.000000Z",
+                }
+            )
+        for i in range(requests):
+            users.put_item(Item={"userId": f"bench-delete-user-{i}"})
+            wallets.put_item(
+                Item={
+                    "walletId": f"bench-delete-wallet-{i}",
+                    "userId": user_id(i % size),
+                    "assetId": ASSETS[0],
+                    "balance": 0,
+                }
+            )
+            operations.put_item(
+                Item={
+                    "operationId": f"bench-delete-operation-{i}",
+                    "walletId": wallet_id(i % size),
+                    "amount": 1,
+                    "type": "buy",
+                    "createdAt": "2001-01-02T00:00:00.000000Z",
+                }
+            )
+
+
+def with_path(event, **params):
+    event["pathParameters"] = dict(event["pathParameters"] or {}, **params)
+    event["path"] = event["resource"].format(**event["pathParameters"])
+    return event
+
+
+def with_body(event, body):
+    event["body"] = json.dumps(body)
+    return event
+
+
+def with_query(event, **params):
+    event["queryStringParameters"] = params or None
+    return event
+
+
+def as_method(event, method):
+    event["httpMethod"] = method
+    return event
+
+
+# (handler, sample event, variant). variant(event, i, size) turns a copy of
+# the sample event into request i, request 0 is the sample event itself.
+CASES = [
+    (
+        "users",
+        "users/event-get-all-users.json",
+        lambda e, i, n: with_query(e, limit="25"),
+    ),
+    (
+        "users",
+        "users/event-get-user-by-id.json",
+        lambda e, i, n: with_path(e, userId=user_id(i % n)),
+    ),
+    (
+        "users",
+        "users/event-post-user.json",
+        lambda e, i, n: with_body(
+            e,
+            {
+                "idNumber": f"{i:08d}P",
+                "firstName": "Post",
+                "lastName": f"User{i}",
+                "email": f"post{i}@example.com",
+                "phone": f"7{i:08d}",
+            },
+        ),
+    ),
+    (
+        "users",
+        "users/event-get-user-by-id.json",
+        lambda e, i, n: with_body(
+            with_path(as_method(e, "PATCH"), userId=user_id(i % n)),
+            {"phone": f"8{i:08d}"},
+        ),
+    ),
+    (
+        "assets",
+        "assets/event-get-all-assets.json",
+        lambda e, i, n: with_query(e, limit="2"),
+    ),
+    (
+        "assets",
+        "assets/event-get-asset-by-id.json",
+        lambda e, i, n: with_path(e, assetId=ASSETS[i % len(ASSETS)]),
+    ),
+    (
+        "assets",
+        "assets/event-post-asset.json",
+        lambda e, i, n: with_body(e, {"symbol": f"B{i}", "blockchain": "Bench"}),
+    ),
+    (
+        "wallets",
+        "wallets/event-get-all-wallets.json",
+        lambda e, i, n: with_path(e, userId=user_id(i % n)),
+    ),
+    (
+        "wallets",
+        "wallets/event-get-portfolio.json",
+        lambda e, i, n: with_path(e, userId=user_id(i % n)),
+    ),
+    (
+        "wallets",
+        "wallets/event-get-wallet-by-id.json",
+        lambda e, i, n: with_path(e, userId=user_id(i % n), walletId=wallet_id(i % n)),
+    ),
+    (
+        "wallets",
+        "wallets/event-post-wallet.json",
+        lambda e, i, n: with_body(
+            with_path(e, userId=user_id(i % n)),
+            {"address": f"0xp{i}", "balance": i, "assetId": ASSETS[i % len(ASSETS)]},
+        ),
+    ),
+    (
+        "wallets",
+        "wallets/event-get-wallet-by-id.json",
+        lambda e, i, n: with_body(
+            with_path(
+                as_method(e, "PATCH"), userId=user_id(i % n), walletId=wallet_id(i % n)
+            ),
+            {"address": f"0xq{i}"},
+        ),
+    ),
+    (
+        "operations",
+        "operations/event-get-all-operations.json",
+        lambda e, i, n: with_path(e, userId=user_id(i % n), walletId=wallet_id(i % n)),
+    ),
+    (
+        "operations",
+        "operations/event-get-operation-by-id.json",
+        lambda e, i, n: with_path(
+            e,
+            userId=user_id(i % n),
+            walletId=wallet_id(i % n),
+            operationId=operation_id(i % n),
+        ),
+    ),
+    (
+        "operations",
+        "operations/event-post-operation.json",
+        lambda e, i, n: with_body(
+            with_path(e, userId=user_id(i % n), walletId=wallet_id(i % n)),
+            {"amount": 1, "type": "buy"},
+        ),
+    ),
+    (
+        "operations",
+        "operations/event-get-operation-by-id.json",
+        lambda e, i, n: with_body(
+            with_path(
+                as_method(e, "PATCH"),
+                userId=user_id(i % n),
+                walletId=wallet_id(i % n),
+                operationId=operation_id(i % n),
+            ),
+            {"amount": 2},
+        ),
+    ),
+    # deletes last, children before their parents
+    (
+        "operations",
+        "operations/event-delete-operation-by-id.json",
+        lambda e, i, n: with_path(
+            e,
+            userId=user_id(i % n),
+            walletId=wallet_id(i % n),
+            operationId=f"bench-delete-operation-{i}",
+        ),
+    ),
+    (
+        "wallets",
+        "wallets/event-delete-wallet-by-id.json",
+        lambda e, i, n: with_path(
+            e, userId=user_id(i % n), walletId=f"bench-delete-wallet-{i}"
+        ),
+    ),
+    (
+        "assets",
+        "assets/event-delete-asset-by-id.json",
+        lambda e, i, n: with_path(e, assetId=f"bench-missing-asset-{i}"),
+    ),
+    (
+        "users",
+        "users/event-delete-user-by-id.json",
+        lambda e, i, n: with_path(e, userId=f"bench-delete-user-{i}"),
+    ),
+]
+
+
+def load_event(name):
+    with open(os.path.join("events", name), "r") as f:
+        return json.load(f)
+
+
+def route_of(event):
+    return f"{event['httpMethod']} {event['resource']}"
+
+
+def percentile(sorted_values, p):
+    # nearest rank
+    index = max(0, -(-len(sorted_values) * p // 100) - 1)
+    return sorted_values[int(index)]
+
+
+@contextlib.contextmanager
+def record_calls(calls):
+    from src.api.db import get_client
+
+    def on_before_call(model, **kwargs):
+        calls.append(model.name)
+
+    events = get_client().meta.events
+    events.register("before-call.dynamodb", on_before_call)
+    try:
+        yield
+    finally:
+        events.unregister("before-call.dynamodb", on_before_call)
+
+
+def reset_caches(handlers):
+    # every dataset starts with cold caches, like a new container
+    from src.api.idempotency import replay_cache
+    from src.api.lookups import existence_cache
+
+    existence_cache.clear()
+    replay_cache.clear()
+    handlers["assets"].catalogue.invalidate()
+    handlers["wallets"].asset_catalogue.invalidate()
+
+
+def run_case(handler, sample, variant, size, requests):
+    latencies = []
+    calls = []
+    statuses = Counter()
+    for i in range(requests):
+        event = copy.deepcopy(sample)
+        if i:
+            event = variant(event, i, size)
+        # handlers log to stdout, keep it for the report
+        with record_calls(calls), contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            ret = handler.lambda_handler(event, fixtures.lambda_context())
+            latencies.append(time.perf_counter() - started)
+        statuses[str(ret["statusCode"])] += 1
+    latencies.sort()
+    result = {f"p{p}Ms": round(percentile(latencies, p) * 1000, 3) for p in PERCENTILES}
+    result.update(
+        {
+            "requests": requests,
+            "throughputPerSecond": round(requests / sum(latencies), 1),
+            "dynamodbCallsPerRequest": round(len(calls) / requests, 2),
+            "dynamodbCalls": dict(Counter(calls)),
+            "statusCodes": dict(statuses),
+        }
+    )
+    return result
+
+
+def run_size(handlers, size, requests):
+    with mock_dynamodb():
+        seed(size, requests)
+        reset_caches(handlers)
+        routes = {}
+        for name, event_file, variant in CASES:
+            sample = load_event(event_file)
+            if variant(copy.deepcopy(sample), 0, size)["httpMethod"] == "PATCH":
+                # no sample event for PATCH, every request is a variant
+                sample = variant(sample, 0, size)
+            routes[route_of(sample)] = run_case(
+                handlers[name], sample, variant, size, requests
+            )
+        return routes
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    for size, routes in results["sizes"].items():
+        print(f"{size} items per table, {results['requests']} requests per route")
+        print(
+            f"  {'route':<68}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+            f"{'req/s':>9}{'calls':>7}"
+        )
+        for route, r in routes.items():
+            print(
+                f"  {route:<68}{r['p50Ms']:>9.2f}{r['p95Ms']:>9.2f}{r['p99Ms']:>9.2f}"
+                f"{r['throughputPerSecond']:>9.1f}{r['dynamodbCallsPerRequest']:>7.2f}"
+            )
+
+
+def print_comparison(results, previous):
+    # p95 and calls per request against an earlier run, per size and route
+    print(f"compared with {previous.get('commit') or 'previous run'}")
+    for size, routes in results["sizes"].items():
+        before = previous["sizes"].get(size, {})
+        for route, r in routes.items():
+            if route not in before:
+                continue
+            old = before[route]
+            change = r["p95Ms"] / old["p95Ms"] - 1 if old["p95Ms"] else 0
+            calls = r["dynamodbCallsPerRequest"] - old["dynamodbCallsPerRequest"]
+            print(f"  {size:>7} {route:<68}p95 {change:>+8.1%}  calls {calls:>+6.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API handlers on moto")
+    parser.add_argument(
+        "--sizes",
+        default=",".join(str(size) for size in SIZES),
+        help="comma separated items per table",
+    )
+    parser.add_argument("--requests", type=int, default=REQUESTS)
+    parser.add_argument("--output", default=OUTPUT)
+    parser.add_argument("--compare", help="results of an earlier run")
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    # handlers read their settings on import
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    for name, value in TABLES.items():
+        os.environ.setdefault(name, value)
+    handlers = {
+        name: importlib.import_module(f"src.api.{name}")
+        for name in ("users", "assets", "wallets", "operations")
+    }
+
+    results = {
+        "commit": commit(),
+        "createdAt": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "requests": args.requests,
+        "sizes": {str(size): run_size(handlers, size, args.requests) for size in sizes},
+    }
+    print_results(results)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.output}")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import gzip
+import io
+import json
+
+import pytest
+
+from src.api import analytics
+from src.api.blobstore import LocalBlobStore
+
+OPERATIONS_ARN = (
+    "arn:aws:dynamodb:us-east-1:123456789012:table/tfm-Operations/stream/2001-01-01"
+)
+WALLETS_ARN = "arn:aws:dynamodb:us-east-1:123456789012:table/tfm-Wallets/stream/2001"
+
+# 2001-01-01T10:00:00Z and 2001-01-02T10:00:00Z
+DAY_1 = 978343200
+DAY_2 = DAY_1 + 24 * 3600
+
+
+def stream_record(sequence, created, image, event_name="INSERT", arn=OPERATIONS_ARN):
+    change = {
+        "ApproximateCreationDateTime": created,
+        "SequenceNumber": str(sequence),
+        # the key is the first attribute of the images below
+        "Keys": dict(list(image.items())[:1]),
+    }
+    change["OldImage" if event_name == "REMOVE" else "NewImage"] = image
+    return {"eventName": event_name, "eventSourceARN": arn, "dynamodb": change}
+
+
+def operation_image(operationId, amount, kind="buy"):
+    return {
+        "operationId": {"S": operationId},
+        "walletId": {"S": "1"},
+        "amount": {"N": amount},
+        "type": {"S": kind},
+    }
+
+
+def read_ndjson(store, key):
+    return [json.loads(line) for line in gzip.decompress(store.get(key)).splitlines()]
+
+
+def test_export_orders_and_partitions_records(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    records = [
+        stream_record(300, DAY_2, operation_image("3", "5")),
+        stream_record(100, DAY_1, operation_image("1", "1.5")),
+        stream_record(200, DAY_1, operation_image("1", "1.5"), "REMOVE"),
+    ]
+
+    written, failed = analytics.export_records(records, store, "ndjson")
+
+    assert failed is None
+    assert [f["key"] for f in written] == [
+        "analytics/tfm-Operations/dt=2001-01-01/100-200.ndjson.gz",
+        "analytics/tfm-Operations/dt=2001-01-02/300-300.ndjson.gz",
+    ]
+    rows = read_ndjson(store, written[0]["key"])
+    assert [(row["sequenceNumber"], row["eventName"]) for row in rows] == [
+        ("100", "INSERT"),
+        ("200", "REMOVE"),
+    ]
+    assert rows[0]["changedAt"] == "2001-01-01T10:00:00.000000Z"
+    assert rows[0]["amount"] == 1.5
+
+
+def test_export_splits_files_by_max_rows(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    records = [
+        stream_record(i, DAY_1, operation_image(str(i), str(i))) for i in range(1, 6)
+    ]
+
+    written, failed = analytics.export_records(records, store, "ndjson", max_rows=2)
+
+    assert failed is None
+    assert [f["rows"] for f in written] == [2, 2, 1]
+    assert [f["key"].rsplit("/", 1)[1] for f in written] == [
+        "1-2.ndjson.gz",
+        "3-4.ndjson.gz",
+        "5-5.ndjson.gz",
+    ]
+
+
+def test_export_parquet_columns(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    store = LocalBlobStore(str(tmp_path))
+    records = [
+        stream_record(1, DAY_1, operation_image("1", "1.5")),
+        stream_record(2, DAY_1, operation_image("2", "10", "sell")),
+        stream_record(
+            3,
+            DAY_1,
+            {
+                "walletId": {"S": "1"},
+                "userId": {"S": "1"},
+                "balance": {"S": "7"},
+            },
+            arn=WALLETS_ARN,
+        ),
+        stream_record(
+            4,
+            DAY_1,
+            {"walletId": {"S": "2"}, "userId": {"S": "1"}, "balance": {"N": "7"}},
+            "MODIFY",
+            WALLETS_ARN,
+        ),
+    ]
+    written, failed = analytics.export_records(records, store, "parquet")
+
+    assert failed is None
+    assert [f["key"] for f in written] == [
+        "analytics/tfm-Operations/dt=2001-01-01/1-2.parquet",
+        "analytics/tfm-Wallets/dt=2001-01-01/3-4.parquet",
+    ]
+    operations = pq.read_table(io.BytesIO(store.get(written[0]["key"])))
+    assert str(operations.schema.field("amount").type) == "decimal128(3, 1)"
+    assert operations.column("type").to_pylist() == ["buy", "sell"]
+    # legacy string balances fall back to a string column
+    wallets = pq.read_table(io.BytesIO(store.get(written[1]["key"])))
+    assert wallets.column("balance").to_pylist() == ["7", "7"]
+
+
+def test_export_reports_first_unwritten_record(tmp_path):
+    class FailingStore(LocalBlobStore):
+        def put(self, key, data):
+            if "dt=2001-01-02" in key:
+                raise OSError("store unavailable")
+            super().put(key, data)
+
+    store = FailingStore(str(tmp_path))
+    records = [
+        stream_record(1, DAY_1, operation_image("1", "1")),
+        stream_record(2, DAY_2, operation_image("2", "1")),
+        stream_record(3, DAY_1, operation_image("3", "1")),
+    ]
+
+    written, failed = analytics.export_records(records, store, "ndjson", max_rows=1)
+
+    assert [f["rows"] for f in written] == [1]
+    assert failed == "2"
+
+
+def test_export_unknown_format(tmp_path):
+    with pytest.raises(analytics.AnalyticsError):
+        analytics.export_records([], LocalBlobStore(str(tmp_path)), "csv")
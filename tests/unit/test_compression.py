@@ -0,0 +1,40 @@
+import base64
+import gzip
+import json
+import zlib
+
+from src.api.compression import choose_encoding, compress_response
+from src.api.router import Request, response
+
+
+def test_choose_encoding():
+    assert choose_encoding(None) is None
+    assert choose_encoding("br") is None
+    assert choose_encoding("gzip, deflate, br") == "gzip"
+    assert choose_encoding("gzip;q=0.5, deflate") == "deflate"
+    assert choose_encoding("gzip;q=0, *") == "deflate"
+    assert choose_encoding("identity, *;q=0") is None
+
+
+def test_compress_response_above_threshold():
+    body = [{"userId": str(i), "email": f"user{i}@gmail.com"} for i in range(100)]
+    ret = compress_response(response(200, body), "gzip", min_bytes=1024)
+    assert ret["isBase64Encoded"] is True
+    assert ret["headers"]["Content-Encoding"] == "gzip"
+    assert ret["headers"]["Vary"] == "Accept-Encoding"
+    assert json.loads(gzip.decompress(base64.b64decode(ret["body"]))) == body
+
+    ret = compress_response(response(200, body), "deflate", min_bytes=1024)
+    assert json.loads(zlib.decompress(base64.b64decode(ret["body"]))) == body
+
+
+def test_compress_response_below_threshold():
+    original = response(200, {"userId": "1"})
+    assert compress_response(original, "gzip", min_bytes=1024) is original
+    assert "isBase64Encoded" not in original
+
+
+def test_request_json_decodes_base64_bodies():
+    body = base64.b64encode(b'{"symbol":"DOT"}').decode("ascii")
+    event = {"httpMethod": "POST", "body": body, "isBase64Encoded": True}
+    assert Request(event, None).json() == {"symbol": "DOT"}
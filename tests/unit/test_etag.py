@@ -0,0 +1,39 @@
+from src.api.compression import compress_response
+from src.api.etag import conditional_response, matches
+from src.api.router import response
+
+
+def test_matches():
+    assert not matches(None, '"abc"')
+    assert matches("*", '"abc"')
+    assert matches('"xyz", W/"abc"', '"abc"')
+    assert matches('"abc-gzip"', '"abc"')
+    assert not matches('"abd"', '"abc"')
+
+
+def test_conditional_response():
+    ret = conditional_response(response(200, {"userId": "1"}), None)
+    etag = ret["headers"]["ETag"]
+    assert ret["statusCode"] == 200
+    assert ret["headers"]["Access-Control-Expose-Headers"] == "ETag"
+
+    ret = conditional_response(response(200, {"userId": "1"}), etag)
+    assert ret["statusCode"] == 304
+    assert ret["body"] == ""
+    assert ret["headers"]["ETag"] == etag
+
+    error = response(400, {"Error": "User not found"})
+    assert conditional_response(error, "*") is error
+
+
+def test_compressed_responses_keep_their_own_etag():
+    ret = conditional_response(response(200, {"userId": "1"}), None)
+    etag = ret["headers"]["ETag"]
+    compressed = compress_response(ret, "gzip", min_bytes=0)
+    assert compressed["headers"]["ETag"] == etag[:-1] + '-gzip"'
+
+    # the tag of the gzip representation validates the same content
+    ret = conditional_response(
+        response(200, {"userId": "1"}), compressed["headers"]["ETag"]
+    )
+    assert ret["statusCode"] == 304
@@ -0,0 +1,60 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+from src.api.blobstore import LocalBlobStore, get_blob_store
+from src.api.export import ExportError, export_ndjson, is_export_request
+
+
+def test_chunked_writer_splits_parts(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    writer = store.open_writer("objects/test", chunk_bytes=10)
+    for i in range(7):
+        writer.write(f"line-{i}\n".encode())
+    handle = writer.close({"entity": "test"})
+
+    assert handle["store"] == "local"
+    assert handle["bytes"] == 7 * 7
+    assert len(handle["parts"]) == 4
+    assert b"".join(store.read_chunked("objects/test")) == b"".join(
+        f"line-{i}\n".encode() for i in range(7)
+    )
+
+
+def test_local_store_rejects_keys_outside_root(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.put("../outside", b"data")
+
+
+def test_unknown_blob_store():
+    with pytest.raises(ValueError):
+        get_blob_store("ftp")
+
+
+def test_export_ndjson_streams_generator(tmp_path):
+    store = LocalBlobStore(str(tmp_path))
+    consumed = []
+
+    def items():
+        for i in range(100):
+            consumed.append(i)
+            yield {"id": str(i), "balance": Decimal("1.5"), "count": Decimal(i)}
+
+    handle = export_ndjson("wallets", items(), store=store, chunk_bytes=256)
+
+    assert handle["items"] == 100
+    assert handle["format"] == "ndjson"
+    assert len(handle["parts"]) > 1
+    lines = b"".join(store.read_chunked(handle["key"]))
+    rows = [json.loads(line) for line in lines.splitlines()]
+    assert rows[3] == {"id": "3", "balance": 1.5, "count": 3}
+    assert len(consumed) == 100
+
+
+def test_is_export_request():
+    assert not is_export_request({"queryStringParameters": None})
+    assert is_export_request({"queryStringParameters": {"export": "ndjson"}})
+    with pytest.raises(ExportError):
+        is_export_request({"queryStringParameters": {"export": "xml"}})
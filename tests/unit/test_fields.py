@@ -0,0 +1,34 @@
+import yaml
+
+from src.api.fields import ENTITY_FIELDS, get_fields, projection
+
+SCHEMAS = {
+    "users": "UserResponse",
+    "assets": "AssetResponse",
+    "wallets": "WalletResponse",
+    "operations": "OperationResponse",
+}
+
+
+def test_fields_follow_swagger_schemas():
+    with open("./swagger-api.yml", "r") as f:
+        schemas = yaml.safe_load(f)["components"]["schemas"]
+    for entity, schema in SCHEMAS.items():
+        keys, fields = ENTITY_FIELDS[entity]
+        properties = set(schemas[schema]["properties"]) - {"id"}
+        assert properties <= set(keys) | set(fields)
+        assert set(fields) <= properties
+
+
+def test_get_fields_always_adds_keys():
+    event = {"queryStringParameters": {"fields": "balance, walletId,balance"}}
+    assert get_fields(event, "wallets") == ["walletId", "userId", "balance"]
+    assert get_fields({"queryStringParameters": None}, "wallets") is None
+
+
+def test_projection_uses_placeholders():
+    assert projection(["operationId", "type"]) == {
+        "ProjectionExpression": "#f0,#f1",
+        "ExpressionAttributeNames": {"#f0": "operationId", "#f1": "type"},
+    }
+    assert projection(None) == {}
@@ -1,8 +1,17 @@
+import base64
+import contextlib
+import copy
+import gzip
 import json
 import os
+import subprocess
+import sys
+import time
 import boto3
 import uuid
 import pytest
+from decimal import Decimal
+from types import SimpleNamespace
 from moto import mock_dynamodb
 from contextlib import contextmanager
 from unittest.mock import patch
@@ -11,6 +20,9 @@ USERS_MOCK_TABLE_NAME = "UsersTest"
 ASSETS_MOCK_TABLE_NAME = "AssetsTest"
 WALLETS_MOCK_TABLE_NAME = "WalletsTest"
 OPERATIONS_MOCK_TABLE_NAME = "OperationsTest"
+OPERATION_STATS_MOCK_TABLE_NAME = "OperationStatsTest"
+JOBS_MOCK_TABLE_NAME = "JobsTest"
+IDEMPOTENCY_MOCK_TABLE_NAME = "IdempotencyTest"
 
 UUID_MOCK_VALUE_JOHN = "f8216640-91a2-11eb-8ab9-57aa454facef"
 UUID_MOCK_VALUE_JANE = "31a9f940-917b-11eb-9054-67837e2c40b0"
@@ -27,6 +39,16 @@ UUID_MOCK_VALUE_NEW_OPERATION1 = "77593b94-0ce7-4548-bdc9-f9509f9fcf48"
 UUID_MOCK_VALUE_NEW_OPERATION2 = "d12d179a-f99e-4bb5-a498-dc660304f151"
 
 
+@pytest.fixture(autouse=True)
+def clear_existence_cache():
+    # the cache lives for the whole process, do not share it between tests
+    from src.api.idempotency import replay_cache
+    from src.api.lookups import existence_cache
+
+    existence_cache.clear()
+    replay_cache.clear()
+
+
 @contextmanager
 def my_test_environment():
     with mock_dynamodb():
@@ -86,6 +108,7 @@ def set_up_dynamodb():
         AttributeDefinitions=[
             {"AttributeName": "operationId", "AttributeType": "S"},
             {"AttributeName": "walletId", "AttributeType": "S"},
+            {"AttributeName": "createdAt", "AttributeType": "S"},
         ],
         ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
         GlobalSecondaryIndexes=[
@@ -98,7 +121,47 @@ def set_up_dynamodb():
                     "ProjectionType": "ALL",
                 },
             },
+            {
+                "IndexName": "Operations-WalletTimeIndex",
+                "KeySchema": [
+                    {"AttributeName": "walletId", "KeyType": "HASH"},
+                    {"AttributeName": "createdAt", "KeyType": "RANGE"},
+                ],
+                "Projection": {
+                    "ProjectionType": "ALL",
+                },
+            },
+        ],
+    )
+    conn.create_table(
+        TableName=OPERATION_STATS_MOCK_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "walletId", "KeyType": "HASH"},
+            {"AttributeName": "period", "KeyType": "RANGE"},
         ],
+        AttributeDefinitions=[
+            {"AttributeName": "walletId", "AttributeType": "S"},
+            {"AttributeName": "period", "AttributeType": "S"},
+        ],
+        ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
+    )
+    conn.create_table(
+        TableName=JOBS_MOCK_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "jobId", "KeyType": "HASH"},
+        ],
+        AttributeDefinitions=[{"AttributeName": "jobId", "AttributeType": "S"}],
+        ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
+    )
+    conn.create_table(
+        TableName=IDEMPOTENCY_MOCK_TABLE_NAME,
+        KeySchema=[
+            {"AttributeName": "idempotencyKey", "KeyType": "HASH"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "idempotencyKey", "AttributeType": "S"}
+        ],
+        ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
     )
 
 
@@ -177,7 +240,7 @@ def put_data_dynamodb_wallet():
         Item={
             "walletId": {"S": UUID_MOCK_VALUE_NEW_WALLET1},
             "address": {"S": "0x123456789"},
-            "balance": {"S": "5"},
+            "balance": {"N": "5"},
             "userId": {"S": UUID_MOCK_VALUE_MARY},
             "assetId": {"S": UUID_MOCK_VALUE_DOT},
         },
@@ -187,7 +250,7 @@ def put_data_dynamodb_wallet():
         Item={
             "walletId": {"S": UUID_MOCK_VALUE_NEW_WALLET2},
             "address": {"S": "0x987654321"},
-            "balance": {"S": "10"},
+            "balance": {"N": "10"},
             "userId": {"S": UUID_MOCK_VALUE_MARY},
             "assetId": {"S": UUID_MOCK_VALUE_DOT},
         },
@@ -202,22 +265,121 @@ def put_data_dynamodb_operation():
         TableName=OPERATIONS_MOCK_TABLE_NAME,
         Item={
             "operationId": {"S": UUID_MOCK_VALUE_NEW_OPERATION1},
-            "amount": {"S": "5"},
+            "amount": {"N": "5"},
             "type": {"S": "buy"},
             "walletId": {"S": UUID_MOCK_VALUE_NEW_WALLET1},
+            "createdAt": {"S": "2001-01-01T10:00:00.000000Z"},
         },
     )
     conn.put_item(
         TableName=OPERATIONS_MOCK_TABLE_NAME,
         Item={
             "operationId": {"S": UUID_MOCK_VALUE_NEW_OPERATION2},
-            "amount": {"S": "10"},
+            "amount": {"N": "10"},
             "type": {"S": "sell"},
             "walletId": {"S": UUID_MOCK_VALUE_NEW_WALLET1},
+            "createdAt": {"S": "2001-01-02T10:00:00.000000Z"},
         },
     )
 
 
+@contextmanager
+def count_read_items(operation_name):
+    # record ScannedCount of every call the handler module makes
+    scanned = []
+
+    def on_after_call(parsed, **kwargs):
+        scanned.append(int(parsed.get("ScannedCount", 0)))
+
+    from src.api.db import get_client
+
+    events = get_client().meta.events
+    event_name = f"after-call.dynamodb.{operation_name}"
+    events.register(event_name, on_after_call)
+    try:
+        yield scanned
+    finally:
+        events.unregister(event_name, on_after_call)
+
+
+@contextmanager
+def count_calls():
+    # record the name of every DynamoDB call the handler module makes
+    calls = []
+
+    def on_before_call(model, **kwargs):
+        calls.append(model.name)
+
+    from src.api.db import get_client
+
+    events = get_client().meta.events
+    events.register("before-call.dynamodb", on_before_call)
+    try:
+        yield calls
+    finally:
+        events.unregister("before-call.dynamodb", on_before_call)
+
+
+def put_unrelated_wallets(count):
+    conn = boto3.client("dynamodb")
+    for i in range(count):
+        conn.put_item(
+            TableName=WALLETS_MOCK_TABLE_NAME,
+            Item={
+                "walletId": {"S": f"unrelated-wallet-{i}"},
+                "address": {"S": f"0x{i}"},
+                "balance": {"N": "1"},
+                "userId": {"S": UUID_MOCK_VALUE_JOHN},
+                "assetId": {"S": UUID_MOCK_VALUE_BTC},
+            },
+        )
+
+
+def put_unrelated_operations(count):
+    conn = boto3.client("dynamodb")
+    for i in range(count):
+        conn.put_item(
+            TableName=OPERATIONS_MOCK_TABLE_NAME,
+            Item={
+                "operationId": {"S": f"unrelated-operation-{i}"},
+                "amount": {"N": "1"},
+                "type": {"S": "buy"},
+                "walletId": {"S": UUID_MOCK_VALUE_NEW_WALLET2},
+                "createdAt": {"S": f"2001-01-01T00:00:{i % 60:02d}.000000Z"},
+            },
+        )
+
+
+def put_wallet_rollup(walletId, day):
+    conn = boto3.client("dynamodb")
+    conn.put_item(
+        TableName=OPERATION_STATS_MOCK_TABLE_NAME,
+        Item={
+            "walletId": {"S": walletId},
+            "period": {"S": f"day#{day}"},
+            "buyAmount": {"N": "5"},
+            "buyCount": {"N": "1"},
+        },
+    )
+
+
+def count_items(table_name, key_name, value):
+    # items of a table whose attribute key_name equals value
+    conn = boto3.client("dynamodb")
+    return conn.scan(
+        TableName=table_name,
+        FilterExpression="#k = :v",
+        ExpressionAttributeNames={"#k": key_name},
+        ExpressionAttributeValues={":v": {"S": value}},
+    )["Count"]
+
+
+def lambda_context():
+    return SimpleNamespace(
+        invoked_function_arn="arn:aws:lambda:us-east-1:123456789012:function:test"
+    )
+
+
 # ----------------------------
 #           USERS
 # ----------------------------
@@ -231,7 +393,14 @@ def mock_uuid_user():
 
 @patch.dict(
     os.environ,
-    {"USERS_TABLE": USERS_MOCK_TABLE_NAME, "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR"},
+    {
+        "USERS_TABLE": USERS_MOCK_TABLE_NAME,
+        "WALLETS_TABLE": WALLETS_MOCK_TABLE_NAME,
+        "OPERATIONS_TABLE": OPERATIONS_MOCK_TABLE_NAME,
+        "OPERATION_STATS_TABLE": OPERATION_STATS_MOCK_TABLE_NAME,
+        "JOBS_TABLE": JOBS_MOCK_TABLE_NAME,
+        "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR",
+    },
 )
 def test_get_list_of_users():
     with my_test_environment():
@@ -271,6 +440,126 @@ def test_get_list_of_users():
         assert data == expected_response
 
 
+def test_get_list_of_users_paginated():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"limit": "2"}
+        ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        first_page = json.loads(ret["body"])
+        assert len(first_page) == 2
+        cursor = ret["headers"]["X-Next-Cursor"]
+
+        apigw_event["queryStringParameters"] = {"limit": "2", "cursor": cursor}
+        ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        second_page = json.loads(ret["body"])
+        assert "X-Next-Cursor" not in ret["headers"]
+
+        user_ids = [user["userId"] for user in first_page + second_page]
+        assert sorted(user_ids) == sorted(
+            [UUID_MOCK_VALUE_JOHN, UUID_MOCK_VALUE_JANE, UUID_MOCK_VALUE_MARY]
+        )
+
+
+def test_get_list_of_users_invalid_cursor():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"cursor": "not-a-cursor"}
+        ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid cursor"}
+        assert ret["statusCode"] == 400
+
+
+def test_get_list_of_users_invalid_limit():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"limit": "0"}
+        ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 400
+
+
+def test_get_list_of_users_sparse_fields():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"fields": "email"}
+        ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        data = json.loads(ret["body"])
+        assert sorted(data, key=lambda user: user["email"]) == [
+            {"userId": UUID_MOCK_VALUE_JANE, "email": "janedoe@gmail.com"},
+            {"userId": UUID_MOCK_VALUE_JOHN, "email": "johndoe@gmail.com"},
+            {"userId": UUID_MOCK_VALUE_MARY, "email": "marydoe@gmail.com"},
+        ]
+
+
+def test_get_list_of_users_compressed():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["headers"] = {"Accept-Encoding": "gzip, deflate"}
+        with patch("src.api.compression.COMPRESSION_MIN_BYTES", 0):
+            ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert ret["isBase64Encoded"] is True
+        assert ret["headers"]["Content-Encoding"] == "gzip"
+        data = json.loads(gzip.decompress(base64.b64decode(ret["body"])))
+        assert len(data) == 3
+
+
+def test_get_list_of_users_unknown_field():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"fields": "email,password"}
+        with count_calls() as calls:
+            ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Unknown field: password"}
+        assert ret["statusCode"] == 400
+        assert calls == []
+
+
+def test_export_users(tmp_path):
+    with my_test_environment():
+        from src.api import users
+        from src.api.blobstore import LocalBlobStore
+
+        with open("./events/users/event-get-all-users.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"export": "ndjson"}
+        # moto ignores Segment, scan with a single segment
+        with patch("src.api.scan.SCAN_SEGMENTS", 1), patch(
+            "src.api.blobstore.BLOB_STORE_LOCAL_ROOT", str(tmp_path)
+        ):
+            ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        export = json.loads(ret["body"])["export"]
+        assert export["entity"] == "users"
+        assert export["items"] == 3
+
+        lines = b"".join(LocalBlobStore(str(tmp_path)).read_chunked(export["key"]))
+        exported_ids = [json.loads(line)["userId"] for line in lines.splitlines()]
+        assert sorted(exported_ids) == sorted(
+            [UUID_MOCK_VALUE_JOHN, UUID_MOCK_VALUE_JANE, UUID_MOCK_VALUE_MARY]
+        )
+
+
 def test_get_single_user():
     with my_test_environment():
         from src.api import users
@@ -338,134 +627,652 @@ def test_add_user():
         assert ret["statusCode"] == 200
 
 
-def test_delete_user():
-    with my_test_environment():
-        from src.api import users
+def count_uuid1_calls():
+    # distinct ids, so a second write would create a second user
+    calls = []
 
-        with open("./events/users/event-delete-user-by-id.json", "r") as f:
-            apigw_event = json.load(f)
-        ret = users.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {}
-        assert ret["statusCode"] == 200
+    def uuid1():
+        calls.append(None)
+        return f"new-user-guid-{len(calls)}"
 
+    return calls, uuid1
 
-# ----------------------------
-#           ASSETS
-# ----------------------------
 
-UUID_MOCK_VALUE_NEW_ASSET = "new-asset-guid"
+def post_user_event(key, body=None):
+    with open("./events/users/event-post-user.json", "r") as f:
+        apigw_event = json.load(f)
+    apigw_event["headers"] = {"Idempotency-Key": key}
+    if body is not None:
+        apigw_event["body"] = json.dumps(body)
+    return apigw_event
 
 
-def mock_uuid_asset():
-    return UUID_MOCK_VALUE_NEW_ASSET
+def test_add_user_idempotency_key_replays_response():
+    with my_test_environment(), patch(
+        "src.api.idempotency.IDEMPOTENCY_TABLE", IDEMPOTENCY_MOCK_TABLE_NAME
+    ):
+        from src.api import users
+        from src.api.idempotency import replay_cache
+
+        calls, uuid1 = count_uuid1_calls()
+        with patch("uuid.uuid1", uuid1):
+            first = users.lambda_handler(post_user_event("retry-1"), "")
+            # served by the container cache
+            second = users.lambda_handler(post_user_event("retry-1"), "")
+            # served by the idempotency table, as in another container
+            replay_cache.clear()
+            with count_calls() as ddb_calls:
+                third = users.lambda_handler(post_user_event("retry-1"), "")
+
+        assert len(calls) == 1
+        assert ddb_calls == ["PutItem", "GetItem"]
+        assert first["statusCode"] == second["statusCode"] == third["statusCode"]
+        assert first["body"] == second["body"] == third["body"]
+        assert "Idempotent-Replayed" not in first["headers"]
+        assert second["headers"]["Idempotent-Replayed"] == "true"
+        assert third["headers"]["Idempotent-Replayed"] == "true"
+        assert count_items(USERS_MOCK_TABLE_NAME, "email", "johndoe@gmail.com") == 2
+
+        # a new key is a new request
+        with patch("uuid.uuid1", uuid1):
+            ret = users.lambda_handler(post_user_event("retry-2"), "")
+        assert json.loads(ret["body"])["userId"] == "new-user-guid-2"
+
+
+def test_add_user_idempotency_key_with_different_body():
+    with my_test_environment(), patch(
+        "src.api.idempotency.IDEMPOTENCY_TABLE", IDEMPOTENCY_MOCK_TABLE_NAME
+    ):
+        from src.api import users
 
+        users.lambda_handler(post_user_event("retry-1"), "")
+        body = json.loads(post_user_event("retry-1")["body"])
+        body["phone"] = "600000002"
+        ret = users.lambda_handler(post_user_event("retry-1", body), "")
+        assert json.loads(ret["body"]) == {
+            "Error": "Idempotency-Key was already used with a different body"
+        }
+        assert ret["statusCode"] == 422
 
-@patch.dict(
-    os.environ,
-    {"ASSETS_TABLE": ASSETS_MOCK_TABLE_NAME, "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR"},
-)
-def test_get_list_of_assets():
-    with my_test_environment():
-        from src.api import assets
 
-        with open("./events/assets/event-get-all-assets.json", "r") as f:
-            apigw_get_all_assets_event = json.load(f)
-        expected_response = [
-            {
-                "assetId": UUID_MOCK_VALUE_BTC,
-                "symbol": "BTC",
-                "blockchain": "Bitcoin",
-            },
-            {
-                "assetId": UUID_MOCK_VALUE_ETH,
-                "symbol": "ETH",
-                "blockchain": "Ethereum",
-            },
-            {
-                "assetId": UUID_MOCK_VALUE_DOT,
-                "symbol": "DOT",
-                "blockchain": "Polkadot",
-            },
-        ]
-        ret = assets.lambda_handler(apigw_get_all_assets_event, "")
+def test_add_user_idempotency_key_in_progress():
+    with my_test_environment(), patch(
+        "src.api.idempotency.IDEMPOTENCY_TABLE", IDEMPOTENCY_MOCK_TABLE_NAME
+    ):
+        from src.api import users
+        from src.api.idempotency import _fingerprint
+
+        # a concurrent duplicate holds the key and has not finished yet
+        apigw_event = post_user_event("retry-1")
+        record = {
+            "idempotencyKey": {"S": "POST /users retry-1"},
+            "status": {"S": "in_progress"},
+            "fingerprint": {"S": _fingerprint(apigw_event)},
+            "lockedUntil": {"N": str(int(time.time()) + 60)},
+            "expiresAt": {"N": str(int(time.time()) + 3600)},
+        }
+        conn = boto3.client("dynamodb")
+        conn.put_item(TableName=IDEMPOTENCY_MOCK_TABLE_NAME, Item=record)
+
+        ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "Error": "A request with this Idempotency-Key is still in progress"
+        }
+        assert ret["statusCode"] == 409
+        assert count_items(USERS_MOCK_TABLE_NAME, "email", "johndoe@gmail.com") == 1
+
+        # the lock of a request that never finished runs out
+        record["lockedUntil"] = {"N": str(int(time.time()) - 1)}
+        conn.put_item(TableName=IDEMPOTENCY_MOCK_TABLE_NAME, Item=record)
+        ret = users.lambda_handler(apigw_event, "")
         assert ret["statusCode"] == 200
-        data = json.loads(ret["body"])
-        assert data == expected_response
 
 
-def test_get_single_asset():
-    with my_test_environment():
-        from src.api import assets
+def test_add_user_idempotency_key_released_on_error():
+    with my_test_environment(), patch(
+        "src.api.idempotency.IDEMPOTENCY_TABLE", IDEMPOTENCY_MOCK_TABLE_NAME
+    ):
+        from src.api import users
 
-        with open("./events/assets/event-get-asset-by-id.json", "r") as f:
-            apigw_event = json.load(f)
-        expected_response = {
-            "blockchain": "Bitcoin",
-            "assetId": UUID_MOCK_VALUE_BTC,
-            "symbol": "BTC",
-        }
-        ret = assets.lambda_handler(apigw_event, "")
-        data = json.loads(ret["body"])
-        assert data == expected_response
+        ret = users.lambda_handler(post_user_event("retry-1", {"idNumber": "1"}), "")
+        assert ret["statusCode"] == 400
+        # the client fixes the body and retries with the same key
+        ret = users.lambda_handler(post_user_event("retry-1"), "")
         assert ret["statusCode"] == 200
 
 
-def test_get_single_asset_wrong_id():
+def test_add_users_batch():
     with my_test_environment():
-        from src.api import assets
+        from src.api import users
 
-        with open("./events/assets/event-get-asset-by-id.json", "r") as f:
+        with open("./events/users/event-post-user.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["assetId"] = "123456789"
-            apigw_event["rawPath"] = "/assets/123456789"
-        ret = assets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {}
-        assert ret["statusCode"] == 200
+        user = json.loads(apigw_event["body"])
+        batch = [dict(user, idNumber=f"{i:08d}X") for i in range(30)]
+        del batch[7]["email"]
+        apigw_event["resource"] = "/users:batch"
+        apigw_event["body"] = json.dumps(batch)
+
+        ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 207
+        results = json.loads(ret["body"])["results"]
+        assert [r["index"] for r in results] == list(range(30))
+        assert results[7] == {
+            "index": 7,
+            "status": 400,
+            "Error": "Invalid body fields",
+        }
+        created = [r["item"] for r in results if r["status"] == 201]
+        assert len(created) == 29
+        assert len({item["userId"] for item in created}) == 29
 
+        ddb_response = boto3.client("dynamodb").scan(
+            TableName=USERS_MOCK_TABLE_NAME, Select="COUNT"
+        )
+        assert ddb_response["Count"] == 3 + 29
 
-def test_add_asset_invalid_body_fields():
+
+def test_add_users_batch_invalid_body():
     with my_test_environment():
-        from src.api import assets
+        from src.api import users
 
-        with open("./events/assets/event-post-asset.json", "r") as f:
+        with open("./events/users/event-post-user.json", "r") as f:
             apigw_event = json.load(f)
-        apigw_event["body"] = json.loads(apigw_event["body"])
-        del apigw_event["body"]["symbol"]
-        apigw_event["body"] = json.dumps(apigw_event["body"])
-        ret = assets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        apigw_event["resource"] = "/users:batch"
+        ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Body must be a non empty array"}
         assert ret["statusCode"] == 400
 
 
-@patch("uuid.uuid1", mock_uuid_asset)
-@pytest.mark.freeze_time("2001-01-01")
-def test_add_asset():
-    with my_test_environment():
-        from src.api import assets
+def test_batch_put_items_retries_unprocessed_items():
+    from src.api.batch import batch_put_items
 
-        with open("./events/assets/event-post-asset.json", "r") as f:
-            apigw_event = json.load(f)
-        expected_response = json.loads(apigw_event["body"])
-        ret = assets.lambda_handler(apigw_event, "")
-        data = json.loads(ret["body"])
-        assert data["assetId"] == UUID_MOCK_VALUE_NEW_ASSET
-        assert data["symbol"] == expected_response["symbol"]
-        assert data["blockchain"] == expected_response["blockchain"]
-        assert ret["statusCode"] == 200
+    class FlakyDynamoDB:
+        def __init__(self):
+            self.calls = []
 
+        def batch_write_item(self, RequestItems):
+            requests = RequestItems["Table"]
+            self.calls.append(len(requests))
+            # leave the last item of every call unprocessed once
+            if len(self.calls) % 2:
+                return {"UnprocessedItems": {"Table": requests[-1:]}}
+            return {"UnprocessedItems": {}}
 
-def test_delete_asset():
-    with my_test_environment():
-        from src.api import assets
+    dynamodb = FlakyDynamoDB()
+    items = [{"id": str(i)} for i in range(30)]
+    with patch("src.api.batch.BATCH_BACKOFF_SECONDS", 0):
+        failed = batch_put_items(dynamodb, "Table", items, "id")
+    assert failed == {}
+    assert dynamodb.calls == [25, 1, 5, 1]
 
-        with open("./events/assets/event-delete-asset-by-id.json", "r") as f:
-            apigw_event = json.load(f)
-        ret = assets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {}
-        assert ret["statusCode"] == 200
 
+def test_batch_put_items_gives_up_after_retries():
+    from src.api.batch import batch_put_items
 
-# ----------------------------
+    class ThrottledDynamoDB:
+        def batch_write_item(self, RequestItems):
+            return {"UnprocessedItems": RequestItems}
+
+    items = [{"id": str(i)} for i in range(3)]
+    with patch("src.api.batch.BATCH_BACKOFF_SECONDS", 0):
+        failed = batch_put_items(ThrottledDynamoDB(), "Table", items, "id")
+    assert failed == {"0": "Unprocessed", "1": "Unprocessed", "2": "Unprocessed"}
+
+
+def test_delete_user():
+    with my_test_environment():
+        from src.api import users
+
+        with open("./events/users/event-delete-user-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+
+def test_delete_user_cascades_to_wallets_and_operations():
+    with my_test_environment():
+        from src.api import users
+
+        put_unrelated_operations(30)
+        put_wallet_rollup(UUID_MOCK_VALUE_NEW_WALLET1, "2001-01-01")
+        put_unrelated_wallets(1)
+
+        with open("./events/users/event-delete-user-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_MARY
+        ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+        assert count_items(USERS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 0
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 0
+        for walletId in (UUID_MOCK_VALUE_NEW_WALLET1, UUID_MOCK_VALUE_NEW_WALLET2):
+            assert count_items(OPERATIONS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+            assert (
+                count_items(OPERATION_STATS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+            )
+        # other users keep their data
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_JOHN) == 1
+
+
+def test_delete_user_large_cascade_runs_as_job():
+    with my_test_environment():
+        from src.api import users
+
+        put_unrelated_operations(10)
+        with open("./events/users/event-delete-user-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_MARY
+
+        invocations = []
+        with patch("src.api.cascade.CASCADE_SYNC_MAX_ITEMS", 5), patch(
+            "src.api.jobs.invoke_async",
+            lambda name, payload: invocations.append((name, payload)),
+        ):
+            ret = users.lambda_handler(apigw_event, lambda_context())
+        job = json.loads(ret["body"])
+        assert ret["statusCode"] == 202
+        assert ret["headers"]["Location"] == (
+            f"/users/{UUID_MOCK_VALUE_MARY}/jobs/{job['jobId']}"
+        )
+        assert job["status"] == "pending"
+        assert invocations == [
+            (lambda_context().invoked_function_arn, {"jobId": job["jobId"]})
+        ]
+        # nothing is deleted until the job runs
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 2
+
+        users.lambda_handler(invocations[0][1], lambda_context())
+
+        status_event = {
+            "resource": "/users/{userId}/jobs/{jobId}",
+            "httpMethod": "GET",
+            "pathParameters": {"userId": UUID_MOCK_VALUE_MARY, "jobId": job["jobId"]},
+        }
+        ret = users.lambda_handler(status_event, "")
+        status = json.loads(ret["body"])
+        assert status["status"] == "succeeded"
+        # 2 seed and 10 extra operations, 2 wallets and the user
+        assert status["result"] == {"deleted": 15}
+        assert count_items(USERS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 0
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 0
+
+        # jobs are only visible to their user
+        status_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JOHN
+        ret = users.lambda_handler(status_event, "")
+        assert json.loads(ret["body"]) == {}
+
+
+def test_delete_user_cascade_keeps_parents_of_failed_deletes():
+    with my_test_environment():
+        from src.api import users
+        from src.api.batch import batch_delete_keys
+
+        def failing_deletes(client, table_name, keys):
+            if table_name == OPERATIONS_MOCK_TABLE_NAME:
+                return keys
+            return batch_delete_keys(client, table_name, keys)
+
+        with open("./events/users/event-delete-user-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_MARY
+        with patch("src.api.cascade.batch_delete_keys", failing_deletes):
+            ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "2 items could not be deleted"}
+        assert ret["statusCode"] == 503
+        # the user and its wallets are left for a retry to find the operations
+        assert count_items(USERS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 1
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "userId", UUID_MOCK_VALUE_MARY) == 2
+
+
+def test_batch_get_items_stops_retrying_unprocessed_keys():
+    from src.api.batch import BATCH_MAX_RETRIES, batch_get_items
+    from src.api.router import ApiError
+
+    class ThrottledDynamoDB:
+        calls = 0
+
+        def batch_get_item(self, RequestItems):
+            self.calls += 1
+            keys = RequestItems["Table"]["Keys"]
+            return {
+                "Responses": {"Table": [keys[0]]},
+                "UnprocessedKeys": {"Table": {"Keys": keys[1:]}} if keys[1:] else {},
+            }
+
+    dynamodb = ThrottledDynamoDB()
+    request_items = {"Table": {"Keys": [{"id": "0"}, {"id": "1"}]}}
+    with patch("src.api.batch.BATCH_BACKOFF_SECONDS", 0):
+        assert batch_get_items(dynamodb, request_items) == {
+            "Table": [{"id": "0"}, {"id": "1"}]
+        }
+
+    dynamodb.batch_get_item = lambda RequestItems: {
+        "Responses": {},
+        "UnprocessedKeys": RequestItems,
+    }
+    sleeps = []
+    with patch("src.api.batch.time.sleep", sleeps.append), pytest.raises(
+        ApiError
+    ) as err:
+        batch_get_items(dynamodb, request_items)
+    assert err.value.status_code == 503
+    assert len(sleeps) == BATCH_MAX_RETRIES
+
+
+def test_batch_delete_keys_returns_unprocessed_keys():
+    from src.api.batch import batch_delete_keys
+
+    class ThrottledDynamoDB:
+        def batch_write_item(self, RequestItems):
+            return {"UnprocessedItems": {"Table": RequestItems["Table"][:1]}}
+
+    keys = [{"id": str(i)} for i in range(3)]
+    with patch("src.api.batch.BATCH_BACKOFF_SECONDS", 0):
+        failed = batch_delete_keys(ThrottledDynamoDB(), "Table", keys)
+    assert failed == [{"id": "0"}]
+
+
+def patch_user_event(body):
+    with open("./events/users/event-get-user-by-id.json", "r") as f:
+        apigw_event = json.load(f)
+    apigw_event["httpMethod"] = "PATCH"
+    apigw_event["body"] = json.dumps(body)
+    return apigw_event
+
+
+def test_patch_user_writes_only_changed_attributes():
+    with my_test_environment():
+        from src.api import users
+
+        apigw_event = patch_user_event({"phone": "600000009"})
+        with count_calls() as calls:
+            ret = users.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert calls == ["UpdateItem"]
+        assert json.loads(ret["body"]) == {
+            "userId": UUID_MOCK_VALUE_JOHN,
+            "phone": "600000009",
+        }
+        user = (
+            boto3.resource("dynamodb")
+            .Table(USERS_MOCK_TABLE_NAME)
+            .get_item(Key={"userId": UUID_MOCK_VALUE_JOHN})["Item"]
+        )
+        assert user["phone"] == "600000009"
+        assert user["email"] == "johndoe@gmail.com"
+
+
+def test_patch_user_invalid_body():
+    with my_test_environment():
+        from src.api import users
+
+        for body, message in [
+            ({}, "Body must be a non empty object"),
+            ({"userId": "1"}, "userId can not be changed"),
+            ({"nickname": "jd"}, "Unknown field: nickname"),
+            ({"phone": None}, "phone can not be null"),
+        ]:
+            ret = users.lambda_handler(patch_user_event(body), "")
+            assert json.loads(ret["body"]) == {"Error": message}
+            assert ret["statusCode"] == 400
+
+
+def test_patch_user_wrong_id():
+    with my_test_environment():
+        from src.api import users
+
+        apigw_event = patch_user_event({"phone": "600000009"})
+        apigw_event["pathParameters"]["userId"] = "123456789"
+        ret = users.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "User not found"}
+        assert ret["statusCode"] == 400
+        assert count_items(USERS_MOCK_TABLE_NAME, "userId", "123456789") == 0
+
+
+# ----------------------------
+#           ASSETS
+# ----------------------------
+
+UUID_MOCK_VALUE_NEW_ASSET = "new-asset-guid"
+
+
+def mock_uuid_asset():
+    return UUID_MOCK_VALUE_NEW_ASSET
+
+
+@patch.dict(
+    os.environ,
+    {"ASSETS_TABLE": ASSETS_MOCK_TABLE_NAME, "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR"},
+)
+def test_get_list_of_assets():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-get-all-assets.json", "r") as f:
+            apigw_get_all_assets_event = json.load(f)
+        expected_response = [
+            {
+                "assetId": UUID_MOCK_VALUE_BTC,
+                "symbol": "BTC",
+                "blockchain": "Bitcoin",
+            },
+            {
+                "assetId": UUID_MOCK_VALUE_ETH,
+                "symbol": "ETH",
+                "blockchain": "Ethereum",
+            },
+            {
+                "assetId": UUID_MOCK_VALUE_DOT,
+                "symbol": "DOT",
+                "blockchain": "Polkadot",
+            },
+        ]
+        ret = assets.lambda_handler(apigw_get_all_assets_event, "")
+        assert ret["statusCode"] == 200
+        data = json.loads(ret["body"])
+        assert data == expected_response
+
+
+def test_get_list_of_assets_paginated():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-get-all-assets.json", "r") as f:
+            apigw_event = json.load(f)
+        asset_ids = []
+        apigw_event["queryStringParameters"] = {"limit": "1"}
+        while True:
+            ret = assets.lambda_handler(apigw_event, "")
+            assert ret["statusCode"] == 200
+            asset_ids += [asset["assetId"] for asset in json.loads(ret["body"])]
+            if "X-Next-Cursor" not in ret["headers"]:
+                break
+            apigw_event["queryStringParameters"] = {
+                "limit": "1",
+                "cursor": ret["headers"]["X-Next-Cursor"],
+            }
+        assert sorted(asset_ids) == sorted(
+            [UUID_MOCK_VALUE_BTC, UUID_MOCK_VALUE_ETH, UUID_MOCK_VALUE_DOT]
+        )
+
+
+def test_get_list_of_assets_served_from_catalogue():
+    with my_test_environment():
+        from src.api import assets
+
+        assets.catalogue.invalidate()
+        with open("./events/assets/event-get-all-assets.json", "r") as f:
+            apigw_event = json.load(f)
+        with count_calls() as calls:
+            first = assets.lambda_handler(apigw_event, "")
+            second = assets.lambda_handler(apigw_event, "")
+        assert first["body"] == second["body"]
+        assert calls == ["Scan"]
+
+
+def test_get_list_of_assets_sparse_fields_from_catalogue():
+    with my_test_environment():
+        from src.api import assets
+
+        assets.catalogue.invalidate()
+        with open("./events/assets/event-get-all-assets.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"fields": "symbol"}
+        ret = assets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        data = json.loads(ret["body"])
+        assert {"assetId": UUID_MOCK_VALUE_BTC, "symbol": "BTC"} in data
+        assert all(set(asset) == {"assetId", "symbol"} for asset in data)
+
+
+@patch("uuid.uuid1", mock_uuid_asset)
+def test_add_asset_invalidates_catalogue():
+    with my_test_environment():
+        from src.api import assets
+
+        assets.catalogue.invalidate()
+        with open("./events/assets/event-get-all-assets.json", "r") as f:
+            apigw_get_all_assets_event = json.load(f)
+        with open("./events/assets/event-post-asset.json", "r") as f:
+            apigw_post_event = json.load(f)
+        assets.lambda_handler(apigw_get_all_assets_event, "")
+        assets.lambda_handler(apigw_post_event, "")
+        ret = assets.lambda_handler(apigw_get_all_assets_event, "")
+        asset_ids = [asset["assetId"] for asset in json.loads(ret["body"])]
+        assert UUID_MOCK_VALUE_NEW_ASSET in asset_ids
+
+
+def test_asset_catalogue_ttl_and_refresh():
+    with my_test_environment():
+        from src.api.catalogue import AssetCatalogue
+
+        now = [0.0]
+        table = boto3.resource("dynamodb").Table(ASSETS_MOCK_TABLE_NAME)
+        catalogue = AssetCatalogue(ASSETS_MOCK_TABLE_NAME, ttl=10, clock=lambda: now[0])
+        assert len(catalogue.all()) == 3
+
+        table.put_item(
+            Item={"assetId": "new-asset", "symbol": "SOL", "blockchain": "Solana"}
+        )
+        # still fresh, the new asset is found through the database fallback
+        now[0] = 5.0
+        assert len(catalogue.all()) == 3
+        assert catalogue.get("new-asset")["symbol"] == "SOL"
+        assert catalogue.get("missing-asset") is None
+
+        table.delete_item(Key={"assetId": UUID_MOCK_VALUE_BTC})
+        # expired, the catalogue is read again
+        now[0] = 10.0
+        assert len(catalogue.all()) == 3
+        assert catalogue.get(UUID_MOCK_VALUE_BTC) is None
+
+
+def test_asset_catalogue_refreshes_in_background():
+    with my_test_environment():
+        from src.api.catalogue import AssetCatalogue
+
+        now = [0.0]
+        table = boto3.resource("dynamodb").Table(ASSETS_MOCK_TABLE_NAME)
+        catalogue = AssetCatalogue(ASSETS_MOCK_TABLE_NAME, ttl=10, clock=lambda: now[0])
+        catalogue.all()
+        table.delete_item(Key={"assetId": UUID_MOCK_VALUE_BTC})
+
+        # close to expiry the current copy is served while a new one loads
+        now[0] = 9.0
+        assert len(catalogue.all()) == 3
+        for _ in range(100):
+            if not catalogue._refreshing:
+                break
+            time.sleep(0.01)
+        assert len(catalogue.all()) == 2
+
+
+def test_asset_catalogue_too_large():
+    with my_test_environment():
+        from src.api.catalogue import AssetCatalogue
+
+        table = boto3.resource("dynamodb").Table(ASSETS_MOCK_TABLE_NAME)
+        catalogue = AssetCatalogue(ASSETS_MOCK_TABLE_NAME, max_items=2)
+        assert catalogue.all() is None
+        assert catalogue.get(UUID_MOCK_VALUE_DOT)["symbol"] == "DOT"
+
+
+def test_get_single_asset():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-get-asset-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        expected_response = {
+            "blockchain": "Bitcoin",
+            "assetId": UUID_MOCK_VALUE_BTC,
+            "symbol": "BTC",
+        }
+        ret = assets.lambda_handler(apigw_event, "")
+        data = json.loads(ret["body"])
+        assert data == expected_response
+        assert ret["statusCode"] == 200
+
+
+def test_get_single_asset_wrong_id():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-get-asset-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["assetId"] = "123456789"
+            apigw_event["rawPath"] = "/assets/123456789"
+        ret = assets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+
+def test_add_asset_invalid_body_fields():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-post-asset.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["body"] = json.loads(apigw_event["body"])
+        del apigw_event["body"]["symbol"]
+        apigw_event["body"] = json.dumps(apigw_event["body"])
+        ret = assets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        assert ret["statusCode"] == 400
+
+
+@patch("uuid.uuid1", mock_uuid_asset)
+@pytest.mark.freeze_time("2001-01-01")
+def test_add_asset():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-post-asset.json", "r") as f:
+            apigw_event = json.load(f)
+        expected_response = json.loads(apigw_event["body"])
+        ret = assets.lambda_handler(apigw_event, "")
+        data = json.loads(ret["body"])
+        assert data["assetId"] == UUID_MOCK_VALUE_NEW_ASSET
+        assert data["symbol"] == expected_response["symbol"]
+        assert data["blockchain"] == expected_response["blockchain"]
+        assert ret["statusCode"] == 200
+
+
+def test_delete_asset():
+    with my_test_environment():
+        from src.api import assets
+
+        with open("./events/assets/event-delete-asset-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = assets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+
+# ----------------------------
 #           WALLETS
 # ----------------------------
 
@@ -482,6 +1289,8 @@ def mock_uuid_wallet():
         "WALLETS_TABLE": WALLETS_MOCK_TABLE_NAME,
         "USERS_TABLE": USERS_MOCK_TABLE_NAME,
         "ASSETS_TABLE": ASSETS_MOCK_TABLE_NAME,
+        "OPERATIONS_TABLE": OPERATIONS_MOCK_TABLE_NAME,
+        "OPERATION_STATS_TABLE": OPERATION_STATS_MOCK_TABLE_NAME,
         "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR",
     },
 )
@@ -495,14 +1304,14 @@ def test_get_list_of_wallets():
             {
                 "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
                 "address": "0x123456789",
-                "balance": "5",
+                "balance": 5,
                 "userId": UUID_MOCK_VALUE_MARY,
                 "assetId": UUID_MOCK_VALUE_DOT,
             },
             {
                 "walletId": UUID_MOCK_VALUE_NEW_WALLET2,
                 "address": "0x987654321",
-                "balance": "10",
+                "balance": 10,
                 "userId": UUID_MOCK_VALUE_MARY,
                 "assetId": UUID_MOCK_VALUE_DOT,
             },
@@ -513,6 +1322,42 @@ def test_get_list_of_wallets():
         assert ret["statusCode"] == 200
 
 
+def test_get_list_of_wallets_read_cost_independent_of_other_users():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-all-wallets.json", "r") as f:
+            apigw_event = json.load(f)
+
+        read_counts = []
+        for unrelated in (0, 200):
+            put_unrelated_wallets(unrelated)
+            with count_read_items("Query") as scanned:
+                ret = wallets.lambda_handler(apigw_event, "")
+            assert ret["statusCode"] == 200
+            assert len(json.loads(ret["body"])) == 2
+            read_counts.append(sum(scanned))
+        assert read_counts == [2, 2]
+
+
+def test_get_list_of_wallets_paginated():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-all-wallets.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"limit": "1"}
+        ret = wallets.lambda_handler(apigw_event, "")
+        first_page = json.loads(ret["body"])
+        apigw_event["queryStringParameters"]["cursor"] = ret["headers"]["X-Next-Cursor"]
+        ret = wallets.lambda_handler(apigw_event, "")
+        second_page = json.loads(ret["body"])
+        assert sorted(wallet["walletId"] for wallet in first_page + second_page) == [
+            UUID_MOCK_VALUE_NEW_WALLET1,
+            UUID_MOCK_VALUE_NEW_WALLET2,
+        ]
+
+
 def test_get_single_wallet():
     with my_test_environment():
         from src.api import wallets
@@ -522,7 +1367,7 @@ def test_get_single_wallet():
         expected_response = {
             "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
             "address": "0x123456789",
-            "balance": "5",
+            "balance": 5,
             "userId": UUID_MOCK_VALUE_MARY,
             "assetId": UUID_MOCK_VALUE_DOT,
         }
@@ -532,13 +1377,54 @@ def test_get_single_wallet():
         assert ret["statusCode"] == 200
 
 
-def test_get_single_wallet_wrong_id():
+def test_get_single_wallet_sparse_fields():
     with my_test_environment():
         from src.api import wallets
 
         with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["walletId"] = "123456789"
+        apigw_event["queryStringParameters"] = {"fields": "balance"}
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
+            "userId": UUID_MOCK_VALUE_MARY,
+            "balance": 5,
+        }
+        assert ret["statusCode"] == 200
+
+
+def test_get_single_wallet_not_modified():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = wallets.lambda_handler(apigw_event, "")
+        etag = ret["headers"]["ETag"]
+
+        apigw_event["headers"] = {"If-None-Match": etag}
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 304
+        assert ret["body"] == ""
+
+        # the content changes, so does the tag
+        boto3.resource("dynamodb").Table(WALLETS_MOCK_TABLE_NAME).update_item(
+            Key={"walletId": UUID_MOCK_VALUE_NEW_WALLET1},
+            UpdateExpression="SET address = :address",
+            ExpressionAttributeValues={":address": "0x987654321"},
+        )
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert ret["headers"]["ETag"] != etag
+
+
+def test_get_single_wallet_wrong_id():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["walletId"] = "123456789"
         ret = wallets.lambda_handler(apigw_event, "")
         assert json.loads(ret["body"]) == {}
         assert ret["statusCode"] == 200
@@ -546,253 +1432,1540 @@ def test_get_single_wallet_wrong_id():
 
 def test_get_single_wallet_wrong_user_id():
     with my_test_environment():
-        from src.api import wallets
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["userId"] = "123456789"
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "User not found"}
+        assert ret["statusCode"] == 400
+
+
+def test_add_wallet_wrong_asset_id():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-post-wallet.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["body"] = json.loads(apigw_event["body"])
+            apigw_event["body"]["assetId"] = "123456789"
+            apigw_event["body"] = json.dumps(apigw_event["body"])
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Asset not found"}
+        assert ret["statusCode"] == 400
+
+
+def test_add_wallet_invalid_body_fields():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-post-wallet.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["body"] = json.loads(apigw_event["body"])
+        del apigw_event["body"]["balance"]
+        apigw_event["body"] = json.dumps(apigw_event["body"])
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        assert ret["statusCode"] == 400
+
+
+def test_add_wallet_invalid_balance():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-post-wallet.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["body"] = json.loads(apigw_event["body"])
+        apigw_event["body"]["balance"] = "-1"
+        apigw_event["body"] = json.dumps(apigw_event["body"])
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        assert ret["statusCode"] == 400
+
+
+@patch("uuid.uuid1", mock_uuid_wallet)
+@pytest.mark.freeze_time("2001-01-01")
+def test_add_wallet():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-post-wallet.json", "r") as f:
+            apigw_event = json.load(f)
+        expected_response = json.loads(apigw_event["body"])
+        ret = wallets.lambda_handler(apigw_event, "")
+        data = json.loads(ret["body"])
+        assert data["walletId"] == UUID_MOCK_VALUE_NEW_WALLET
+        assert data["address"] == expected_response["address"]
+        assert data["balance"] == expected_response["balance"]
+        assert data["assetId"] == expected_response["assetId"]
+        assert data["userId"] == UUID_MOCK_VALUE_MARY
+        assert ret["statusCode"] == 201
+
+
+def test_add_wallet_asset_check_uses_catalogue():
+    with my_test_environment():
+        from src.api import wallets
+
+        wallets.asset_catalogue.invalidate()
+        with open("./events/wallets/event-post-wallet.json", "r") as f:
+            apigw_event = json.load(f)
+        wallets.lambda_handler(apigw_event, "")
+        with count_calls() as calls:
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 201
+        assert calls == ["PutItem"]
+
+
+def test_build_portfolio_adds_assets_sharing_a_symbol():
+    from src.api.portfolio import build_portfolio
+
+    class Catalogue:
+        def get_many(self, assetIds):
+            return {
+                assetId: {"symbol": "USDT", "blockchain": "Ethereum"}
+                for assetId in assetIds
+            }
+
+    wallets = [
+        {"walletId": "1", "assetId": "usdt-a", "balance": Decimal(10)},
+        {"walletId": "2", "assetId": "usdt-b", "balance": Decimal(5)},
+    ]
+    portfolio = build_portfolio(UUID_MOCK_VALUE_MARY, wallets, Catalogue())
+    assert len(portfolio["assets"]) == 2
+    assert portfolio["blockchains"] == [
+        {"blockchain": "Ethereum", "wallets": 2, "assets": {"USDT": 15}}
+    ]
+
+
+def test_get_portfolio():
+    with my_test_environment():
+        from src.api import wallets
+
+        wallets.asset_catalogue.invalidate()
+        boto3.resource("dynamodb").Table(WALLETS_MOCK_TABLE_NAME).put_item(
+            Item={
+                "walletId": "btc-wallet",
+                "address": "bc1q",
+                "balance": Decimal("1.5"),
+                "userId": UUID_MOCK_VALUE_MARY,
+                "assetId": UUID_MOCK_VALUE_BTC,
+            }
+        )
+        with open("./events/wallets/event-get-portfolio.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        data = json.loads(ret["body"])
+        assert data["wallets"] == 3
+        assert sorted(data["assets"], key=lambda asset: asset["symbol"]) == [
+            {
+                "assetId": UUID_MOCK_VALUE_BTC,
+                "symbol": "BTC",
+                "blockchain": "Bitcoin",
+                "wallets": 1,
+                "balance": 1.5,
+            },
+            {
+                "assetId": UUID_MOCK_VALUE_DOT,
+                "symbol": "DOT",
+                "blockchain": "Polkadot",
+                "wallets": 2,
+                "balance": 15,
+            },
+        ]
+        assert {"blockchain": "Polkadot", "wallets": 2, "assets": {"DOT": 15}} in (
+            data["blockchains"]
+        )
+
+        # the join is served from the cached catalogue
+        with count_calls() as calls:
+            wallets.lambda_handler(apigw_event, "")
+        assert calls == ["Query"]
+
+
+def test_asset_catalogue_get_many_reads_missing_assets_in_one_call():
+    with my_test_environment():
+        from src.api.catalogue import AssetCatalogue
+
+        catalogue = AssetCatalogue(ASSETS_MOCK_TABLE_NAME)
+        catalogue._fresh_assets()
+        boto3.resource("dynamodb").Table(ASSETS_MOCK_TABLE_NAME).put_item(
+            Item={"assetId": "new-asset", "symbol": "SOL", "blockchain": "Solana"}
+        )
+        with count_calls() as calls:
+            assets = catalogue.get_many([UUID_MOCK_VALUE_BTC, "new-asset", "nope"])
+        assert calls == ["BatchGetItem"]
+        assert sorted(assets) == sorted([UUID_MOCK_VALUE_BTC, "new-asset"])
+
+
+def test_delete_wallet():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+
+def test_delete_wallet_wrong_user_id():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        with count_calls() as calls:
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid userId"}
+        assert ret["statusCode"] == 400
+        # moto does not return the stored item with the failed condition
+        assert calls == ["GetItem"]
+        walletId = UUID_MOCK_VALUE_NEW_WALLET2
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 1
+
+        apigw_event["pathParameters"]["walletId"] = "123456789"
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Wallet not found"}
+        assert ret["statusCode"] == 400
+
+
+def test_delete_wallet_checks_owner_before_children():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        with count_calls() as calls:
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        # the owner, the keys of the children, then the wallet
+        assert calls == ["GetItem", "Query", "Query", "BatchWriteItem"]
+
+
+def test_delete_wallet_failed_cascade_keeps_wallet_for_retry():
+    with my_test_environment():
+        from src.api import wallets
+        from src.api.batch import batch_delete_keys
+
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["walletId"] = UUID_MOCK_VALUE_NEW_WALLET1
+        walletId = UUID_MOCK_VALUE_NEW_WALLET1
+
+        def failing_deletes(client, table_name, keys):
+            if table_name == OPERATIONS_MOCK_TABLE_NAME:
+                return keys
+            return batch_delete_keys(client, table_name, keys)
+
+        with patch("src.api.cascade.batch_delete_keys", failing_deletes):
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "2 items could not be deleted"}
+        assert ret["statusCode"] == 503
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 1
+
+        # any other failure leaves the wallet too
+        with patch(
+            "src.api.cascade.wallet_children", side_effect=RuntimeError("throttled")
+        ):
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 400
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 1
+
+        # a retry still finds the operations through the wallet
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+        assert count_items(OPERATIONS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+
+
+def test_delete_wallet_large_cascade_runs_as_job():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["walletId"] = UUID_MOCK_VALUE_NEW_WALLET1
+        walletId = UUID_MOCK_VALUE_NEW_WALLET1
+        invocations = []
+        with patch("src.api.cascade.CASCADE_SYNC_MAX_ITEMS", 1), patch(
+            "src.api.jobs.invoke_async",
+            lambda name, payload: invocations.append(payload),
+        ):
+            ret = wallets.lambda_handler(apigw_event, lambda_context())
+        assert ret["statusCode"] == 202
+        assert json.loads(ret["body"])["kind"] == "deleteWallet"
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 1
+
+        wallets.lambda_handler(invocations[0], lambda_context())
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+        assert count_items(OPERATIONS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+
+
+def test_owned_write_uses_item_returned_with_failure():
+    from botocore.exceptions import ClientError
+    from src.api import wallets
+
+    def write(**kwargs):
+        assert kwargs["ReturnValuesOnConditionCheckFailure"] == "ALL_OLD"
+        raise ClientError(
+            {
+                "Error": {"Code": "ConditionalCheckFailedException"},
+                "Item": {"userId": {"S": UUID_MOCK_VALUE_JANE}},
+            },
+            "DeleteItem",
+        )
+
+    with pytest.raises(wallets.ApiError) as err:
+        wallets.owned_write(write, "1", UUID_MOCK_VALUE_MARY, "Invalid userId")
+    assert err.value.message == "Invalid userId"
+
+
+def test_update_wallet_keeps_owner():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["httpMethod"] = "PUT"
+        apigw_event["body"] = json.dumps(
+            {"address": "0x1", "balance": 3, "assetId": UUID_MOCK_VALUE_DOT}
+        )
+        with count_calls() as calls:
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert calls == ["PutItem"]
+        walletId = apigw_event["pathParameters"]["walletId"]
+        wallet = (
+            boto3.resource("dynamodb")
+            .Table(WALLETS_MOCK_TABLE_NAME)
+            .get_item(Key={"walletId": walletId})["Item"]
+        )
+        assert wallet["userId"] == UUID_MOCK_VALUE_MARY
+        assert wallet["balance"] == 3
+
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "Error": "Wallet does not belong to the user"
+        }
+        assert ret["statusCode"] == 400
+
+
+def test_delete_wallet_cascades_to_operations():
+    with my_test_environment():
+        from src.api import wallets
+
+        put_unrelated_operations(3)
+        put_wallet_rollup(UUID_MOCK_VALUE_NEW_WALLET1, "2001-01-01")
+        put_wallet_rollup(UUID_MOCK_VALUE_NEW_WALLET1, "2001-01-02")
+
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["walletId"] = UUID_MOCK_VALUE_NEW_WALLET1
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+        walletId = UUID_MOCK_VALUE_NEW_WALLET1
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+        assert count_items(OPERATIONS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+        assert count_items(OPERATION_STATS_MOCK_TABLE_NAME, "walletId", walletId) == 0
+        # the other wallet of the user keeps its operations
+        walletId = UUID_MOCK_VALUE_NEW_WALLET2
+        assert count_items(OPERATIONS_MOCK_TABLE_NAME, "walletId", walletId) == 3
+
+
+def test_patch_wallet_balance():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["httpMethod"] = "PATCH"
+        apigw_event["body"] = json.dumps({"balance": 7})
+        with count_calls() as calls:
+            ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert calls == ["UpdateItem"]
+        walletId = apigw_event["pathParameters"]["walletId"]
+        assert json.loads(ret["body"]) == {"walletId": walletId, "balance": 7}
+        assert get_balance(walletId) == 7
+
+        apigw_event["body"] = json.dumps({"balance": -1})
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+
+        apigw_event["body"] = json.dumps({"assetId": "123456789"})
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Asset not found"}
+
+
+def test_patch_wallet_wrong_user_id():
+    with my_test_environment():
+        from src.api import wallets
+
+        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["httpMethod"] = "PATCH"
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        apigw_event["body"] = json.dumps({"balance": 7})
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "Error": "Wallet does not belong to the user"
+        }
+        assert ret["statusCode"] == 400
+
+        apigw_event["pathParameters"]["walletId"] = "123456789"
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Wallet not found"}
+        assert count_items(WALLETS_MOCK_TABLE_NAME, "walletId", "123456789") == 0
+
+
+# ----------------------------
+#           OPERATIONS
+# ----------------------------
+
+UUID_MOCK_VALUE_NEW_OPERATION = "new-operation-guid"
+
+
+def mock_uuid_operation():
+    return UUID_MOCK_VALUE_NEW_OPERATION
+
+
+@patch.dict(
+    os.environ,
+    {
+        "WALLETS_TABLE": WALLETS_MOCK_TABLE_NAME,
+        "USERS_TABLE": USERS_MOCK_TABLE_NAME,
+        "ASSETS_TABLE": ASSETS_MOCK_TABLE_NAME,
+        "OPERATIONS_TABLE": OPERATIONS_MOCK_TABLE_NAME,
+        "OPERATION_STATS_TABLE": OPERATION_STATS_MOCK_TABLE_NAME,
+        "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR",
+    },
+)
+def test_get_list_of_operations():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_get_all_operations_event = json.load(f)
+        expected_response = [
+            {
+                "operationId": UUID_MOCK_VALUE_NEW_OPERATION1,
+                "amount": 5,
+                "type": "buy",
+                "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
+                "createdAt": "2001-01-01T10:00:00.000000Z",
+            },
+            {
+                "operationId": UUID_MOCK_VALUE_NEW_OPERATION2,
+                "amount": 10,
+                "type": "sell",
+                "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
+                "createdAt": "2001-01-02T10:00:00.000000Z",
+            },
+        ]
+        ret = operations.lambda_handler(apigw_get_all_operations_event, "")
+        data = json.loads(ret["body"])
+        assert data == expected_response
+        assert ret["statusCode"] == 200
+
+
+def test_get_list_of_operations_time_range():
+    with my_test_environment():
+        from src.api import operations
+
+        put_unrelated_operations(10)
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {
+            "from": "2001-01-02",
+            "to": "2001-01-03T00:00:00Z",
+        }
+        with count_read_items("Query") as scanned:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        data = json.loads(ret["body"])
+        assert [o["operationId"] for o in data] == [UUID_MOCK_VALUE_NEW_OPERATION2]
+        # only the window is read
+        assert scanned == [1]
+
+        apigw_event["queryStringParameters"] = {"order": "desc"}
+        ret = operations.lambda_handler(apigw_event, "")
+        data = json.loads(ret["body"])
+        assert [o["operationId"] for o in data] == [
+            UUID_MOCK_VALUE_NEW_OPERATION2,
+            UUID_MOCK_VALUE_NEW_OPERATION1,
+        ]
+
+
+def test_get_list_of_operations_invalid_time_range():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        for params, error in [
+            ({"from": "yesterday"}, "Invalid from"),
+            ({"from": "2001-01-02", "to": "2001-01-01"}, "from must not be after to"),
+            ({"order": "random"}, "order must be asc or desc"),
+        ]:
+            apigw_event["queryStringParameters"] = params
+            ret = operations.lambda_handler(apigw_event, "")
+            assert json.loads(ret["body"]) == {"Error": error}
+            assert ret["statusCode"] == 400
+
+
+def put_legacy_operation():
+    # stored before operations had a createdAt
+    boto3.client("dynamodb").put_item(
+        TableName=OPERATIONS_MOCK_TABLE_NAME,
+        Item={
+            "operationId": {"S": "legacy-operation"},
+            "amount": {"N": "2"},
+            "type": {"S": "buy"},
+            "walletId": {"S": UUID_MOCK_VALUE_NEW_WALLET1},
+        },
+    )
+
+
+def test_get_list_of_operations_from_legacy_wallet_index():
+    with my_test_environment():
+        from src.api import operations
+
+        put_legacy_operation()
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        with patch(
+            "src.api.operations.OPERATIONS_WALLET_INDEX", "Operations-WalletIndex"
+        ):
+            ret = operations.lambda_handler(apigw_event, "")
+            assert ret["statusCode"] == 200
+            assert len(json.loads(ret["body"])) == 3
+
+            apigw_event["queryStringParameters"] = {"from": "2001-01-01"}
+            ret = operations.lambda_handler(apigw_event, "")
+            assert json.loads(ret["body"]) == {
+                "Error": "from, to and order are not available yet"
+            }
+            assert ret["statusCode"] == 400
+
+
+def test_backfill_created_at_migration():
+    with my_test_environment():
+        from src.api import operations, wallets
+        from src.api.migrations import backfill_created_at
+
+        put_legacy_operation()
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = operations.lambda_handler(apigw_event, "")
+        assert len(json.loads(ret["body"])) == 2
+
+        # moto ignores Segment, scan with a single segment
+        with patch("src.api.scan.SCAN_SEGMENTS", 1):
+            first = backfill_created_at(
+                OPERATIONS_MOCK_TABLE_NAME,
+                OPERATION_STATS_MOCK_TABLE_NAME,
+                "2001-01-03T00:00:00.000000Z",
+            )
+            again = backfill_created_at(
+                OPERATIONS_MOCK_TABLE_NAME, OPERATION_STATS_MOCK_TABLE_NAME
+            )
+        assert first == {"backfilled": 1, "createdAt": "2001-01-03T00:00:00.000000Z"}
+        assert again["backfilled"] == 0
+
+        ret = operations.lambda_handler(apigw_event, "")
+        items = json.loads(ret["body"])
+        assert [item["operationId"] for item in items][-1] == "legacy-operation"
+        rollup = (
+            boto3.resource("dynamodb")
+            .Table(OPERATION_STATS_MOCK_TABLE_NAME)
+            .get_item(
+                Key={
+                    "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
+                    "period": "day#2001-01-03",
+                }
+            )["Item"]
+        )
+        assert rollup["buyAmount"] == 2
+        assert rollup["buyCount"] == 1
+
+        # the cascade finds it through the sorted index too
+        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["walletId"] = UUID_MOCK_VALUE_NEW_WALLET1
+        ret = wallets.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert (
+            count_items(
+                OPERATIONS_MOCK_TABLE_NAME, "walletId", UUID_MOCK_VALUE_NEW_WALLET1
+            )
+            == 0
+        )
+
+
+def test_get_list_of_operations_sparse_fields():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        # type is a DynamoDB reserved word
+        apigw_event["queryStringParameters"] = {"fields": "type"}
+        ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        data = json.loads(ret["body"])
+        assert data
+        assert all(
+            set(operation) == {"operationId", "walletId", "type"} for operation in data
+        )
+
+
+def test_get_list_of_operations_read_cost_independent_of_other_wallets():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+
+        read_counts = []
+        for unrelated in (0, 200):
+            put_unrelated_operations(unrelated)
+            with count_read_items("Query") as scanned:
+                ret = operations.lambda_handler(apigw_event, "")
+            assert ret["statusCode"] == 200
+            assert len(json.loads(ret["body"])) == 2
+            read_counts.append(sum(scanned))
+        assert read_counts == [2, 2]
+
+
+def test_export_operations(tmp_path):
+    with my_test_environment():
+        from src.api import operations
+        from src.api.blobstore import LocalBlobStore
+
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"export": "ndjson"}
+        put_unrelated_operations(5)
+        with patch("src.api.blobstore.BLOB_STORE_LOCAL_ROOT", str(tmp_path)):
+            ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        export = json.loads(ret["body"])["export"]
+        assert export["items"] == 2
+
+        lines = b"".join(LocalBlobStore(str(tmp_path)).read_chunked(export["key"]))
+        assert sorted(
+            json.loads(line)["operationId"] for line in lines.splitlines()
+        ) == [
+            UUID_MOCK_VALUE_NEW_OPERATION1,
+            UUID_MOCK_VALUE_NEW_OPERATION2,
+        ]
+
+
+def test_export_operations_unsupported_format():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["queryStringParameters"] = {"export": "csv"}
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Unsupported export format: csv"}
+        assert ret["statusCode"] == 400
+
+
+def test_get_single_operation():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        expected_response = {
+            "operationId": UUID_MOCK_VALUE_NEW_OPERATION1,
+            "amount": 5,
+            "type": "buy",
+            "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
+            "createdAt": "2001-01-01T10:00:00.000000Z",
+        }
+        ret = operations.lambda_handler(apigw_event, "")
+        data = json.loads(ret["body"])
+        assert data == expected_response
+        assert ret["statusCode"] == 200
+
+
+def test_get_single_operation_wrong_id():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["operationId"] = "123456789"
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+
+def test_get_single_operation_wrong_user_id():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["userId"] = "123456789"
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "User not found"}
+        assert ret["statusCode"] == 400
+
+
+def test_get_single_operation_wrong_wallet_id():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["walletId"] = "123456789"
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Wallet not found"}
+        assert ret["statusCode"] == 400
+
+
+def test_add_operation_wrong_type():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["body"] = json.loads(apigw_event["body"])
+            apigw_event["body"]["type"] = "not-a-type"
+            apigw_event["body"] = json.dumps(apigw_event["body"])
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        assert ret["statusCode"] == 400
+
+
+def test_add_operation_wallet_does_not_belong_to_user():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "Error": "Wallet does not belong to the user"
+        }
+        assert ret["statusCode"] == 400
+
+
+def test_add_operation_invalid_body_fields():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["body"] = json.loads(apigw_event["body"])
+        del apigw_event["body"]["amount"]
+        apigw_event["body"] = json.dumps(apigw_event["body"])
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        assert ret["statusCode"] == 400
+
+
+@patch("uuid.uuid1", mock_uuid_operation)
+@pytest.mark.freeze_time("2001-01-01")
+def test_add_operation():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+        expected_response = json.loads(apigw_event["body"])
+        ret = operations.lambda_handler(apigw_event, "")
+        data = json.loads(ret["body"])
+        assert data["operationId"] == UUID_MOCK_VALUE_NEW_OPERATION
+        assert data["type"] == expected_response["type"]
+        assert data["amount"] == expected_response["amount"]
+        assert data["walletId"] == UUID_MOCK_VALUE_NEW_WALLET1
+        assert data["createdAt"] == "2001-01-01T00:00:00.000000Z"
+        assert ret["statusCode"] == 201
+
+
+def test_add_operations_batch():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["resource"] = "/users/{userId}/wallets/{walletId}/operations:batch"
+        apigw_event["body"] = json.dumps(
+            [{"amount": "1", "type": "buy"}, {"amount": "2", "type": "sell"}]
+        )
+        ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        results = json.loads(ret["body"])["results"]
+        assert [r["status"] for r in results] == [201, 201]
+        assert all(
+            r["item"]["walletId"] == UUID_MOCK_VALUE_NEW_WALLET1 for r in results
+        )
+
+
+def test_add_operations_batch_wallet_does_not_belong_to_user():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["resource"] = "/users/{userId}/wallets/{walletId}/operations:batch"
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        apigw_event["body"] = json.dumps([{"amount": "1", "type": "buy"}])
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "Error": "Wallet does not belong to the user"
+        }
+        assert ret["statusCode"] == 400
+
+
+def test_delete_operation():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+
+
+def test_delete_operation_wrong_wallet_id():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["walletId"] = "123456789"
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Wallet not found"}
+        assert ret["statusCode"] == 400
+
+
+def test_delete_operation_ownership_is_a_condition():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        # the stored operation is read for the balance change, the ownership
+        # of the wallet is checked by the transaction
+        with count_calls() as calls:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert calls == ["GetItem", "TransactWriteItems"]
+
+
+def test_update_operation_wallet_does_not_belong_to_user():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["httpMethod"] = "PUT"
+        apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        apigw_event["body"] = json.dumps({"amount": 8, "type": "buy"})
+        with count_calls() as calls:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {
+            "Error": "Wallet does not belong to the user"
+        }
+        assert ret["statusCode"] == 400
+        # the wallet is only read to explain the cancelled transaction
+        assert calls == ["GetItem", "TransactWriteItems", "GetItem"]
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 5
+
+
+def test_delete_operation_wrong_user_id():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+            apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid user"}
+        assert ret["statusCode"] == 400
+
+
+def test_delete_missing_operation_checks_user_and_wallet():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["operationId"] = "123456789"
+        with count_calls() as calls:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {}
+        assert ret["statusCode"] == 200
+        assert calls == ["GetItem", "BatchGetItem"]
+
+        for path, message in [
+            ({"userId": UUID_MOCK_VALUE_JANE}, "Invalid user"),
+            ({"walletId": "123456789"}, "Wallet not found"),
+            ({"userId": "123456789", "walletId": "123456789"}, "User not found"),
+        ]:
+            event = copy.deepcopy(apigw_event)
+            event["pathParameters"].update(path)
+            ret = operations.lambda_handler(event, "")
+            assert json.loads(ret["body"]) == {"Error": message}
+            assert ret["statusCode"] == 400
+
+
+def get_balance(walletId):
+    wallets_table = boto3.resource("dynamodb").Table(WALLETS_MOCK_TABLE_NAME)
+    return wallets_table.get_item(Key={"walletId": walletId})["Item"]["balance"]
+
+
+def test_add_operation_updates_balance():
+    with my_test_environment():
+        from src.api import operations
 
-        with open("./events/wallets/event-get-wallet-by-id.json", "r") as f:
+        with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["userId"] = "123456789"
-        ret = wallets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "User not found"}
-        assert ret["statusCode"] == 400
+        apigw_event["body"] = json.dumps({"amount": 2.5, "type": "sell"})
+        ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 201
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == Decimal("2.5")
 
 
-def test_add_wallet_wrong_asset_id():
+def test_add_operation_retry_with_idempotency_key_applies_once():
+    with my_test_environment(), patch(
+        "src.api.idempotency.IDEMPOTENCY_TABLE", IDEMPOTENCY_MOCK_TABLE_NAME
+    ):
+        from src.api import operations
+
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["headers"] = {"Idempotency-Key": "retry-1"}
+        apigw_event["body"] = json.dumps({"amount": 2.5, "type": "sell"})
+        first = operations.lambda_handler(apigw_event, "")
+        second = operations.lambda_handler(apigw_event, "")
+        assert first["statusCode"] == second["statusCode"] == 201
+        assert first["body"] == second["body"]
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == Decimal("2.5")
+        walletId = UUID_MOCK_VALUE_NEW_WALLET1
+        assert count_items(OPERATIONS_MOCK_TABLE_NAME, "walletId", walletId) == 3
+
+
+def test_add_operation_insufficient_balance():
     with my_test_environment():
-        from src.api import wallets
+        from src.api import operations
 
-        with open("./events/wallets/event-post-wallet.json", "r") as f:
+        with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["body"] = json.loads(apigw_event["body"])
-            apigw_event["body"]["assetId"] = "123456789"
-            apigw_event["body"] = json.dumps(apigw_event["body"])
-        ret = wallets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Asset not found"}
+        apigw_event["body"] = json.dumps({"amount": "15", "type": "sell"})
+        with count_calls() as calls:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Insufficient balance"}
         assert ret["statusCode"] == 400
+        assert calls == ["BatchGetItem", "TransactWriteItems", "GetItem"]
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 5
 
 
-def test_add_wallet_invalid_body_fields():
+def test_add_operations_batch_keeps_balance_positive():
     with my_test_environment():
-        from src.api import wallets
+        from src.api import operations
 
-        with open("./events/wallets/event-post-wallet.json", "r") as f:
+        with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-        apigw_event["body"] = json.loads(apigw_event["body"])
-        del apigw_event["body"]["balance"]
-        apigw_event["body"] = json.dumps(apigw_event["body"])
-        ret = wallets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
-        assert ret["statusCode"] == 400
+        apigw_event["resource"] = "/users/{userId}/wallets/{walletId}/operations:batch"
+        # the net amount is positive but the sell comes first
+        apigw_event["body"] = json.dumps(
+            [{"amount": 6, "type": "sell"}, {"amount": 10, "type": "buy"}]
+        )
+        ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 207
+        results = json.loads(ret["body"])["results"]
+        assert [r["status"] for r in results] == [400, 400]
+        assert results[0]["Error"] == "Insufficient balance"
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 5
+
+        apigw_event["body"] = json.dumps(
+            [{"amount": 10, "type": "buy"}, {"amount": 6, "type": "sell"}]
+        )
+        ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 9
 
 
-@patch("uuid.uuid1", mock_uuid_wallet)
-@pytest.mark.freeze_time("2001-01-01")
-def test_add_wallet():
+def test_add_operations_batch_reports_failed_chunks():
     with my_test_environment():
-        from src.api import wallets
+        from botocore.exceptions import ClientError
+        from src.api import operations
+        from src.api.db import get_client
 
-        with open("./events/wallets/event-post-wallet.json", "r") as f:
-            apigw_event = json.load(f)
-        expected_response = json.loads(apigw_event["body"])
-        ret = wallets.lambda_handler(apigw_event, "")
-        data = json.loads(ret["body"])
-        assert data["walletId"] == UUID_MOCK_VALUE_NEW_WALLET
-        assert data["address"] == expected_response["address"]
-        assert data["balance"] == expected_response["balance"]
-        assert data["assetId"] == expected_response["assetId"]
-        assert data["userId"] == UUID_MOCK_VALUE_MARY
-        assert ret["statusCode"] == 201
+        client = get_client()
+        calls = []
 
+        class ThrottledClient:
+            def transact_write_items(self, **kwargs):
+                calls.append(kwargs)
+                if len(calls) == 2:
+                    raise ClientError(
+                        {"Error": {"Code": "ThrottlingException"}},
+                        "TransactWriteItems",
+                    )
+                return client.transact_write_items(**kwargs)
 
-def test_delete_wallet():
+        with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["resource"] = "/users/{userId}/wallets/{walletId}/operations:batch"
+        apigw_event["body"] = json.dumps(
+            [{"amount": i, "type": "buy"} for i in (1, 2, 3)]
+        )
+        # one operation, the wallet and the rollup per transaction
+        with patch("src.api.balances.TRANSACT_MAX_ITEMS", 3), patch(
+            "src.api.balances.get_client", ThrottledClient
+        ):
+            ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 207
+        results = json.loads(ret["body"])["results"]
+        assert [r["status"] for r in results] == [201, 503, 201]
+        assert "ThrottlingException" in results[1]["Error"]
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 5 + 1 + 3
+
+
+def test_update_operation_applies_difference():
     with my_test_environment():
-        from src.api import wallets
+        from src.api import operations
 
-        with open("./events/wallets/event-delete-wallet-by-id.json", "r") as f:
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
             apigw_event = json.load(f)
-        ret = wallets.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {}
+        apigw_event["httpMethod"] = "PUT"
+        # the stored operation buys 5
+        apigw_event["body"] = json.dumps({"amount": 8, "type": "buy"})
+        ret = operations.lambda_handler(apigw_event, "")
         assert ret["statusCode"] == 200
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 8
 
-
-# ----------------------------
-#           OPERATIONS
-# ----------------------------
-
-UUID_MOCK_VALUE_NEW_OPERATION = "new-operation-guid"
-
-
-def mock_uuid_operation():
-    return UUID_MOCK_VALUE_NEW_OPERATION
+        apigw_event["body"] = json.dumps({"amount": 9, "type": "sell"})
+        ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Insufficient balance"}
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 8
 
 
-@patch.dict(
-    os.environ,
-    {
-        "WALLETS_TABLE": WALLETS_MOCK_TABLE_NAME,
-        "USERS_TABLE": USERS_MOCK_TABLE_NAME,
-        "ASSETS_TABLE": ASSETS_MOCK_TABLE_NAME,
-        "OPERATIONS_TABLE": OPERATIONS_MOCK_TABLE_NAME,
-        "AWS_XRAY_CONTEXT_MISSING": "LOG_ERROR",
-    },
-)
-def test_get_list_of_operations():
+def test_update_operation_repeated_change_is_applied_again():
     with my_test_environment():
         from src.api import operations
+        from src.api.db import get_client
 
-        with open("./events/operations/event-get-all-operations.json", "r") as f:
-            apigw_get_all_operations_event = json.load(f)
-        expected_response = [
-            {
-                "operationId": UUID_MOCK_VALUE_NEW_OPERATION1,
-                "amount": "5",
-                "type": "buy",
-                "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
-            },
-            {
-                "operationId": UUID_MOCK_VALUE_NEW_OPERATION2,
-                "amount": "10",
-                "type": "sell",
-                "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
-            },
-        ]
-        ret = operations.lambda_handler(apigw_get_all_operations_event, "")
-        data = json.loads(ret["body"])
-        assert data == expected_response
-        assert ret["statusCode"] == 200
+        tokens = []
 
+        def on_before_call(params, **kwargs):
+            tokens.append(json.loads(params["body"])["ClientRequestToken"])
 
-def test_get_single_operation():
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["httpMethod"] = "PATCH"
+        events = get_client().meta.events
+        events.register("before-call.dynamodb.TransactWriteItems", on_before_call)
+        try:
+            # the stored operation buys 5, change it to 8, back and to 8 again
+            for amount in (8, 5, 8):
+                apigw_event["body"] = json.dumps({"amount": amount})
+                ret = operations.lambda_handler(apigw_event, "")
+                assert ret["statusCode"] == 200
+        finally:
+            events.unregister("before-call.dynamodb.TransactWriteItems", on_before_call)
+        # DynamoDB would skip a change sent again with the same token
+        assert len(set(tokens)) == 3
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 8
+
+
+def test_update_operation_keeps_creation_time():
     with my_test_environment():
         from src.api import operations
 
         with open("./events/operations/event-get-operation-by-id.json", "r") as f:
             apigw_event = json.load(f)
-        expected_response = {
-            "operationId": UUID_MOCK_VALUE_NEW_OPERATION1,
-            "amount": "5",
-            "type": "buy",
-            "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
-        }
+        apigw_event["httpMethod"] = "PUT"
+        apigw_event["body"] = json.dumps(
+            {"amount": 5, "type": "buy", "createdAt": "1999-01-01T00:00:00Z"}
+        )
         ret = operations.lambda_handler(apigw_event, "")
-        data = json.loads(ret["body"])
-        assert data == expected_response
-        assert ret["statusCode"] == 200
+        assert json.loads(ret["body"])["createdAt"] == "2001-01-01T10:00:00.000000Z"
 
 
-def test_get_single_operation_wrong_id():
+def test_delete_operation_updates_balance():
     with my_test_environment():
         from src.api import operations
 
-        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["operationId"] = "123456789"
         ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {}
         assert ret["statusCode"] == 200
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 0
 
+        # deleting it again changes nothing
+        ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 0
 
-def test_get_single_operation_wrong_user_id():
+
+def set_string_attribute(table_name, key, attribute, value):
+    # items written before numbers were stored as numbers
+    boto3.client("dynamodb").update_item(
+        TableName=table_name,
+        Key={name: {"S": v} for name, v in key.items()},
+        UpdateExpression="SET #a = :v",
+        ExpressionAttributeNames={"#a": attribute},
+        ExpressionAttributeValues={":v": {"S": value}},
+    )
+
+
+def test_add_operation_on_string_balance_is_not_insufficient_balance():
     with my_test_environment():
         from src.api import operations
 
-        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+        set_string_attribute(
+            WALLETS_MOCK_TABLE_NAME,
+            {"walletId": UUID_MOCK_VALUE_NEW_WALLET1},
+            "balance",
+            "5",
+        )
+        with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["userId"] = "123456789"
+        apigw_event["body"] = json.dumps({"amount": 1, "type": "buy"})
         ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "User not found"}
-        assert ret["statusCode"] == 400
+        error = json.loads(ret["body"])["Error"]
+        assert error != "Insufficient balance"
+        assert "TransactionCanceledException" in error
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == "5"
 
 
-def test_get_single_operation_wrong_wallet_id():
+def test_convert_numbers_migration():
     with my_test_environment():
         from src.api import operations
+        from src.api.migrations import convert_numbers
+
+        set_string_attribute(
+            WALLETS_MOCK_TABLE_NAME,
+            {"walletId": UUID_MOCK_VALUE_NEW_WALLET1},
+            "balance",
+            "5",
+        )
+        set_string_attribute(
+            WALLETS_MOCK_TABLE_NAME,
+            {"walletId": UUID_MOCK_VALUE_NEW_WALLET2},
+            "balance",
+            "ten",
+        )
+        set_string_attribute(
+            OPERATIONS_MOCK_TABLE_NAME,
+            {"operationId": UUID_MOCK_VALUE_NEW_OPERATION1},
+            "amount",
+            "5",
+        )
+        # moto ignores Segment, scan with a single segment
+        with patch("src.api.scan.SCAN_SEGMENTS", 1):
+            wallets = convert_numbers(WALLETS_MOCK_TABLE_NAME, "walletId", "balance")
+            amounts = convert_numbers(
+                OPERATIONS_MOCK_TABLE_NAME, "operationId", "amount"
+            )
+            # running again finds nothing left to convert
+            again = convert_numbers(OPERATIONS_MOCK_TABLE_NAME, "operationId", "amount")
+        assert wallets == {"converted": 1, "invalid": [UUID_MOCK_VALUE_NEW_WALLET2]}
+        assert amounts == {"converted": 1, "invalid": []}
+        assert again == {"converted": 0, "invalid": []}
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 5
 
-        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
+        with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["walletId"] = "123456789"
+        apigw_event["body"] = json.dumps({"amount": 1, "type": "buy"})
         ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Wallet not found"}
-        assert ret["statusCode"] == 400
+        assert ret["statusCode"] == 201
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 6
 
 
-def test_add_operation_wrong_type():
+def get_wallet_stats(params=None):
+    from src.api import operations
+
+    with open("./events/operations/event-get-all-operations.json", "r") as f:
+        apigw_event = json.load(f)
+    apigw_event["resource"] = "/users/{userId}/wallets/{walletId}/stats"
+    apigw_event["queryStringParameters"] = params
+    return operations.lambda_handler(apigw_event, "")
+
+
+def test_wallet_stats_follow_operation_writes():
     with my_test_environment():
         from src.api import operations
 
         with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["body"] = json.loads(apigw_event["body"])
-            apigw_event["body"]["type"] = "not-a-type"
-            apigw_event["body"] = json.dumps(apigw_event["body"])
-        ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
+        with pytest.MonkeyPatch.context() as mp:
+            for day, body in [
+                ("2001-01-01", {"amount": 4, "type": "buy"}),
+                ("2001-01-01", {"amount": 1.5, "type": "sell"}),
+                ("2001-01-03", {"amount": 2, "type": "sell"}),
+            ]:
+                mp.setattr(operations, "now_iso", lambda: f"{day}T12:00:00.000000Z")
+                apigw_event["body"] = json.dumps(body)
+                ret = operations.lambda_handler(apigw_event, "")
+                assert ret["statusCode"] == 201
+        created = json.loads(ret["body"])
+
+        ret = get_wallet_stats({"granularity": "day"})
+        assert ret["statusCode"] == 200
+        assert json.loads(ret["body"]) == [
+            {
+                "date": "2001-01-01",
+                "buyAmount": 4,
+                "buyCount": 1,
+                "sellAmount": 1.5,
+                "sellCount": 1,
+            },
+            {
+                "date": "2001-01-03",
+                "buyAmount": 0,
+                "buyCount": 0,
+                "sellAmount": 2,
+                "sellCount": 1,
+            },
+        ]
+
+        # an update moves the amount from sells to buys, a delete removes it
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_event = json.load(f)
+        apigw_event["pathParameters"]["operationId"] = created["operationId"]
+        apigw_event["httpMethod"] = "PUT"
+        apigw_event["body"] = json.dumps({"amount": 3, "type": "buy"})
+        assert operations.lambda_handler(apigw_event, "")["statusCode"] == 200
+        ret = get_wallet_stats({"from": "2001-01-02"})
+        assert json.loads(ret["body"]) == [
+            {
+                "date": "2001-01-03",
+                "buyAmount": 3,
+                "buyCount": 1,
+                "sellAmount": 0,
+                "sellCount": 0,
+            }
+        ]
+
+        apigw_event["httpMethod"] = "DELETE"
+        assert operations.lambda_handler(apigw_event, "")["statusCode"] == 200
+        ret = get_wallet_stats({"from": "2001-01-02", "to": "2001-01-31"})
+        assert json.loads(ret["body"]) == []
+
+
+def test_wallet_stats_invalid_granularity():
+    with my_test_environment():
+        ret = get_wallet_stats({"granularity": "hour"})
+        assert json.loads(ret["body"]) == {"Error": "granularity must be one of: day"}
         assert ret["statusCode"] == 400
 
 
-def test_add_operation_wallet_does_not_belong_to_user():
+def test_rollups_applied_once_per_change():
+    with my_test_environment():
+        from src.api import balances
+        from src.api.rollups import get_stats
+
+        operation = {
+            "operationId": "retried-operation",
+            "walletId": UUID_MOCK_VALUE_NEW_WALLET1,
+            "amount": Decimal("2"),
+            "type": "buy",
+            "createdAt": "2001-01-05T00:00:00.000000Z",
+        }
+        balances.write_operation(
+            OPERATIONS_MOCK_TABLE_NAME,
+            WALLETS_MOCK_TABLE_NAME,
+            UUID_MOCK_VALUE_MARY,
+            operation,
+            stats_table=OPERATION_STATS_MOCK_TABLE_NAME,
+        )
+        # a retry is either answered from the request token or refused by
+        # the operation condition, it is never applied twice
+        with contextlib.suppress(balances.BalanceError):
+            balances.write_operation(
+                OPERATIONS_MOCK_TABLE_NAME,
+                WALLETS_MOCK_TABLE_NAME,
+                UUID_MOCK_VALUE_MARY,
+                operation,
+                stats_table=OPERATION_STATS_MOCK_TABLE_NAME,
+            )
+        stats = get_stats(
+            OPERATION_STATS_MOCK_TABLE_NAME,
+            UUID_MOCK_VALUE_NEW_WALLET1,
+            {"queryStringParameters": None},
+        )
+        assert [(s["date"], s["buyCount"]) for s in stats] == [("2001-01-05", 1)]
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 7
+
+
+def test_add_operations_reuse_cached_ownership():
     with my_test_environment():
         from src.api import operations
+        from src.api.lookups import existence_cache
 
         with open("./events/operations/event-post-operation.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["userId"] = UUID_MOCK_VALUE_JANE
-        ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {
-            "Error": "Wallet does not belong to the user"
-        }
-        assert ret["statusCode"] == 400
+        with count_calls() as calls:
+            for _ in range(5):
+                ret = operations.lambda_handler(apigw_event, "")
+                assert ret["statusCode"] == 201
+        assert calls.count("BatchGetItem") == 1
+        assert existence_cache.stats()["hits"] == 8
 
 
-def test_add_operation_invalid_body_fields():
+def test_delete_operation_bypasses_existence_cache():
     with my_test_environment():
         from src.api import operations
 
         with open("./events/operations/event-post-operation.json", "r") as f:
+            apigw_post_event = json.load(f)
+        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+            apigw_delete_event = json.load(f)
+        operations.lambda_handler(apigw_post_event, "")
+
+        # the wallet changes owner behind the cache's back
+        boto3.resource("dynamodb").Table(WALLETS_MOCK_TABLE_NAME).update_item(
+            Key={"walletId": UUID_MOCK_VALUE_NEW_WALLET1},
+            UpdateExpression="SET userId = :userId",
+            ExpressionAttributeValues={":userId": UUID_MOCK_VALUE_JANE},
+        )
+        ret = operations.lambda_handler(apigw_delete_event, "")
+        assert json.loads(ret["body"]) == {"Error": "Invalid user"}
+        assert ret["statusCode"] == 400
+
+
+def test_get_user_and_wallet_stops_retrying_unprocessed_keys():
+    from src.api import lookups
+    from src.api.router import ApiError
+
+    class ThrottledDynamoDB:
+        def batch_get_item(self, RequestItems):
+            return {"Responses": {}, "UnprocessedKeys": RequestItems}
+
+    lookups.existence_cache.clear()
+    with patch("src.api.lookups.get_resource", ThrottledDynamoDB), patch(
+        "src.api.batch.BATCH_BACKOFF_SECONDS", 0
+    ), pytest.raises(ApiError) as err:
+        lookups.get_user_and_wallet("Users", "Wallets", "u", "w")
+    assert err.value.status_code == 503
+    # nothing is cached from a failed read
+    assert lookups.existence_cache.stats()["size"] == 0
+
+
+def test_existence_cache_negative_lookups_and_expiry():
+    from src.api.cache import MISSING, LRUCache
+
+    now = [0.0]
+    cache = LRUCache(max_items=2, ttl=5, clock=lambda: now[0])
+    cache.put(("user", "a"), None)
+    cache.put(("user", "b"), {"userId": "b"})
+    assert cache.get(("user", "a")) is None
+    assert cache.get(("user", "b"), max_age=0) is MISSING
+
+    # least recently used entry is evicted first
+    cache.put(("user", "c"), {"userId": "c"})
+    assert cache.get(("user", "b")) is MISSING
+    assert cache.get(("user", "a")) is None
+
+    now[0] = 5.0
+    assert cache.get(("user", "a")) is MISSING
+    assert cache.stats() == {"hits": 2, "misses": 3, "size": 1}
+
+
+def test_patch_operation_applies_difference():
+    with my_test_environment():
+        from src.api import operations
+
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
             apigw_event = json.load(f)
-        apigw_event["body"] = json.loads(apigw_event["body"])
-        del apigw_event["body"]["amount"]
-        apigw_event["body"] = json.dumps(apigw_event["body"])
+        apigw_event["httpMethod"] = "PATCH"
+        # the stored operation buys 5
+        apigw_event["body"] = json.dumps({"amount": 8})
+        with count_calls() as calls:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert ret["statusCode"] == 200
+        assert calls == ["GetItem", "TransactWriteItems"]
+        assert json.loads(ret["body"])["amount"] == 8
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 8
+
+        apigw_event["body"] = json.dumps({"type": "sell"})
         ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Invalid body fields"}
-        assert ret["statusCode"] == 400
+        assert json.loads(ret["body"]) == {"Error": "Insufficient balance"}
+        assert get_balance(UUID_MOCK_VALUE_NEW_WALLET1) == 8
 
 
-@patch("uuid.uuid1", mock_uuid_operation)
-@pytest.mark.freeze_time("2001-01-01")
-def test_add_operation():
+def test_patch_operation_invalid_body():
     with my_test_environment():
         from src.api import operations
 
-        with open("./events/operations/event-post-operation.json", "r") as f:
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
             apigw_event = json.load(f)
-        expected_response = json.loads(apigw_event["body"])
+        apigw_event["httpMethod"] = "PATCH"
+        for body, message in [
+            ({"createdAt": "1999-01-01T00:00:00Z"}, "createdAt can not be changed"),
+            ({"walletId": "1"}, "walletId can not be changed"),
+            ({"type": "swap"}, "Invalid body fields"),
+            ({"amount": 0}, "Invalid body fields"),
+        ]:
+            apigw_event["body"] = json.dumps(body)
+            ret = operations.lambda_handler(apigw_event, "")
+            assert json.loads(ret["body"]) == {"Error": message}
+            assert ret["statusCode"] == 400
+
+        apigw_event["pathParameters"]["operationId"] = "123456789"
+        apigw_event["body"] = json.dumps({"amount": 1})
         ret = operations.lambda_handler(apigw_event, "")
-        data = json.loads(ret["body"])
-        assert data["operationId"] == UUID_MOCK_VALUE_NEW_OPERATION
-        assert data["type"] == expected_response["type"]
-        assert data["amount"] == expected_response["amount"]
-        assert data["walletId"] == UUID_MOCK_VALUE_NEW_WALLET1
-        assert ret["statusCode"] == 201
+        assert json.loads(ret["body"]) == {"Error": "Operation not found"}
 
 
-def test_delete_operation():
+# ----------------------------
+#           CLIENT
+# ----------------------------
+
+
+def test_table_handles_created_once_per_container():
+    with my_test_environment():
+        from src.api import db
+
+        assert db.table(USERS_MOCK_TABLE_NAME) is db.table(USERS_MOCK_TABLE_NAME)
+        assert db.table(USERS_MOCK_TABLE_NAME).meta.client is db.get_client()
+        assert set(db.init_timings) == {"importMs", "clientMs"}
+
+
+@pytest.mark.parametrize("handler", ["users", "assets", "wallets", "operations"])
+def test_import_time_covers_the_sdk(handler):
+    # a fresh interpreter, like a cold container, boto3 is not loaded yet
+    script = (
+        f"import src.api.{handler}; from src.api import db; "
+        "print(db.init_timings['importMs'])"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=dict(os.environ, AWS_DEFAULT_REGION="us-east-1"),
+    ).stdout
+    # importing boto3 alone takes tens of milliseconds
+    assert float(output.splitlines()[-1]) > 10
+
+
+def dynamodb_summary(output):
+    # the per invocation summary line logged by Router.dispatch
+    lines = [json.loads(line) for line in output.splitlines() if line.startswith("{")]
+    return [line for line in lines if line["message"] == "DynamoDB calls"][-1]
+
+
+def test_invocation_logs_dynamodb_calls(capsys):
     with my_test_environment():
         from src.api import operations
 
-        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+        with open("./events/operations/event-get-operation-by-id.json", "r") as f:
             apigw_event = json.load(f)
+        apigw_event["httpMethod"] = "PATCH"
+        apigw_event["body"] = json.dumps({"amount": 8})
         ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {}
         assert ret["statusCode"] == 200
 
+        summary = dynamodb_summary(capsys.readouterr().out)
+        assert summary["route"] == (
+            "PATCH /users/{userId}/wallets/{walletId}/operations/{operationId}"
+        )
+        assert summary["statusCode"] == 200
+        assert summary["calls"] == 2
+        assert set(summary["operations"]) == {"GetItem", "TransactWriteItems"}
+        assert summary["operations"]["GetItem"]["count"] == 1
+        assert summary["operations"]["GetItem"]["errors"] == 0
+        assert summary["operations"]["GetItem"]["ms"] > 0
 
-def test_delete_operation_wrong_wallet_id():
+
+def test_calls_ask_for_consumed_capacity():
+    with my_test_environment():
+        from src.api import users
+        from src.api.metrics import call_metrics
+
+        sent = []
+
+        def on_before_call(params, **kwargs):
+            sent.append(json.loads(params["body"]).get("ReturnConsumedCapacity"))
+
+        from src.api.db import get_client
+
+        events = get_client().meta.events
+        events.register("before-call.dynamodb", on_before_call)
+        try:
+            with open("./events/users/event-get-user-by-id.json", "r") as f:
+                ret = users.lambda_handler(json.load(f), "")
+        finally:
+            events.unregister("before-call.dynamodb", on_before_call)
+        assert ret["statusCode"] == 200
+        assert sent == ["TOTAL"]
+        summary = call_metrics.summary()
+        assert summary["calls"] == 1
+        assert summary["capacityUnits"] == summary["tables"][USERS_MOCK_TABLE_NAME]
+
+
+def test_call_metrics_sum_batch_capacity_per_table():
+    from src.api.metrics import CallMetrics
+
+    now = [0.0]
+    metrics = CallMetrics(clock=lambda: now[0])
+    metrics.record(
+        "BatchWriteItem",
+        0.002,
+        [
+            {"TableName": "Wallets", "CapacityUnits": 2.0},
+            {"TableName": "Operations", "CapacityUnits": 3.0},
+        ],
+        False,
+    )
+    metrics.record(
+        "GetItem", 0.001, [{"TableName": "Wallets", "CapacityUnits": 0.5}], True
+    )
+    now[0] = 0.01
+    summary = metrics.summary()
+    assert summary["calls"] == 2
+    assert summary["durationMs"] == 10.0
+    assert summary["callsMs"] == 3.0
+    assert summary["capacityUnits"] == 5.5
+    assert summary["tables"] == {"Wallets": 2.5, "Operations": 3.0}
+    assert summary["operations"]["GetItem"]["errors"] == 1
+
+    metrics.reset()
+    assert metrics.summary()["calls"] == 0
+
+
+# ----------------------------
+#           ROUTER
+# ----------------------------
+
+
+def test_unsupported_route_skips_prechecks():
     with my_test_environment():
         from src.api import operations
 
-        with open("./events/operations/event-delete-operation-by-id.json", "r") as f:
+        with open("./events/operations/event-get-all-operations.json", "r") as f:
             apigw_event = json.load(f)
-            apigw_event["pathParameters"]["walletId"] = "123456789"
-        ret = operations.lambda_handler(apigw_event, "")
-        assert json.loads(ret["body"]) == {"Error": "Wallet not found"}
+            apigw_event["httpMethod"] = "PATCH"
+        with count_calls() as calls:
+            ret = operations.lambda_handler(apigw_event, "")
+        assert json.loads(ret["body"]) == {"Message": "Unsupported route"}
         assert ret["statusCode"] == 400
+        assert calls == []
+
+
+def test_route_registered_once():
+    from src.api.router import Router
+
+    router = Router()
+    router.route("GET", "/users")(lambda request: None)
+    with pytest.raises(ValueError):
+        router.route("GET", "/users")(lambda request: None)
@@ -0,0 +1,85 @@
+import threading
+import zlib
+
+import pytest
+
+from src.api.scan import parallel_scan
+
+
+class FakeSegmentedClient:
+    # stands in for DynamoDB, which moto does not split into segments
+    def __init__(self, items, fail_segment=None):
+        self.items = items
+        self.fail_segment = fail_segment
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def scan(self, TableName, Segment, TotalSegments, Limit=10, **kwargs):
+        with self.lock:
+            self.calls.append((Segment, kwargs.get("ExclusiveStartKey")))
+        if Segment == self.fail_segment:
+            raise RuntimeError("segment failed")
+        segment_items = [
+            item
+            for item in self.items
+            if zlib.crc32(item["id"].encode()) % TotalSegments == Segment
+        ]
+        start = kwargs.get("ExclusiveStartKey", {"position": 0})["position"]
+        page = segment_items[start : start + Limit]
+        ddb_response = {"Items": page, "ScannedCount": len(page)}
+        if start + Limit < len(segment_items):
+            ddb_response["LastEvaluatedKey"] = {"position": start + Limit}
+        return ddb_response
+
+
+class FakeTable:
+    def __init__(self, client):
+        self.name = "FakeTable"
+        self.meta = type("Meta", (), {"client": client})()
+
+
+def make_table(count, **kwargs):
+    items = [{"id": f"item-{i}"} for i in range(count)]
+    return FakeTable(FakeSegmentedClient(items, **kwargs))
+
+
+def test_parallel_scan_returns_every_item_once():
+    table = make_table(250)
+    items = list(parallel_scan(table, total_segments=4, page_size=10))
+    assert sorted(item["id"] for item in items) == sorted(
+        f"item-{i}" for i in range(250)
+    )
+    assert {segment for segment, _ in table.meta.client.calls} == {0, 1, 2, 3}
+
+
+def test_parallel_scan_reports_progress():
+    table = make_table(100)
+    snapshots = []
+    list(
+        parallel_scan(
+            table,
+            total_segments=3,
+            page_size=7,
+            on_progress=lambda progress: snapshots.append(progress.as_dict()),
+        )
+    )
+    assert snapshots[-1]["finishedSegments"] == 3
+    assert snapshots[-1]["items"] == 100
+    assert snapshots[-1]["scanned"] == 100
+    assert snapshots[-1]["pages"] == len(table.meta.client.calls)
+
+
+def test_parallel_scan_bounded_buffer_with_early_stop():
+    table = make_table(1000)
+    scan = parallel_scan(table, total_segments=4, max_buffered_pages=1, page_size=5)
+    first_items = [next(scan) for _ in range(12)]
+    scan.close()
+    assert len(first_items) == 12
+    # workers stop once the consumer is gone instead of reading the whole table
+    assert len(table.meta.client.calls) < 1000 / 5
+
+
+def test_parallel_scan_propagates_segment_errors():
+    table = make_table(50, fail_segment=2)
+    with pytest.raises(RuntimeError, match="segment failed"):
+        list(parallel_scan(table, total_segments=4, page_size=5))
@@ -0,0 +1,37 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+from src.api.router import response
+from src.api.serializer import dumps
+
+
+def test_dumps_whole_decimals_as_ints():
+    assert dumps({"a": Decimal("5"), "b": Decimal("1E+2")}) == '{"a":5,"b":100}'
+
+
+def test_dumps_keeps_decimal_precision():
+    body = [
+        {"walletId": "a", "balance": Decimal("12345678901234567890.123456789")},
+        {"walletId": "b", "balance": Decimal("0.5"), "tags": ["x"]},
+        {"walletId": "c", "balance": Decimal("-0.00000000000000000001")},
+    ]
+    text = dumps(body)
+    assert '"balance":12345678901234567890.123456789' in text
+    assert json.loads(text, parse_float=Decimal) == body
+
+
+def test_dumps_leaves_lookalike_strings_alone():
+    body = {"note": "0.5", "amount": Decimal("0.1000000000000000000001")}
+    assert json.loads(dumps(body), parse_float=Decimal) == body
+
+
+def test_dumps_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        dumps({"when": object()})
+
+
+def test_response_encodes_numeric_items():
+    ret = response(200, {"balance": Decimal("7"), "amount": Decimal("2.5")})
+    assert json.loads(ret["body"]) == {"balance": 7, "amount": 2.5}